@@ -1,80 +1,161 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
 import os
 import boto3
-from io import BytesIO
-from blogs.utils.csv import write_csv
-from threading import Thread
+import hashlib
+import json
+from botocore.exceptions import ClientError
+from functools import partial
+from threading import Lock
+
+from blogs.tasks import executor
+
+
+S3_BUCKET = 'bear-backup'
+
+# Saves within this many seconds of the first one share a single backup run
+BACKUP_DEBOUNCE = 60
+
+# Ranking and search data changes without the writer touching anything
+VOLATILE_POST_FIELDS = {'upvotes', 'shadow_votes', 'score', 'search_vector'}
+
+_pending = {}
+_pending_lock = Lock()
 
 
 def backup_in_thread(blog):
     if os.getenv('ENVIRONMENT') == 'dev':
         return
 
-    if blog.reviewed:
-        print(f"Backing up {blog.title} in thread")
-        thread = Thread(target=backup_blog, args=(blog,))
-        thread.start()
-        return thread
-    else:
+    if not blog.reviewed:
         print(f"Blog {blog.title} is not reviewed, skipping backup")
+        return
+
+    with _pending_lock:
+        if blog.pk in _pending:
+            return True
+        _pending[blog.pk] = True
+
+    # Outside the lock, on dev and in tests the backup runs inline and clears the entry
+    print(f"Backing up {blog.title} in {BACKUP_DEBOUNCE}s")
+    scheduled = executor.schedule(BACKUP_DEBOUNCE, 'backup', _run_backup, blog.pk, refused=partial(_forget_backup, blog.pk))
+    if not scheduled:
+        _forget_backup(blog.pk)
+    return scheduled
+
+
+def _forget_backup(blog_id):
+    # The run was refused or finished starting, the next save schedules a new one
+    with _pending_lock:
+        _pending.pop(blog_id, None)
+
+
+def _run_backup(blog_id):
+    from blogs.models import Blog
+
+    _forget_backup(blog_id)
+    blog = Blog.objects.filter(pk=blog_id).first()
+    if blog:
+        result = backup_blog(blog)
+        print(f"Backup of {blog.subdomain}: {result}")
+
+
+def get_s3_client():
+    return boto3.client(
+        's3',
+        region_name='fra1',
+        endpoint_url='https://fra1.digitaloceanspaces.com',
+        aws_access_key_id=os.environ.get('SPACES_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.environ.get('SPACES_SECRET'),
+    )
+
+
+def serialize(row):
+    data = json.dumps(row, cls=DjangoJSONEncoder, sort_keys=True).encode('utf-8')
+    return data, hashlib.sha256(data).hexdigest()[:32]
 
 
-def backup_blog(blog):
+def read_manifest(s3_client, key):
+    try:
+        return json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+
+
+def load_backup(subdomain, date=None, s3_client=None):
+    # The blog row and post rows of the latest backup, or of the one made on date (YYYY-MM-DD)
+    s3_client = s3_client or get_s3_client()
+    base_path = f'content/{subdomain}'
+    manifest = read_manifest(s3_client, f'{base_path}/{date}/manifest.json' if date else f'{base_path}/manifest.json')
+    if manifest is None:
+        return None, []
+
+    def read(key):
+        return json.loads(s3_client.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read())
+
+    posts = sorted((read(key) for key in manifest['posts'].values()), key=lambda post: post['id'])
+    return read(manifest['blog']), posts
+
+
+def backup_blog(blog, s3_client=None):
+    """Uploads whatever changed since the last backup.
+
+    Posts and blog settings are stored as JSON objects named by their content hash, so
+    unchanged ones are never uploaded again. content/<subdomain>/manifest.json lists the
+    objects making up the latest backup, and a copy is kept per day it changed in
+    content/<subdomain>/<date>/manifest.json.
+    """
     date_str = timezone.now().strftime('%Y-%m-%d')
-    base_path = f'content/{blog.subdomain}/{date_str}'
-    
-    aws_access_key = os.environ.get('SPACES_ACCESS_KEY_ID')
-    aws_secret_key = os.environ.get('SPACES_SECRET')
-    s3_bucket = 'bear-backup'
-    
+    base_path = f'content/{blog.subdomain}'
+
     try:
-        s3_client = boto3.client(
-            's3',
-            region_name='fra1',
-            endpoint_url='https://fra1.digitaloceanspaces.com',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key
-        )
-        
+        s3_client = s3_client or get_s3_client()
+        previous = read_manifest(s3_client, f'{base_path}/manifest.json') or {}
+        stored = set(previous.get('posts', {}).values()) | {previous.get('blog')}
+
         uploaded_files = []
-        
-        # Export and upload posts CSV
-        if blog.posts.count() > 0:
-            # Create posts CSV in memory
-            posts_csv_buffer = BytesIO()
-            write_csv(blog.posts.values(), posts_csv_buffer)
-            
-            # Upload posts CSV
-            posts_csv_buffer.seek(0)
-            posts_object_path = f'{base_path}/posts.csv'
-            s3_client.upload_fileobj(posts_csv_buffer, s3_bucket, posts_object_path)
-            uploaded_files.append(posts_object_path)
-        
-        # Export and upload blog info CSV
-        blog_csv_buffer = BytesIO()
-
-        # Create a queryset with just this blog
-        blog_queryset = type(blog).objects.filter(pk=blog.pk)
-        write_csv(blog_queryset.values(), blog_csv_buffer)
-        
-        # Upload blog CSV
-        blog_csv_buffer.seek(0)
-        blog_object_path = f'{base_path}/blog.csv'
-        s3_client.upload_fileobj(blog_csv_buffer, s3_bucket, blog_object_path)
-        uploaded_files.append(blog_object_path)
-        
+        uploaded_bytes = 0
+
+        def store(key, data):
+            nonlocal uploaded_bytes
+            if key not in stored:
+                s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=data, ContentType='application/json')
+                uploaded_files.append(key)
+                uploaded_bytes += len(data)
+
+        posts = {}
+        fields = [field.attname for field in blog.posts.model._meta.concrete_fields if field.attname not in VOLATILE_POST_FIELDS]
+        for row in blog.posts.values(*fields).iterator(chunk_size=20):
+            data, digest = serialize(row)
+            key = f'{base_path}/posts/{row["uid"]}/{digest}.json'
+            store(key, data)
+            posts[row['uid']] = key
+
+        blog_data, digest = serialize(type(blog).objects.filter(pk=blog.pk).values().get())
+        blog_key = f'{base_path}/blog/{digest}.json'
+        store(blog_key, blog_data)
+
+        manifest = {'blog': blog_key, 'posts': posts}
+        if manifest != {'blog': previous.get('blog'), 'posts': previous.get('posts')}:
+            body = json.dumps({**manifest, 'backup_date': date_str}, sort_keys=True).encode('utf-8')
+            for key in (f'{base_path}/{date_str}/manifest.json', f'{base_path}/manifest.json'):
+                s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=body, ContentType='application/json')
+                uploaded_files.append(key)
+                uploaded_bytes += len(body)
+
         return {
             'success': True,
             'blog_subdomain': blog.subdomain,
             'backup_date': date_str,
             'uploaded_files': uploaded_files,
-            'post_count': blog.posts.count()
+            'uploaded_bytes': uploaded_bytes,
+            'post_count': len(posts)
         }
-        
+
     except Exception as e:
-        return {
-            'success': False,
-            'error': str(e),
-            'blog_subdomain': blog.subdomain
-        }
+        # Raised so the backup queue retries the run, uploads so far are skipped next time
+        print(f"Backup of {blog.subdomain} failed: {e}")
+        raise
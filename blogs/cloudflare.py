@@ -0,0 +1,118 @@
+import os
+import requests
+from threading import Lock
+
+from blogs.tasks import executor
+
+
+CLOUDFLARE_API_URL = os.getenv('CLOUDFLARE_API_URL', 'https://api.cloudflare.com/client/v4')
+
+# Saves within this many seconds of each other share a purge request
+PURGE_WINDOW = 2
+
+# Cloudflare accepts at most this many cache tags per purge request
+TAGS_PER_REQUEST = 30
+
+
+def purge_tags(tags):
+    """Purges the cache tags in a single request, raises on failure so the task queue can retry."""
+    if os.getenv('ENVIRONMENT') == 'dev':
+        # Don't invalidate on dev
+        return
+
+    cloudflare_api_key = os.getenv('CLOUDFLARE_API_KEY')
+    cloudflare_email = os.getenv('CLOUDFLARE_EMAIL')
+    cloudflare_zone_id = os.getenv('CLOUDFLARE_ZONE_ID')
+
+    if not all([cloudflare_api_key, cloudflare_email, cloudflare_zone_id]):
+        return
+
+    headers = {
+        'X-Auth-Email': cloudflare_email,
+        'Authorization': f'Bearer {cloudflare_api_key}',
+        'Content-Type': 'application/json',
+    }
+
+    url = f"{CLOUDFLARE_API_URL}/zones/{cloudflare_zone_id}/purge_cache"
+
+    response = requests.post(url, headers=headers, json={"tags": list(tags)}, timeout=5)
+    response.raise_for_status()
+    response_data = response.json()
+    if response_data.get('success') != True:
+        raise Exception(f"Failed to invalidate Cloudflare cache for tags {tags}: {response_data.get('errors', [])}")
+
+    print(f"Invalidated Cloudflare cache for tags: {', '.join(tags)}")
+    return response_data
+
+
+def batches(tags):
+    tags = sorted(set(tags))
+    return [tags[i:i + TAGS_PER_REQUEST] for i in range(0, len(tags), TAGS_PER_REQUEST)]
+
+
+def purge(tags):
+    # Synchronous, for management commands that exit before a background purge would run
+    for batch in batches(tags):
+        try:
+            purge_tags(batch)
+        except Exception as e:
+            print(f"Error invalidating Cloudflare cache for {', '.join(batch)}: {str(e)}")
+
+
+class PurgeQueue:
+    """Collects cache tags for PURGE_WINDOW seconds, then purges them in as few requests as possible.
+
+    A post save also saves its blog, and bulk imports save hundreds of posts, which
+    used to be one purge request each.
+    """
+
+    def __init__(self):
+        self._tags = set()
+        self._lock = Lock()
+        self._scheduled = False
+
+        self.added = 0
+        self.flushed_tags = 0
+        self.requests = 0
+
+    def add(self, *tags):
+        with self._lock:
+            self.added += len(tags)
+            self._tags.update(tag.lower() for tag in tags)
+            if self._scheduled or not self._tags:
+                return
+            self._scheduled = True
+        executor.schedule(PURGE_WINDOW, 'cloudflare', self.flush, refused=self.retry)
+
+    def retry(self, tags=()):
+        # The cloudflare queue was full, keep the tags and try again in the next window
+        with self._lock:
+            self._tags.update(tags)
+            self._scheduled = False
+        self.add()
+
+    def flush(self):
+        with self._lock:
+            tags, self._tags = self._tags, set()
+            self._scheduled = False
+
+        refused = []
+        for batch in batches(tags):
+            if executor.submit('cloudflare', purge_tags, batch):
+                self.flushed_tags += len(batch)
+                self.requests += 1
+            else:
+                refused.extend(batch)
+        if refused:
+            self.retry(refused)
+
+    def stats(self):
+        return {
+            'pending': len(self._tags),
+            'added': self.added,
+            'flushed_tags': self.flushed_tags,
+            'requests': self.requests,
+        }
+
+
+purge_queue = PurgeQueue()
@@ -1,19 +1,20 @@
+from django.conf import settings
 from django.utils import timezone
 from django.core.mail import EmailMultiAlternatives
 from django.contrib.gis.geoip2 import GeoIP2
-from django.db.models import Max, Min
 import re
 import os
-import random
-import threading
 from requests.exceptions import ConnectionError, ReadTimeout
 import requests
-from time import time
 import geoip2
+import httpagentparser
 from ipaddr import client_ip
 import hashlib
 
-from blogs.models import Blog, Post
+from blogs.models import Blog, DiscoverPost
+from blogs.random_pool import sample_blogs, sample_posts
+from blogs.tasks import executor
+from blogs.utils.lru import LRUCache
 
 
 def is_protected(subdomain):
@@ -94,13 +95,25 @@ def salt_and_hash(request, duration='day'):
 
 _geoip = None
 
+# Readers load several pages in a row, so most hits repeat an IP or user agent seen moments ago
+country_cache = LRUCache(maxsize=50000)
+user_agent_cache = LRUCache(maxsize=5000)
+
 
 def get_country(user_ip):
     # user_ip = '45.222.31.178'
+    country = country_cache.get(user_ip)
+    if country is None:
+        country = lookup_country(user_ip)
+        country_cache.set(user_ip, country)
+    return country
+
+
+def lookup_country(user_ip):
     global _geoip
     try:
         if _geoip is None:
-            _geoip = GeoIP2()
+            _geoip = GeoIP2(cache=settings.GEOIP_CACHE)
         country = _geoip.country(user_ip)
 
         return country
@@ -108,6 +121,18 @@ def get_country(user_ip):
         return {}
 
 
+def parse_user_agent(user_agent):
+    # (device, browser) as analytics records them
+    parsed = user_agent_cache.get(user_agent)
+    if parsed is None:
+        detected = httpagentparser.detect(user_agent)
+        parsed = (detected.get('platform', {}).get('name', ''), detected.get('browser', {}).get('name', ''))
+        # Don't let junk headers push out the real ones
+        if len(user_agent) <= 512:
+            user_agent_cache.set(user_agent, parsed)
+    return parsed
+
+
 def unmark(content):
     content = re.sub(r'^\s{0,3}#{1,6}\s+(.*)$', r'\1', content, flags=re.MULTILINE)
     content = re.sub(r'^\s{0,3}[-*]{3,}\s*$', '', content, flags=re.MULTILINE)
@@ -142,25 +167,17 @@ def valid_xml_char_ordinal(c):
     )
 
 
-class EmailThread(threading.Thread):
-    def __init__(self, subject, html_message, from_email, recipient_list, reply_to=None):
-        self.subject = subject
-        self.html_message = html_message
-        self.from_email = from_email
-        self.recipient_list = recipient_list
-        self.reply_to = reply_to
-        threading.Thread.__init__(self)
-    
-    def run(self):
-        email = EmailMultiAlternatives(
-            subject=self.subject,
-            body=self.html_message,
-            from_email=self.from_email,
-            to=self.recipient_list,
-            reply_to=self.reply_to if self.reply_to else None,
-        )
-        email.attach_alternative(self.html_message, "text/html")
-        email.send(fail_silently=True)
+def send_mail(subject, html_message, from_email, recipient_list, reply_to=None):
+    email = EmailMultiAlternatives(
+        subject=subject,
+        body=html_message,
+        from_email=from_email,
+        to=recipient_list,
+        reply_to=reply_to if reply_to else None,
+    )
+    email.attach_alternative(html_message, "text/html")
+    # Raises so the task queue can retry
+    email.send()
 
 
 # Important! All members of the recipient list will see the other recipients in the 'To' field
@@ -169,62 +186,29 @@ def send_async_mail(subject, html_message, from_email, recipient_list, reply_to=
         print(f'[DEV] Would send email to {recipient_list}: {subject}')
         return
     print('Sent email to ', recipient_list)
-    EmailThread(subject, html_message, from_email, recipient_list, reply_to).start()
-
-
-_random_post_cache = {'url': '', 'expires': 0}
-_random_blog_cache = {'url': '', 'expires': 0}
-
-
-def _random_by_id(queryset, model):
-    agg = model.objects.aggregate(max_id=Max('id'), min_id=Min('id'))
-    if not agg['max_id']:
-        return None
-    for _ in range(10):
-        rand_id = random.randint(agg['min_id'], agg['max_id'])
-        obj = queryset.filter(id__gte=rand_id).first()
-        if obj:
-            return obj
-    return queryset.first()
+    if not executor.submit('email', send_mail, subject, html_message, from_email, recipient_list, reply_to):
+        # The email queue is full, send it now rather than lose it
+        try:
+            send_mail(subject, html_message, from_email, recipient_list, reply_to)
+        except Exception as e:
+            print(f'Failed to send email to {recipient_list}: {e}')
 
 
 def random_post_link():
-    if time() < _random_post_cache['expires'] and _random_post_cache['url']:
-        return _random_post_cache['url']
-    post = _random_by_id(
-        Post.objects.filter(
-            blog__reviewed=True,
-            blog__hidden=False,
-            publish=True,
+    ids = sample_posts(5)
+    urls = {
+        pk: f"{blog_url}/{slug}"
+        for pk, blog_url, slug in DiscoverPost.objects.filter(
+            pk__in=ids,
             published_date__lte=timezone.now(),
-            make_discoverable=True,
             hidden=False,
-            content__isnull=False,
-        ).select_related('blog'),
-        Post,
-    )
-    if not post:
-        return ''
-    url = f"{post.blog.useful_domain}/{post.slug}"
-    _random_post_cache['url'] = url
-    _random_post_cache['expires'] = time() + 60
-    return url
+            blog_hidden=False,
+        ).values_list('pk', 'blog_url', 'slug')
+    }
+    return next((urls[pk] for pk in ids if pk in urls), '')
 
 
 def random_blog_link():
-    if time() < _random_blog_cache['expires'] and _random_blog_cache['url']:
-        return _random_blog_cache['url']
-    blog = _random_by_id(
-        Blog.objects.filter(
-            reviewed=True,
-            hidden=False,
-            user__is_active=True,
-        ),
-        Blog,
-    )
-    if not blog:
-        return ''
-    url = blog.useful_domain
-    _random_blog_cache['url'] = url
-    _random_blog_cache['expires'] = time() + 60
-    return url
+    ids = sample_blogs(5)
+    blogs = Blog.objects.filter(reviewed=True, hidden=False, user__is_active=True).in_bulk(ids)
+    return next((blogs[pk].useful_domain for pk in ids if pk in blogs), '')
@@ -0,0 +1,278 @@
+from django.conf import settings
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from blogs.models import Blog, Hit, OnSiteCounter, Post, VisitorSketch
+from blogs.utils.hll import HyperLogLog
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+from functools import reduce
+import atexit
+import operator
+import queue
+import threading
+import time
+
+
+class HitQueue:
+    """Bounded in-process buffer for analytics hits.
+
+    The hit endpoint only enqueues, a background thread resolves blogs/posts and writes
+    batches with bulk_create. Duplicates are dropped by the hit_unique_visit constraint.
+    When the queue is full hits are dropped (and counted) instead of holding up requests.
+    """
+
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=2, background=None):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._background = background
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.high_water = 0
+
+        self._worker = None
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    @property
+    def background(self):
+        # Follows the BACKGROUND_TASKS setting unless set, so local hits (and tests) show up immediately
+        if self._background is None:
+            return settings.BACKGROUND_TASKS
+        return self._background
+
+    def put(self, hit):
+        try:
+            self.queue.put_nowait(hit)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.enqueued += 1
+        self.high_water = max(self.high_water, self.queue.qsize())
+
+        if self.background:
+            self.start()
+        else:
+            self.flush()
+        return True
+
+    def start(self):
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='hit-queue', daemon=True)
+                self._worker.start()
+                # Write whatever is still queued when the worker process shuts down
+                atexit.register(self.stop)
+
+    def stop(self):
+        self._stopping.set()
+        if self._worker is not None:
+            self._worker.join(self.flush_interval + 1)
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                # The worker thread has its own connection, keep it healthy like a request would
+                close_old_connections()
+                try:
+                    self._write(batch)
+                finally:
+                    close_old_connections()
+        # Don't leave the connection open behind the process
+        connections.close_all()
+
+    def _take_batch(self):
+        # Wait up to flush_interval to fill a batch
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        with self._write_lock:
+            try:
+                subdomains = {hit['blog'] for hit in batch}
+                blog_ids = dict(Blog.objects.filter(subdomain__in=subdomains).values_list('subdomain', 'pk'))
+
+                uids = {hit['post'] for hit in batch if hit['post']}
+                post_ids = dict(Post.objects.filter(uid__in=uids).values_list('uid', 'pk')) if uids else {}
+
+                hits = [
+                    Hit(
+                        blog_id=blog_ids[hit['blog']],
+                        post_id=post_ids.get(hit['post']),
+                        hash_id=hit['hash_id'],
+                        referrer=hit['referrer'],
+                        country=hit['country'],
+                        device=hit['device'],
+                        browser=hit['browser'],
+                    )
+                    for hit in batch if hit['blog'] in blog_ids
+                ]
+                hits = new_visits(hits)
+                # Duplicates from another worker in the meantime are still ignored by the constraint
+                Hit.objects.bulk_create(hits, ignore_conflicts=True)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f'Hits: Failed to write batch of {len(batch)}: {e}')
+            else:
+                # Only new visits count towards visitors and "Reading now", like the deduped rows did
+                self.written += len(hits)
+                self.batches += 1
+                try:
+                    update_visitor_sketches(hits)
+                except Exception as e:
+                    print(f'Hits: Failed to update visitor sketches: {e}')
+                try:
+                    count_on_site(hits)
+                except Exception as e:
+                    print(f'Hits: Failed to update on site counters: {e}')
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'maxsize': self.queue.maxsize,
+            'high_water': self.high_water,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+
+def visit_key(hit):
+    # The fields of the hit_unique_visit constraint
+    return (hit.blog_id, hit.hash_id, hit.post_id, hit.referrer, hit.country, hit.device, hit.browser)
+
+
+def new_visits(hits):
+    # Drops hits that repeat one in the batch or one already stored, so they aren't counted
+    if not hits:
+        return hits
+    # hash_ids change daily and are scrubbed after a day, older rows can't match
+    since = timezone.now() - timedelta(days=2)
+    seen = set(
+        Hit.objects.filter(
+            blog_id__in={hit.blog_id for hit in hits},
+            hash_id__in={hit.hash_id for hit in hits},
+            created_date__gte=since,
+        ).values_list('blog_id', 'hash_id', 'post_id', 'referrer', 'country', 'device', 'browser')
+    )
+    new = []
+    for hit in hits:
+        # Scrubbed rows are exempt from the constraint
+        if hit.hash_id != 'scrubbed':
+            key = visit_key(hit)
+            if key in seen:
+                continue
+            seen.add(key)
+        new.append(hit)
+    return new
+
+
+def sketch_keys(post_id, referrer):
+    # Every (scope, key) a visit counts towards, analytics merges whichever matches its filters
+    post = str(post_id) if post_id else 'homepage'
+    keys = [('blog', ''), ('post', post)]
+    if referrer:
+        keys.append(('referrer', referrer[:255]))
+        keys.append(('post_referrer', f'{post}|{referrer}'[:255]))
+    return keys
+
+
+def update_visitor_sketches(hits):
+    day = timezone.now().date()
+    sketches = defaultdict(HyperLogLog)
+    for hit in hits:
+        for scope, key in sketch_keys(hit.post_id, hit.referrer):
+            sketches[(hit.blog_id, scope, key)].add(hit.hash_id)
+    if not sketches:
+        return
+
+    with transaction.atomic():
+        VisitorSketch.objects.bulk_create([
+            VisitorSketch(blog_id=blog_id, date=day, scope=scope, key=key, registers=HyperLogLog().to_bytes())
+            for blog_id, scope, key in sketches
+        ], ignore_conflicts=True)
+
+        # Other workers merge into the same rows, lock them in a fixed order
+        rows = list(VisitorSketch.objects.select_for_update().filter(
+            reduce(operator.or_, (Q(blog_id=blog_id, scope=scope, key=key) for blog_id, scope, key in sketches)),
+            date=day,
+        ).order_by('blog_id', 'scope', 'key'))
+        for row in rows:
+            sketch = HyperLogLog.from_bytes(row.registers).merge(sketches[(row.blog_id, row.scope, row.key)])
+            row.registers = sketch.to_bytes()
+        VisitorSketch.objects.bulk_update(rows, ['registers'], batch_size=500)
+
+
+# "Reading now" covers the current minute and the ones before it
+ON_SITE_MINUTES = 4
+
+
+def count_on_site(hits):
+    minute = int(time.time() // 60)
+    counts = sorted(Counter(hit.blog_id for hit in hits).items())
+    if not counts:
+        return
+
+    # A bucket from an older minute starts over, a late batch for a minute that's gone is dropped
+    table = OnSiteCounter._meta.db_table
+    params = []
+    for blog_id, count in counts:
+        params += [blog_id, minute % (ON_SITE_MINUTES + 1), minute, count]
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {table} (blog_id, slot, minute, hits)
+            VALUES {', '.join(['(%s, %s, %s, %s)'] * len(counts))}
+            ON CONFLICT (blog_id, slot) DO UPDATE SET
+                hits = CASE
+                    WHEN {table}.minute = excluded.minute THEN {table}.hits + excluded.hits
+                    WHEN {table}.minute < excluded.minute THEN excluded.hits
+                    ELSE {table}.hits
+                END,
+                minute = CASE WHEN {table}.minute < excluded.minute THEN excluded.minute ELSE {table}.minute END
+        """, params)
+
+
+def on_site_now(blog_id):
+    minute = int(time.time() // 60)
+    return OnSiteCounter.objects.filter(
+        blog_id=blog_id, minute__gt=minute - ON_SITE_MINUTES
+    ).aggregate(hits=Sum('hits'))['hits'] or 0
+
+
+hit_queue = HitQueue()
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+
+from time import perf_counter
+
+from blogs.models import Post
+from blogs.templatetags.custom_tags import render_markup
+
+
+PROSE = (
+    "I've been thinking about slow software lately. Not slow as in *performance*, "
+    "but slow as in **deliberate**. The kind you sit with for a while (c) before it makes sense.\n\n"
+)
+
+# Rough shapes of what people actually post
+CORPUS = {
+    'prose': "# A quiet post\n\n" + PROSE * 40,
+    'links': PROSE * 10 + "\n".join(
+        f"- [Link {i}](https://en.wikipedia.org/wiki/Bear_(disambiguation_{i})) and [tab](tab:https://example.com/{i})"
+        for i in range(40)
+    ),
+    'code': PROSE * 5 + "\n\n".join(
+        f"Step {i} uses `inline_{i}()`:\n\n```python\ndef step_{i}(x):\n    return x * {i}\n```"
+        for i in range(20)
+    ),
+    'math': PROSE * 5 + "\n\n".join(
+        f"Where $x_{i} = \\alpha + {i}$ and $$\\beta_{i}$$ holds, costing $5 to $10.\n\n$$\n\\sum_{{n=0}}^{{{i}}} n^2\n$$"
+        for i in range(20)
+    ),
+    'html': PROSE * 10 + "\n\n".join(
+        f'<div class="box" onclick="alert({i})"><iframe src="https://www.youtube.com/embed/{i}"></iframe></div>\n\n<script>console.log({i})</script>'
+        for i in range(10)
+    ),
+    'directives': "{{ blog_title }}\n\n" + PROSE * 10 + "\n\n{{ posts limit:5 }}\n\n{{ previous_post }} {{ next_post }}",
+}
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark for the markdown rendering pipeline (bypasses the render cache)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Renders per document')
+        parser.add_argument('--posts', type=int, default=0, help='Also benchmark the N most recent real posts')
+
+    def handle(self, *args, **kwargs):
+        iterations = kwargs['iterations']
+        corpus = dict(CORPUS)
+
+        if kwargs['posts']:
+            for post in Post.objects.filter(publish=True).order_by('-id').only('id', 'content')[:kwargs['posts']]:
+                corpus[f'post {post.id}'] = post.content
+
+        total = 0
+        for name, content in corpus.items():
+            for upgraded in (False, True):
+                start = perf_counter()
+                for _ in range(iterations):
+                    render_markup(content, upgraded)
+                elapsed = perf_counter() - start
+                total += elapsed
+                self.stdout.write(f'{name:<16} upgraded={upgraded!s:<5} {len(content):>7} chars  {elapsed / iterations * 1000:8.3f} ms/render')
+
+        self.stdout.write(self.style.SUCCESS(f'Total: {total:.3f}s for {len(corpus) * 2 * iterations} renders'))
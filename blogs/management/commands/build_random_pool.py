@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from time import perf_counter
+from blogs.random_pool import build_random_pool
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the pools of discoverable post and blog ids that random picks sample from'
+
+    def handle(self, *args, **kwargs):
+        began = perf_counter()
+        pool = build_random_pool()
+        elapsed = perf_counter() - began
+
+        posts = pool['posts']
+        self.stdout.write(self.style.SUCCESS(
+            f"Pooled {len(posts[''])} posts in {len(posts) - 1} languages and {len(pool['blogs'])} blogs in {elapsed:.1f}s"
+        ))
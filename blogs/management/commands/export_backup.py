@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+from blogs.backup import load_backup
+from blogs.utils.csv import iter_csv
+
+
+class Command(BaseCommand):
+    help = 'Writes a blog backup out as blog.csv and posts.csv, the files backups were made of before they went incremental'
+
+    def add_arguments(self, parser):
+        parser.add_argument('subdomain')
+        parser.add_argument('--date', help='Day of the backup (YYYY-MM-DD), only days something changed have one. Defaults to the latest')
+        parser.add_argument('--output', default='.', help='Directory to write the CSV files to')
+
+    def handle(self, *args, **kwargs):
+        blog, posts = load_backup(kwargs['subdomain'], kwargs['date'])
+        if blog is None:
+            on_date = f" on {kwargs['date']}" if kwargs['date'] else ''
+            raise CommandError(f"No backup of {kwargs['subdomain']}{on_date}")
+
+        os.makedirs(kwargs['output'], exist_ok=True)
+        for name, rows in (('blog.csv', [blog]), ('posts.csv', posts)):
+            with open(os.path.join(kwargs['output'], name), 'w', newline='', encoding='utf-8') as f:
+                f.writelines(iter_csv(rows))
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote blog.csv and posts.csv ({len(posts)} posts) to {kwargs['output']}"))
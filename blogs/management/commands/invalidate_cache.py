@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
+from blogs.cloudflare import purge
 from blogs.models import Post
 
 class Command(BaseCommand):
@@ -9,7 +10,7 @@ class Command(BaseCommand):
     def handle(self, *args, **kwargs):
         # Find posts that just became public in the last 10 minutes (scheduled to run every 10 min).
         # This catches scheduled posts going live so Cloudflare doesn't keep serving stale cached pages.
-        for post in Post.objects.filter(publish=True, published_date__lte=timezone.now(), published_date__gte=timezone.now() - timedelta(minutes=10)):
-            post.blog._purge_cloudflare_cache()
-            self.stdout.write(self.style.SUCCESS(f'Successfully invalidated Cloudflare cache for {post.blog.subdomain}'))
-        self.stdout.write(self.style.SUCCESS(f'All invalidations done'))
\ No newline at end of file
+        subdomains = set(Post.objects.filter(publish=True, published_date__lte=timezone.now(), published_date__gte=timezone.now() - timedelta(minutes=10)).values_list('blog__subdomain', flat=True))
+        purge(subdomains)
+        self.stdout.write(self.style.SUCCESS(f'Invalidated Cloudflare cache for {len(subdomains)} blogs'))
+        self.stdout.write(self.style.SUCCESS(f'All invalidations done'))
@@ -0,0 +1,217 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+import re
+
+from blogs.models import PersistentStore
+
+
+TABLE = 'blogs_hit'
+LEGACY_TABLE = 'blogs_hit_legacy'
+SEQUENCE = 'blogs_hit_partitioned_id_seq'
+BOUND_CHECK = 'blogs_hit_legacy_bound'
+
+# Once the bound is checked, hits from next month can't be written until the table is attached
+CONVERT_MARGIN = timedelta(days=2)
+
+# Same rule as Hit.Meta's hit_unique_visit. A partitioned parent can't hold a unique index
+# without the partition key, so each partition carries its own copy.
+UNIQUE_VISIT = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS "{partition}_unique_visit" ON "{partition}" '
+    '(blog_id, hash_id, post_id, referrer, country, device, browser) NULLS NOT DISTINCT '
+    "WHERE hash_id <> 'scrubbed'"
+)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(start, months):
+    month = start.month - 1 + months
+    return start.replace(year=start.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(start):
+    return f'{TABLE}_y{start.year}m{start.month:02d}'
+
+
+def parse_bound(value):
+    # Postgres renders bounds like '2026-11-01 00:00:00+00'
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'")).astimezone(dt_timezone.utc)
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def get_partitions(cursor):
+    # [(name, start, end)], start is None for the legacy partition
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, [TABLE])
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+        partitions.append((name, parse_bound(match.group(1)), parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+def create_partition(cursor, start):
+    name = partition_name(start)
+    cursor.execute(
+        f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE}" FOR VALUES FROM (%s) TO (%s)',
+        [start, add_months(start, 1)],
+    )
+    cursor.execute(UNIQUE_VISIT.format(partition=name))
+    return name
+
+
+def prepare(cursor, boundary):
+    """The slow part of convert, done while hits are still read and written.
+
+    A validated CHECK constraint proves every row falls before boundary, so attaching doesn't
+    scan the table, and the index the legacy partition's primary key needs is built concurrently.
+    """
+    # Concurrent builds can't run in a transaction, which only happens under tests
+    concurrently = '' if connection.in_atomic_block else 'CONCURRENTLY '
+    # DDL can't run with deferred foreign key checks pending in the same transaction
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    # Left behind by an attempt that didn't finish, a failed concurrent build leaves an invalid index
+    cursor.execute(f'ALTER TABLE "{TABLE}" DROP CONSTRAINT IF EXISTS "{BOUND_CHECK}"')
+    cursor.execute(f'DROP INDEX {concurrently}IF EXISTS "{LEGACY_TABLE}_pkey"')
+
+    cursor.execute(
+        f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{BOUND_CHECK}" CHECK (created_date IS NOT NULL AND created_date < %s) NOT VALID',
+        [boundary],
+    )
+    cursor.execute(f'ALTER TABLE "{TABLE}" VALIDATE CONSTRAINT "{BOUND_CHECK}"')
+    cursor.execute(f'CREATE UNIQUE INDEX {concurrently}"{LEGACY_TABLE}_pkey" ON "{TABLE}" (id, created_date)')
+
+
+@transaction.atomic
+def convert(cursor, boundary):
+    """Turns blogs_hit into a partitioned table without copying rows.
+
+    The existing table is attached as the first partition covering everything before
+    boundary, its indexes and foreign keys are reused. Run prepare first, then the exclusive
+    lock on hits is only held for catalog changes.
+    """
+    # DDL can't run with deferred foreign key checks pending in the same transaction
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+    cursor.execute("""
+        SELECT i.relname, pg_get_indexdef(i.oid), x.indisunique
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass
+    """, [TABLE])
+    indexes = cursor.fetchall()
+    cursor.execute("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+    """, [TABLE])
+    foreign_keys = cursor.fetchall()
+
+    cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{LEGACY_TABLE}"')
+
+    # The parent takes over the index names Django knows about
+    parent_indexes = []
+    for name, definition, unique in indexes:
+        if unique:
+            continue
+        cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name[:56]}_legacy"')
+        parent_indexes.append(definition)
+
+    cursor.execute(f'CREATE TABLE "{TABLE}" (LIKE "{LEGACY_TABLE}" INCLUDING DEFAULTS) PARTITION BY RANGE (created_date)')
+
+    # The legacy id may be an identity column, give the parent its own sequence carrying on from it
+    cursor.execute(f'CREATE SEQUENCE "{SEQUENCE}" OWNED BY "{TABLE}".id')
+    cursor.execute(f'SELECT setval(%s, COALESCE((SELECT MAX(id) FROM "{LEGACY_TABLE}"), 0) + 1, false)', [SEQUENCE])
+    cursor.execute(f'ALTER TABLE "{TABLE}" ALTER COLUMN id SET DEFAULT nextval(%s)', [SEQUENCE])
+    cursor.execute(f'ALTER TABLE "{TABLE}" ALTER COLUMN id SET NOT NULL, ALTER COLUMN created_date SET NOT NULL')
+    cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{TABLE}_partitioned_pkey" PRIMARY KEY (id, created_date)')
+
+    for definition in parent_indexes:
+        cursor.execute(definition)
+    for name, definition in foreign_keys:
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+
+    # The legacy table's primary key has to match the parent's before it can be attached
+    cursor.execute(
+        f'ALTER TABLE "{LEGACY_TABLE}" DROP CONSTRAINT "{TABLE}_pkey", '
+        f'ADD CONSTRAINT "{LEGACY_TABLE}_pkey" PRIMARY KEY USING INDEX "{LEGACY_TABLE}_pkey"'
+    )
+    # The bound check stands in for the validation scan, the partition bound replaces it after
+    cursor.execute(
+        f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{LEGACY_TABLE}" FOR VALUES FROM (MINVALUE) TO (%s)',
+        [boundary],
+    )
+    cursor.execute(f'ALTER TABLE "{LEGACY_TABLE}" DROP CONSTRAINT "{BOUND_CHECK}"')
+
+
+class Command(BaseCommand):
+    help = 'Keeps Hit partitioned by month: creates upcoming partitions and detaches rolled up ones past retention. Postgres only.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true', help='One-off: turn blogs_hit into a partitioned table (locks hits briefly at the end)')
+        parser.add_argument('--ahead', type=int, default=3, help='Months of partitions to keep ready')
+        parser.add_argument('--retain-months', type=int, default=None, help='Detach partitions that ended more than N months ago')
+        parser.add_argument('--drop', action='store_true', help='Drop detached partitions instead of keeping them as archive tables')
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor != 'postgresql':
+            self.stdout.write('Hit partitioning needs Postgres, skipping')
+            return
+
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            if not is_partitioned(cursor):
+                if not kwargs['convert']:
+                    raise CommandError(f'{TABLE} is not partitioned yet, run with --convert once first')
+                boundary = add_months(month_start(now), 1)
+                if boundary - now < CONVERT_MARGIN:
+                    raise CommandError(f'Too close to {boundary:%B}, run --convert earlier in the month')
+                prepare(cursor, boundary)
+                convert(cursor, boundary)
+                self.stdout.write(f'Converted {TABLE}, existing rows now live in {LEGACY_TABLE}')
+
+            partitions = get_partitions(cursor)
+
+            # New partitions pick up where the last one ends, ranges can't overlap
+            start = partitions[-1][2] if partitions else month_start(now)
+            last = add_months(month_start(now), kwargs['ahead'])
+            while start <= last:
+                self.stdout.write(f'Created {create_partition(cursor, start)}')
+                start = add_months(start, 1)
+
+            if kwargs['retain_months'] is not None:
+                self.detach(cursor, partitions, add_months(month_start(now), -kwargs['retain_months']), kwargs['drop'])
+
+        self.stdout.write(self.style.SUCCESS('Hit partitions are up to date'))
+
+    def detach(self, cursor, partitions, cutoff, drop):
+        # Old days are only readable through the rollups, so never detach hits that aren't rolled up yet
+        rolled_up_to = PersistentStore.load().hits_rolled_up_to
+        if rolled_up_to is None:
+            self.stdout.write('Hits have not been rolled up yet, not detaching anything')
+            return
+        rolled_up_until = datetime.combine(rolled_up_to + timedelta(days=1), datetime.min.time(), tzinfo=dt_timezone.utc)
+
+        for name, start, end in partitions:
+            if end > cutoff or end > rolled_up_until:
+                continue
+            cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+            if drop:
+                cursor.execute(f'DROP TABLE "{name}"')
+                self.stdout.write(f'Dropped {name}')
+            else:
+                self.stdout.write(f'Detached {name}, kept as an archive table')
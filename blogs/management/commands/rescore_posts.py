@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from datetime import timedelta
+from time import perf_counter
+from blogs.models import Post, Upvote
+from blogs.scoring import BUOYANCY, UPVOTE_CAP, discover_rank, rescore
+
+
+class Command(BaseCommand):
+    help = 'Recounts upvotes and recomputes discover scores for posts upvoted recently, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since-hours', type=float, default=48, help='Rescore posts upvoted in the last this many hours')
+        parser.add_argument('--all', action='store_true', help='Rescore every post that has been upvoted')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Posts per bulk update')
+        parser.add_argument('--buoyancy', type=float, default=BUOYANCY, help='Days for a post to sink one order of magnitude of upvotes')
+        parser.add_argument('--cap', type=int, default=UPVOTE_CAP, help='Upvotes counted towards the score')
+        parser.add_argument('--dry-run', action='store_true', help="Report how rankings would move without writing")
+        parser.add_argument('--report', type=int, default=20, help='Top movers listed on a dry run')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['all']:
+            post_ids = Post.objects.filter(upvotes__gt=0).values_list('id', flat=True)
+        else:
+            since = timezone.now() - timedelta(hours=kwargs['since_hours'])
+            post_ids = Upvote.objects.filter(created_date__gte=since).values_list('post_id', flat=True).distinct()
+        post_ids = sorted(set(post_ids))
+
+        began = perf_counter()
+        changes = rescore(
+            post_ids,
+            buoyancy=kwargs['buoyancy'],
+            cap=kwargs['cap'],
+            batch_size=kwargs['batch_size'],
+            dry_run=kwargs['dry_run'],
+        )
+        elapsed = perf_counter() - began
+
+        if kwargs['dry_run']:
+            movers = sorted(changes, key=lambda change: abs(change['score'] - change['old_score']), reverse=True)
+            for change in movers[:kwargs['report']]:
+                old_rank = discover_rank(change['old_score'])
+                new_rank = discover_rank(change['score'], exclude=change['id'])
+                self.stdout.write(
+                    f"{change['id']}: {change['title'][:60]} | upvotes {change['old_upvotes']} -> {change['upvotes']} | "
+                    f"score {change['old_score']:.3f} -> {change['score']:.3f} | rank {old_rank} -> {new_rank}"
+                )
+
+        action = 'Would update' if kwargs['dry_run'] else 'Updated'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {len(changes)} of {len(post_ids)} posts in {elapsed:.1f}s'
+        ))
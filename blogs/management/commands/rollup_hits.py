@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from blogs.models import Hit, HitRollup, PersistentStore, VisitorRollup
+
+
+def day_bounds(day):
+    start = datetime.combine(day, datetime.min.time(), tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+@transaction.atomic
+def rollup_day(day):
+    start, end = day_bounds(day)
+    hits = Hit.objects.filter(created_date__gte=start, created_date__lt=end, blog__isnull=False)
+
+    # Rebuilding a day replaces it
+    HitRollup.objects.filter(date=day).delete()
+    VisitorRollup.objects.filter(date=day).delete()
+
+    rows = hits.values('blog_id', 'post_id', 'referrer', 'country', 'device', 'browser').annotate(
+        hit_count=Count('id'),
+        visitor_count=Count('hash_id', distinct=True),
+    ).order_by()
+    HitRollup.objects.bulk_create((
+        HitRollup(
+            date=day,
+            blog_id=row['blog_id'],
+            post_id=row['post_id'],
+            referrer=row['referrer'],
+            country=row['country'],
+            device=row['device'],
+            browser=row['browser'],
+            hits=row['hit_count'],
+            visitors=row['visitor_count'],
+        ) for row in rows.iterator(chunk_size=5000)
+    ), batch_size=5000)
+
+    visitors = hits.values('blog_id').annotate(visitor_count=Count('hash_id', distinct=True)).order_by()
+    VisitorRollup.objects.bulk_create((
+        VisitorRollup(date=day, blog_id=row['blog_id'], visitors=row['visitor_count'])
+        for row in visitors.iterator(chunk_size=5000)
+    ), batch_size=5000)
+
+
+class Command(BaseCommand):
+    help = 'Rolls up raw hits into daily HitRollup/VisitorRollup rows for closed (UTC) days. Must run before scrub_hash_ids.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(), help='Rebuild from this date (YYYY-MM-DD)')
+
+    def handle(self, *args, **kwargs):
+        persistent_store = PersistentStore.load()
+        yesterday = timezone.now().date() - timedelta(days=1)
+
+        day = kwargs['since']
+        if day is None and persistent_store.hits_rolled_up_to:
+            day = persistent_store.hits_rolled_up_to + timedelta(days=1)
+        if day is None:
+            first_hit = Hit.objects.aggregate(first=Min('created_date'))['first']
+            day = first_hit.astimezone(dt_timezone.utc).date() if first_hit else yesterday + timedelta(days=1)
+
+        days = 0
+        while day <= yesterday:
+            rollup_day(day)
+            persistent_store.hits_rolled_up_to = day
+            persistent_store.save(update_fields=['hits_rolled_up_to'])
+            day += timedelta(days=1)
+            days += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {days} day(s) of hits, up to {persistent_store.hits_rolled_up_to}'))
@@ -1,13 +1,68 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
 from django.utils import timezone
 from datetime import timedelta
-from blogs.models import Hit
+from time import perf_counter, sleep
+from blogs.models import Hit, PersistentStore
 
 
 class Command(BaseCommand):
-    help = 'Scrubs hash_ids from hits older than 24 hours'
+    help = 'Scrubs hash_ids from hits older than 24 hours, in id batches from where the last run stopped'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Ignore the watermark and scrub all of history')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Hit ids per update')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
 
     def handle(self, *args, **kwargs):
+        # Unique visitors are counted from hash_ids, roll up closed days before they're scrubbed
+        call_command('rollup_hits', stdout=self.stdout)
+
+        persistent_store = PersistentStore.load()
         time_24_hours_ago = timezone.now() - timedelta(hours=24)
-        Hit.objects.filter(created_date__lt=time_24_hours_ago).exclude(hash_id='scrubbed').update(hash_id='scrubbed')
-        self.stdout.write(self.style.SUCCESS('Scrubbed hash_ids'))
+
+        start = persistent_store.hits_scrubbed_to_id
+        if kwargs['all']:
+            start = 0
+        elif start is None:
+            # First run: older months were scrubbed by the unbounded job this replaces
+            since = (time_24_hours_ago - timedelta(days=7)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            first = Hit.objects.filter(created_date__gte=since).aggregate(first=Min('id'))['first']
+            start = first - 1 if first else Hit.objects.aggregate(last=Max('id'))['last'] or 0
+
+        # Hits are partitioned by created_date, not id. Bound every query by the month of the
+        # first unscrubbed hit too (a week of slack for ids out of date order) so Postgres prunes it
+        first = Hit.objects.filter(id__gt=start).order_by('id').values_list('created_date', flat=True).first()
+        if first is None:
+            first = time_24_hours_ago
+        since = (first - timedelta(days=7)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        hits = Hit.objects.filter(created_date__gte=since)
+
+        # Every id below the first hit that's too recent is old enough to scrub
+        stop = hits.filter(id__gt=start, created_date__gte=time_24_hours_ago).aggregate(stop=Min('id'))['stop']
+        if stop is None:
+            stop = (hits.filter(id__gt=start).aggregate(last=Max('id'))['last'] or start) + 1
+
+        scrubbed = 0
+        began = perf_counter()
+        while start < stop - 1:
+            end = min(start + kwargs['batch_size'], stop - 1)
+            # Each batch commits on its own, the hit writer only ever waits on one batch of row locks
+            scrubbed += hits.filter(
+                id__gt=start, id__lte=end, created_date__lt=time_24_hours_ago,
+            ).exclude(hash_id='scrubbed').update(hash_id='scrubbed')
+            start = end
+            persistent_store.hits_scrubbed_to_id = start
+            persistent_store.save(update_fields=['hits_scrubbed_to_id'])
+            if kwargs['pause']:
+                sleep(kwargs['pause'])
+
+        if persistent_store.hits_scrubbed_to_id != start:
+            persistent_store.hits_scrubbed_to_id = start
+            persistent_store.save(update_fields=['hits_scrubbed_to_id'])
+
+        elapsed = perf_counter() - began
+        self.stdout.write(self.style.SUCCESS(
+            f'Scrubbed {scrubbed} hash_ids in {elapsed:.1f}s ({scrubbed / elapsed if elapsed else 0:.0f} rows/s), up to hit {start}'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from blogs.models import Blog, DiscoverPost
+from blogs.views.discover import bump_discover_generation, eligible_posts, sync_discover_blog
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the discover feed table from posts and blogs'
+
+    def handle(self, *args, **kwargs):
+        # Entries whose post or blog stopped being eligible without a save noticing
+        deleted, _ = DiscoverPost.objects.exclude(post__in=eligible_posts()).delete()
+
+        blogs = Blog.objects.filter(reviewed=True, user__is_active=True, posts_in_last_12_hours__lte=3)
+        count = changed = 0
+        for blog in blogs.only('id', 'user_id', 'subdomain', 'domain', 'lang', 'hidden').iterator(chunk_size=500):
+            changed += sync_discover_blog(blog, full=True)
+            count += 1
+
+        # Once for the whole run, not per blog
+        if deleted or changed:
+            bump_discover_generation()
+
+        self.stdout.write(self.style.SUCCESS(f'Synced {count} blogs, removed {deleted} stale entries, {DiscoverPost.objects.count()} posts are discoverable'))
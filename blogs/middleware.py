@@ -7,6 +7,8 @@ from collections import defaultdict
 
 from ipaddr import client_ip
 
+from blogs.utils.hosts import request_host
+
 
 # Block auth and admin paths on non-main domains
 class MainSitePathProtectionMiddleware:
@@ -14,10 +16,7 @@ class MainSitePathProtectionMiddleware:
         self.get_response = get_response
 
     def __call__(self, request):
-        host = request.get_host().lower()
-        main_domains = set(os.getenv('MAIN_SITE_HOSTS', '').split(','))
-
-        if host not in main_domains and request.path.startswith(('/accounts/', '/mothership/')):
+        if not request_host(request).is_main_site and request.path.startswith(('/accounts/', '/mothership/')):
             return JsonResponse({"error": "Bad Request"}, status=400)
 
         return self.get_response(request)
@@ -30,10 +29,8 @@ class ConditionalXFrameOptionsMiddleware:
 
     def __call__(self, request):
         response = self.get_response(request)
-        host = request.get_host().lower()
-        main_domains = set(os.getenv('MAIN_SITE_HOSTS', '').split(','))
 
-        if host in main_domains:
+        if request_host(request).is_main_site:
             response['X-Frame-Options'] = 'DENY'
 
         return response
@@ -0,0 +1,38 @@
+# Generated by Django 6.0.6 on 2026-10-18 18:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0069_feedentry'),
+    ]
+
+    operations = [
+        # get_or_create races left some duplicate visits behind, drop them so the constraint can be built
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM blogs_hit WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (
+                            PARTITION BY blog_id, hash_id, post_id, referrer, country, device, browser
+                            ORDER BY id
+                        ) AS row_number
+                        FROM blogs_hit
+                        WHERE hash_id <> 'scrubbed'
+                    ) duplicates
+                    WHERE row_number > 1
+                );
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RemoveIndex(
+            model_name='hit',
+            name='hit_blog_hash_post',
+        ),
+        migrations.AddConstraint(
+            model_name='hit',
+            constraint=models.UniqueConstraint(condition=models.Q(('hash_id', 'scrubbed'), _negated=True), fields=('blog', 'hash_id', 'post', 'referrer', 'country', 'device', 'browser'), name='hit_unique_visit', nulls_distinct=False),
+        ),
+    ]
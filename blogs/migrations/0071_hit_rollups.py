@@ -0,0 +1,54 @@
+# Generated by Django 6.0.6 on 2026-10-18 18:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0070_hit_unique_visit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='persistentstore',
+            name='hits_rolled_up_to',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='HitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('referrer', models.URLField(blank=True, default=None, null=True)),
+                ('country', models.CharField(blank=True, max_length=200, null=True)),
+                ('device', models.CharField(blank=True, max_length=200, null=True)),
+                ('browser', models.CharField(blank=True, max_length=200, null=True)),
+                ('hits', models.IntegerField(default=0)),
+                ('visitors', models.IntegerField(default=0)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blogs.blog')),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='blogs.post')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['blog', 'date'], name='hitrollup_blog_date')],
+            },
+        ),
+        migrations.CreateModel(
+            name='VisitorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('visitors', models.IntegerField(default=0)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blogs.blog')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('blog', 'date'), name='visitorrollup_blog_date')],
+            },
+        ),
+        # The rollup scans all blogs one day at a time, hits are append-only so BRIN stays tiny
+        migrations.RunSQL(
+            sql="CREATE INDEX blogs_hit_created_date_brin ON blogs_hit USING BRIN (created_date);",
+            reverse_sql="DROP INDEX IF EXISTS blogs_hit_created_date_brin;",
+        ),
+    ]
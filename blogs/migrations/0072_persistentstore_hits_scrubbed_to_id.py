@@ -0,0 +1,18 @@
+# Generated by Django 6.0.6 on 2026-10-18 18:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0071_hit_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='persistentstore',
+            name='hits_scrubbed_to_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0.6 on 2026-10-18 18:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0072_persistentstore_hits_scrubbed_to_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('scope', models.CharField(choices=[('blog', 'Blog'), ('post', 'Post'), ('referrer', 'Referrer'), ('post_referrer', 'Post and referrer')], max_length=20)),
+                ('key', models.CharField(blank=True, default='', max_length=255)),
+                ('registers', models.BinaryField()),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blogs.blog')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('blog', 'scope', 'key', 'date'), name='visitorsketch_unique')],
+            },
+        ),
+    ]
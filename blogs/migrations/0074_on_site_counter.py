@@ -0,0 +1,27 @@
+# Generated by Django 6.0.6 on 2026-10-18 18:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0073_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OnSiteCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.SmallIntegerField()),
+                ('minute', models.IntegerField()),
+                ('hits', models.IntegerField(default=0)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='blogs.blog')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('blog', 'slot'), name='onsitecounter_blog_slot')],
+            },
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 6.0.6 on 2026-10-18 19:20
+
+import os
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_discover_posts(apps, schema_editor):
+    # Same rows as sync_discover_posts, in one statement so the feed isn't empty after deploying
+    host = os.getenv('MAIN_SITE_HOSTS', 'bearblog.dev').split(',')[0]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO blogs_discoverpost (
+                post_id, blog_id, user_id, title, slug, published_date, score, upvotes, shadow_votes,
+                lang, hidden, subdomain, blog_url, blog_lang, blog_hidden
+            )
+            SELECT
+                p.id, b.id, b.user_id, p.title, p.slug, p.published_date, p.score, p.upvotes, p.shadow_votes,
+                p.lang, p.hidden, b.subdomain, 'https://' || COALESCE(NULLIF(b.domain, ''), b.subdomain || '.' || %s), b.lang, b.hidden
+            FROM blogs_post p
+            INNER JOIN blogs_blog b ON p.blog_id = b.id
+            INNER JOIN auth_user u ON b.user_id = u.id
+            WHERE p.publish = TRUE
+                AND b.reviewed = TRUE
+                AND u.is_active = TRUE
+                AND p.make_discoverable = TRUE
+                AND b.posts_in_last_12_hours <= 3
+                AND p.content_length >= 150
+        """, [host])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0074_on_site_counter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscoverPost',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='discover_entry', serialize=False, to='blogs.post')),
+                ('title', models.CharField(max_length=200)),
+                ('slug', models.CharField(max_length=200)),
+                ('published_date', models.DateTimeField()),
+                ('score', models.FloatField(default=0)),
+                ('upvotes', models.IntegerField(default=0)),
+                ('shadow_votes', models.IntegerField(default=0)),
+                ('lang', models.CharField(blank=True, max_length=10)),
+                ('hidden', models.BooleanField(default=False)),
+                ('subdomain', models.CharField(max_length=100)),
+                ('blog_url', models.CharField(max_length=200)),
+                ('blog_lang', models.CharField(blank=True, max_length=10)),
+                ('blog_hidden', models.BooleanField(default=False)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='discover_entries', to='blogs.blog')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('blog_hidden', False), ('hidden', False)), fields=['-score'], name='discover_score'), models.Index(condition=models.Q(('blog_hidden', False), ('hidden', False)), fields=['-published_date'], name='discover_newest')],
+            },
+        ),
+        migrations.RunPython(fill_discover_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0.6 on 2026-10-18 19:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogs', '0075_discover_post'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='discoverpost',
+            name='discover_score',
+        ),
+        migrations.RemoveIndex(
+            model_name='discoverpost',
+            name='discover_newest',
+        ),
+        migrations.AddIndex(
+            model_name='discoverpost',
+            index=models.Index(condition=models.Q(('blog_hidden', False), ('hidden', False)), fields=['-score', '-post'], name='discover_score'),
+        ),
+        migrations.AddIndex(
+            model_name='discoverpost',
+            index=models.Index(condition=models.Q(('blog_hidden', False), ('hidden', False)), fields=['-published_date', '-post'], name='discover_newest'),
+        ),
+    ]
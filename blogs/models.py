@@ -1,20 +1,19 @@
 from django.utils import timezone
 from django.db import models, connection
+from django.db.models import F
 from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from blogs.cloudflare import purge_queue
 
 from zoneinfo import ZoneInfo
 import os
 import json
-from math import log
 import random
 import string
 import hashlib
-import requests
-from threading import Thread
 
 
 class UserSettings(models.Model):
@@ -51,6 +50,26 @@ def create_user_settings(sender, instance, **kwargs):
         user_settings.user.blogs.update(reviewed=True)
 
 
+# On User (de)activation, drop their blogs from the host cache
+@receiver(post_save, sender=User)
+def forget_user_blog_hosts(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and 'is_active' not in update_fields):
+        return
+    from blogs.views.blog import forget_blog_hosts
+    for blog in instance.blogs.only('subdomain', 'domain'):
+        forget_blog_hosts(blog)
+
+
+# On User (de)activation, add or drop their posts from the discovery feed
+@receiver(post_save, sender=User)
+def sync_user_discover_posts(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and 'is_active' not in update_fields):
+        return
+    from blogs.views.discover import sync_discover_blog
+    for blog in instance.blogs.all():
+        sync_discover_blog(blog)
+
+
 class Blog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, related_name='blogs')
     title = models.CharField(max_length=200)
@@ -177,49 +196,8 @@ class Blog(models.Model):
         self.all_tags = json.dumps(sorted(all_tags))
 
     def invalidate_cloudflare_cache(self):
-        # Purge in a background thread so the network round-trip doesn't block the save
-        Thread(target=self._purge_cloudflare_cache).start()
-
-    def _purge_cloudflare_cache(self):
-        if os.getenv('ENVIRONMENT') == 'dev':
-            # Don't invalidate on dev
-            return
-
-        cloudflare_api_key = os.getenv('CLOUDFLARE_API_KEY')
-        cloudflare_email = os.getenv('CLOUDFLARE_EMAIL')
-        cloudflare_zone_id = os.getenv('CLOUDFLARE_ZONE_ID')
-        
-        if not all([cloudflare_api_key, cloudflare_email, cloudflare_zone_id]):
-            return
-            
-        headers = {
-            'X-Auth-Email': cloudflare_email,
-            'Authorization': f'Bearer {cloudflare_api_key}',
-            'Content-Type': 'application/json',
-        }
-        
-        url = f"https://api.cloudflare.com/client/v4/zones/{cloudflare_zone_id}/purge_cache"
-        
-        data = {
-            "tags": [self.subdomain]
-        }
-        
-        try:
-            response = requests.post(url, headers=headers, json=data, timeout=5)
-            response.raise_for_status()
-            response_data = response.json()
-            if response_data.get('success') == True:
-                print(f"Invalidated Cloudflare cache for tag: {self.subdomain}")
-            else:
-                errors = response_data.get('errors', [])
-                print(f"Failed to invalidate Cloudflare cache for tag: {self.subdomain}")
-                print(f"Errors: {errors}")
-
-            return response_data
-        except Exception as e:
-            # Log the error but don't prevent the save operation
-            print(f"Error invalidating Cloudflare cache for {self.subdomain}: {str(e)}")
-            return None
+        # Batched with other saves in the next few seconds, off the request thread
+        purge_queue.add(self.subdomain)
 
     def save(self, *args, **kwargs):
         # Handle all tags
@@ -250,6 +228,14 @@ class Blog(models.Model):
 
         # Save the blog
         super(Blog, self).save(*args, **kwargs)
+
+        # Drop cached host lookups (including negative ones) for this blog's addresses
+        from blogs.views.blog import forget_blog_hosts
+        forget_blog_hosts(self)
+
+        # Keep the blog's discover feed entries in line
+        from blogs.views.discover import sync_discover_blog
+        sync_discover_blog(self)
         
         # Invalidate Cloudflare cache after saving
         if self.pk:
@@ -308,26 +294,15 @@ class Post(models.Model):
         return hashlib.sha256(self.uid.encode()).hexdigest()[0:10]
 
     def update_score(self):
-        self.upvotes = self.upvote_set.count()
-        upvotes = self.upvotes
-
-        if upvotes > 1: 
-            # Cap upvotes at 30 so they don't stick to the top forever
-            if upvotes > 30:
-                upvotes = 30
-
-            upvotes += self.shadow_votes
-
-            log_of_upvotes = log(upvotes, 10)
-
-            posted_at = self.first_published_at or self.published_date
-
-            seconds = posted_at.timestamp()
-            if seconds > 0:
-                # Lower buoyancy means posts sink faster with time
-                buoyancy = 14
-                score = (log_of_upvotes) + ((seconds - 1577811600) / (buoyancy * 86400))
-                self.score = score
+        # Upvote.save increments the stored count, this instance may have been loaded before that
+        upvotes = Post.objects.filter(pk=self.pk).values_list('upvotes', flat=True).first()
+        if upvotes is not None:
+            self.upvotes = upvotes
+
+        from blogs.scoring import post_score
+        score = post_score(self.upvotes, self.shadow_votes, self.first_published_at or self.published_date)
+        if score is not None:
+            self.score = score
     
     def save(self, *args, **kwargs):
         self.slug = self.slug.lower()
@@ -364,26 +339,80 @@ class Post(models.Model):
         # Save blog to trigger a few other things
         self.blog.save()
 
+        from blogs.views.discover import sync_discover_post
+        sync_discover_post(self)
+
+        # Pre-render the feed entry so feed requests don't have to
+        if self.publish and not self.is_page:
+            from blogs.views.feed import update_feed_entry
+            update_feed_entry(self.blog, self)
+
     def __str__(self):
         return self.title
 
 
+# Pre-rendered Atom/RSS entry fragments, rebuilt whenever the fingerprint of the post changes
+class FeedEntry(models.Model):
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, related_name='feed_entry')
+    fingerprint = models.CharField(max_length=64)
+    atom = models.TextField()
+    rss = models.TextField()
+    updated_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.post} - {self.fingerprint[:10]}"
+
+
+# Posts eligible for the discovery feed, with what the feed filters, sorts and displays
+# on, so discover pages are an index scan on one narrow table. Kept in sync on save, see
+# blogs/views/discover.py
+class DiscoverPost(models.Model):
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, primary_key=True, related_name='discover_entry')
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE, related_name='discover_entries')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    title = models.CharField(max_length=200)
+    slug = models.CharField(max_length=200)
+    published_date = models.DateTimeField()
+    score = models.FloatField(default=0)
+    upvotes = models.IntegerField(default=0)
+    shadow_votes = models.IntegerField(default=0)
+    lang = models.CharField(max_length=10, blank=True)
+    hidden = models.BooleanField(default=False)
+    subdomain = models.CharField(max_length=100)
+    blog_url = models.CharField(max_length=200)
+    blog_lang = models.CharField(max_length=10, blank=True)
+    blog_hidden = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Pages are sorted by these, with the id breaking ties for keyset pagination
+            models.Index(fields=['-score', '-post'], condition=models.Q(hidden=False, blog_hidden=False), name='discover_score'),
+            models.Index(fields=['-published_date', '-post'], condition=models.Q(hidden=False, blog_hidden=False), name='discover_newest'),
+        ]
+
+    def __str__(self):
+        return f"{self.title} - {self.score}"
+
+
 class Upvote(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE)
     created_date = models.DateTimeField(auto_now_add=True)
     hash_id = models.CharField(max_length=200)
 
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+
         # Save the Upvote instance
         super(Upvote, self).save(*args, **kwargs)
 
-        # Update only upvotes/score, skipping the full Post.save() cascade
-        # (search vector rebuild, blog save, cache invalidation)
-        self.post.update_score()
-        Post.objects.filter(pk=self.post.pk).update(
-            upvotes=self.post.upvotes,
-            score=self.post.score,
-        )
+        # Count it without recounting or touching the score, skipping the full Post.save() cascade
+        # (search vector rebuild, blog save, cache invalidation). The score follows in a batch
+        if adding:
+            Post.objects.filter(pk=self.post_id).update(upvotes=F('upvotes') + 1)
+            DiscoverPost.objects.filter(pk=self.post_id).update(upvotes=F('upvotes') + 1)
+
+            from blogs.scoring import rescore_queue
+            rescore_queue.add(self.post_id)
 
     class Meta:
         indexes = [
@@ -423,15 +452,103 @@ class Hit(models.Model):
             
             # For country aggregation
             models.Index(fields=['blog', 'created_date', 'country'], name='hit_blog_date_country'),
-
-            # For the get_or_create dedupe lookup in the hit endpoint
-            models.Index(fields=['blog', 'hash_id', 'post'], name='hit_blog_hash_post'),
+        ]
+        constraints = [
+            # Dedupes batched inserts from the hit queue (bulk_create ignore_conflicts).
+            # hash_id is per visitor per day, scrubbed rows are exempt since they all share one value.
+            models.UniqueConstraint(
+                fields=['blog', 'hash_id', 'post', 'referrer', 'country', 'device', 'browser'],
+                condition=~models.Q(hash_id='scrubbed'),
+                nulls_distinct=False,
+                name='hit_unique_visit',
+            ),
         ]
 
     def __str__(self):
         return f"{self.created_date.strftime('%d %b %Y, %X')} - {self.blog.subdomain} - {self.post}"
 
 
+# Closed (UTC) days of Hit rows, built by the rollup_hits command so analytics
+# don't have to aggregate raw hits for long date ranges
+class HitRollup(models.Model):
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, blank=True, null=True)
+    date = models.DateField()
+    referrer = models.URLField(default=None, blank=True, null=True)
+    country = models.CharField(max_length=200, blank=True, null=True)
+    device = models.CharField(max_length=200, blank=True, null=True)
+    browser = models.CharField(max_length=200, blank=True, null=True)
+    hits = models.IntegerField(default=0)
+    # Distinct visitors within this row only, rows can't be summed into a daily total
+    visitors = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['blog', 'date'], name='hitrollup_blog_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.blog_id} - {self.hits} hits"
+
+
+class VisitorRollup(models.Model):
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
+    date = models.DateField()
+    visitors = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blog', 'date'], name='visitorrollup_blog_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.blog_id} - {self.visitors} visitors"
+
+
+
+# HyperLogLog sketches of a day's visitor hash_ids (blogs/utils/hll.py), written by the
+# hit queue as hits come in. Merging days gives unique visitors for any range without
+# keeping hashes around. key is '' for the blog, a post id (or 'homepage'), a referrer,
+# or 'post|referrer' for the matching scope.
+class VisitorSketch(models.Model):
+    SCOPES = (
+        ('blog', 'Blog'),
+        ('post', 'Post'),
+        ('referrer', 'Referrer'),
+        ('post_referrer', 'Post and referrer'),
+    )
+
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
+    date = models.DateField()
+    scope = models.CharField(max_length=20, choices=SCOPES)
+    key = models.CharField(max_length=255, blank=True, default='')
+    registers = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blog', 'scope', 'key', 'date'], name='visitorsketch_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.blog_id} - {self.scope} {self.key}"
+
+
+# Sliding window of hits per blog for "Reading now". A small ring of per-minute buckets,
+# a slot is reused (and reset) once its minute has passed.
+class OnSiteCounter(models.Model):
+    blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
+    slot = models.SmallIntegerField()
+    minute = models.IntegerField()
+    hits = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['blog', 'slot'], name='onsitecounter_blog_slot'),
+        ]
+
+    def __str__(self):
+        return f"{self.blog_id} - {self.minute} - {self.hits} hits"
+
 class Subscriber(models.Model):
     blog = models.ForeignKey(Blog, on_delete=models.CASCADE)
     email_address = models.EmailField()
@@ -475,6 +592,8 @@ class PersistentStore(models.Model):
     review_highlight_terms = models.TextField(blank=True, default='[]')
     review_blacklist_terms = models.TextField(blank=True, default='[]')
     reviewed_blogs = models.JSONField(default=dict)
+    hits_rolled_up_to = models.DateField(blank=True, null=True)
+    hits_scrubbed_to_id = models.BigIntegerField(blank=True, null=True)
 
     @property
     def ignore_terms(self):
@@ -0,0 +1,87 @@
+from django.core.cache import caches
+from django.utils import timezone
+
+from blogs.models import Blog, DiscoverPost
+from blogs.tasks import executor
+
+from array import array
+import random
+import time
+
+pool_cache = caches['discover']
+
+# Processes look for a rebuilt pool at most this often
+reload_after = 60
+
+_pool = {'built_at': None, 'checked': 0, 'posts': {}, 'blogs': array('I')}
+
+
+def build_random_pool():
+    """Collects the ids of discoverable posts, per language, and of discoverable blogs.
+
+    The ids are kept as arrays of 4 byte ints in the discover cache, and every process
+    samples from its own copy, so a random pick is never a miss.
+    """
+    try:
+        return _build_random_pool()
+    finally:
+        pool_cache.delete('random_pool:building')
+
+
+def _build_random_pool():
+    posts = {'': array('I')}
+    rows = DiscoverPost.objects.filter(published_date__lte=timezone.now(), hidden=False, blog_hidden=False)
+    for pk, lang, blog_lang in rows.order_by('pk').values_list('pk', 'lang', 'blog_lang').iterator(chunk_size=10000):
+        posts[''].append(pk)
+        # The post's language, or its blog's, as filter_lang matches them
+        lang = (lang or blog_lang or '')[:2]
+        if lang:
+            posts.setdefault(lang, array('I')).append(pk)
+
+    blogs = Blog.objects.filter(reviewed=True, hidden=False, user__is_active=True).order_by('pk')
+    pool = {
+        'built_at': time.time(),
+        'posts': posts,
+        'blogs': array('I', blogs.values_list('pk', flat=True).iterator(chunk_size=10000)),
+    }
+    pool_cache.set_many({'random_pool': pool, 'random_pool:built_at': pool['built_at']}, None)
+
+    _pool.update(pool, checked=time.monotonic())
+    return _pool
+
+
+def get_pool():
+    if time.monotonic() - _pool['checked'] < reload_after:
+        return _pool
+    _pool['checked'] = time.monotonic()
+
+    built_at = pool_cache.get('random_pool:built_at')
+    if built_at is not None and built_at == _pool['built_at']:
+        return _pool
+
+    pool = pool_cache.get('random_pool') if built_at is not None else None
+    if pool is None:
+        # Not built yet, or pushed out of the cache. Only one caller rebuilds it, and keeps
+        # serving its old copy meanwhile if it has one
+        if not pool_cache.add('random_pool:building', True, 60):
+            if _pool['built_at'] is None:
+                # Look again on the next pick instead of waiting out reload_after
+                _pool['checked'] = 0
+            return _pool
+        if _pool['built_at'] is not None and executor.background:
+            executor.submit('discover', build_random_pool)
+            return _pool
+        return build_random_pool()
+    _pool.update(pool)
+    return _pool
+
+
+def sample_posts(count, lang=None):
+    # Ids of up to count random discoverable posts in lang, which may have changed since the pool was built
+    ids = get_pool()['posts'].get((lang or '')[:2], ())
+    return random.sample(ids, min(count, len(ids)))
+
+
+def sample_blogs(count):
+    ids = get_pool()['blogs']
+    return random.sample(ids, min(count, len(ids)))
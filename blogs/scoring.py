@@ -0,0 +1,147 @@
+from django.db import transaction
+from django.db.models import Count
+
+from blogs.models import DiscoverPost, Post, Upvote
+from blogs.tasks import executor
+
+from math import log
+from threading import Lock
+
+# Scores count up from the start of 2020
+SCORE_EPOCH = 1577811600
+
+# Lower buoyancy means posts sink faster with time
+BUOYANCY = 14
+
+# Cap upvotes at 30 so they don't stick to the top forever
+UPVOTE_CAP = 30
+
+# Posts upvoted within this many seconds of each other are rescored together
+RESCORE_WINDOW = 60
+
+
+def post_score(upvotes, shadow_votes, posted_at, buoyancy=BUOYANCY, cap=UPVOTE_CAP):
+    """Score = log10(U) + (S / (B * 86,400)), None for posts with fewer than 2 upvotes or U <= 0 (they keep their score)."""
+    if upvotes <= 1 or posted_at is None:
+        return None
+
+    seconds = posted_at.timestamp()
+    if seconds <= 0:
+        return None
+
+    votes = min(upvotes, cap) + shadow_votes
+    if votes <= 0:
+        # Negative shadow votes outweigh the upvotes, there's no log to take
+        return None
+    return log(votes, 10) + ((seconds - SCORE_EPOCH) / (buoyancy * 86400))
+
+
+def upvote_counts(post_ids):
+    # One GROUP BY for the whole batch
+    return dict(
+        Upvote.objects.filter(post_id__in=post_ids)
+        .values('post_id')
+        .annotate(upvote_count=Count('id'))
+        .values_list('post_id', 'upvote_count')
+    )
+
+
+def rescore(post_ids, buoyancy=BUOYANCY, cap=UPVOTE_CAP, batch_size=1000, dry_run=False):
+    """Recounts upvotes and recomputes scores for the posts, batch_size posts at a time.
+
+    Changed posts and their discover entries are written with one bulk update per batch.
+    Returns the changes as dicts with the old and new upvotes and score.
+    """
+    post_ids = list(post_ids)
+    changes = []
+
+    for i in range(0, len(post_ids), batch_size):
+        batch = post_ids[i:i + batch_size]
+        counts = upvote_counts(batch)
+        changed = []
+
+        posts = Post.objects.filter(pk__in=batch).only('id', 'title', 'upvotes', 'shadow_votes', 'score', 'first_published_at', 'published_date')
+        for post in posts:
+            upvotes = counts.get(post.pk, 0)
+            score = post_score(upvotes, post.shadow_votes, post.first_published_at or post.published_date, buoyancy, cap)
+            if score is None:
+                score = post.score
+            if (upvotes, score) == (post.upvotes, post.score):
+                continue
+
+            changes.append({
+                'id': post.pk,
+                'title': post.title,
+                'old_upvotes': post.upvotes,
+                'upvotes': upvotes,
+                'old_score': post.score,
+                'score': score,
+            })
+            post.upvotes, post.score = upvotes, score
+            changed.append(post)
+
+        if changed and not dry_run:
+            with transaction.atomic():
+                Post.objects.bulk_update(changed, ['upvotes', 'score'])
+                DiscoverPost.objects.bulk_update(
+                    [DiscoverPost(post_id=post.pk, upvotes=post.upvotes, score=post.score) for post in changed],
+                    ['upvotes', 'score'],
+                )
+
+    if changes and not dry_run:
+        from blogs.views.discover import bump_discover_generation, ranking_changed
+        if ranking_changed(changes):
+            bump_discover_generation()
+
+    return changes
+
+
+class RescoreQueue:
+    """Collects upvoted posts for RESCORE_WINDOW seconds, then rescores them in one batch.
+
+    rescore_posts still reconciles every recently upvoted post, this keeps a new vote
+    from waiting on the scheduler.
+    """
+
+    def __init__(self):
+        self._post_ids = set()
+        self._lock = Lock()
+        self._scheduled = False
+
+    def add(self, post_id):
+        with self._lock:
+            self._post_ids.add(post_id)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        executor.schedule(RESCORE_WINDOW, 'discover', self.flush, refused=self.retry)
+
+    def retry(self):
+        # The discover queue was full, try the posts again in the next window
+        with self._lock:
+            self._scheduled = bool(self._post_ids)
+            if not self._scheduled:
+                return
+        executor.schedule(RESCORE_WINDOW, 'discover', self.flush, refused=self.retry)
+
+    def flush(self):
+        with self._lock:
+            post_ids, self._post_ids = self._post_ids, set()
+            self._scheduled = False
+        if not post_ids:
+            return
+        try:
+            rescore(post_ids)
+        except Exception:
+            # Put them back so the queue's retry, or the next window, rescores them
+            with self._lock:
+                self._post_ids.update(post_ids)
+            raise
+
+
+rescore_queue = RescoreQueue()
+
+
+def discover_rank(score, exclude=None):
+    # Position on the trending page for a post with this score
+    return DiscoverPost.objects.filter(hidden=False, blog_hidden=False, score__gt=score).exclude(pk=exclude).count() + 1
@@ -0,0 +1,214 @@
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+import atexit
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+
+class TaskQueue:
+    """A bounded queue of side-effect work (emails, purges, uploads) with a few worker threads.
+
+    Tasks that raise are retried with exponential backoff. When the queue is full new
+    tasks are dropped (and counted) rather than piling up threads in the web worker.
+    """
+
+    def __init__(self, name, workers=2, maxsize=1000, retries=2, backoff=1):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.retries = retries
+        self.backoff = backoff
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            self.queue.put_nowait((fn, args, kwargs, time.monotonic()))
+        except queue.Full:
+            self.dropped += 1
+            print(f'Tasks: {self.name} queue is full, dropped {getattr(fn, "__name__", fn)}')
+            return False
+
+        self.submitted += 1
+        self.high_water = max(self.high_water, self.queue.qsize())
+        self.start()
+        return True
+
+    def start(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._start_lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f'tasks-{self.name}-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                # Stopping, don't leave the connection open behind the process
+                connections.close_all()
+                self._threads.remove(threading.current_thread())
+                self.queue.task_done()
+                return
+            # Workers have their own connection, keep it healthy like a request would
+            close_old_connections()
+            try:
+                self.run(*task)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def run(self, fn, args, kwargs, queued_at):
+        started = time.monotonic()
+        self.wait_time += started - queued_at
+        for attempt in range(self.retries + 1):
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries:
+                    self.failed += 1
+                    print(f'Tasks: {self.name} {getattr(fn, "__name__", fn)} failed: {e}')
+                    break
+                self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                self.completed += 1
+                break
+        self.run_time += time.monotonic() - started
+
+    def drain(self, timeout):
+        # Give the workers until the deadline to finish what's queued
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stop(self):
+        # One stop marker per worker, queued behind whatever is left
+        for _ in list(self._threads):
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {
+            'workers': self.workers,
+            'queued': self.queue.qsize(),
+            'maxsize': self.queue.maxsize,
+            'high_water': self.high_water,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'avg_wait': self.wait_time / done if done else 0,
+            'avg_run': self.run_time / done if done else 0,
+        }
+
+
+class TaskExecutor:
+    """Per task type queues, plus a single timer thread for delayed tasks."""
+
+    def __init__(self, queues, background=None):
+        self.queues = {q.name: q for q in queues}
+        self._background = background
+        self._delayed = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._timer = None
+
+    @property
+    def background(self):
+        # Follows the BACKGROUND_TASKS setting unless set, which is off on dev and in tests
+        if self._background is None:
+            return settings.BACKGROUND_TASKS
+        return self._background
+
+    @background.setter
+    def background(self, value):
+        self._background = value
+
+    def submit(self, name, fn, *args, **kwargs):
+        if not self.background:
+            # Inline on dev and in tests, without retries
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                print(f'Tasks: {name} {getattr(fn, "__name__", fn)} failed: {e}')
+            return True
+        return self.queues[name].submit(fn, *args, **kwargs)
+
+    def schedule(self, delay, name, fn, *args, refused=None, **kwargs):
+        """Submits fn to the named queue in delay seconds.
+
+        The queue can be full by then, in which case the task is dropped and refused()
+        is called so the caller can forget about it or run it another way.
+        """
+        if not self.background:
+            return self.submit(name, fn, *args, **kwargs)
+        with self._condition:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._counter), name, fn, args, kwargs, refused))
+            self._condition.notify()
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._run_timer, name='tasks-timer', daemon=True)
+                self._timer.start()
+        return True
+
+    def _run_timer(self):
+        while True:
+            with self._condition:
+                while not self._delayed or self._delayed[0][0] > time.monotonic():
+                    self._condition.wait(self._delayed[0][0] - time.monotonic() if self._delayed else None)
+                _, _, name, fn, args, kwargs, refused = heapq.heappop(self._delayed)
+            if not self.queues[name].submit(fn, *args, **kwargs) and refused:
+                try:
+                    refused()
+                except Exception as e:
+                    print(f'Tasks: {name} {getattr(refused, "__name__", refused)} failed: {e}')
+
+    def drain(self, timeout=4):
+        # Gunicorn gives a worker 5 seconds to shut down, finish what's already queued.
+        # Delayed tasks that haven't come due are lost with the process.
+        deadline = time.monotonic() + timeout
+        for q in self.queues.values():
+            q.drain(max(deadline - time.monotonic(), 0))
+
+    def shutdown(self, timeout=4):
+        # Drain, then stop the workers so they close their database connections
+        self.drain(timeout)
+        for q in self.queues.values():
+            q.stop()
+
+    def stats(self):
+        return {
+            'delayed': len(self._delayed),
+            'queues': {name: q.stats() for name, q in self.queues.items()},
+        }
+
+
+executor = TaskExecutor([
+    TaskQueue('email', workers=2),
+    TaskQueue('cloudflare', workers=2),
+    TaskQueue('backup', workers=1),
+    TaskQueue('media', workers=4, maxsize=200),
+    TaskQueue('discover', workers=1, maxsize=100),
+])
+
+atexit.register(executor.shutdown)
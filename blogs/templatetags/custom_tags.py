@@ -1,4 +1,5 @@
 from django import template
+from django.core.cache import caches
 from django.utils import timezone
 from django.template.loader import render_to_string
 from django.utils import dateformat, translation
@@ -17,17 +18,23 @@ from mistune import HTMLRenderer, create_markdown
 from mistune.directives import FencedDirective, RSTDirective
 from mistune.directives import Admonition, TableOfContents
 from zoneinfo import ZoneInfo
+from functools import lru_cache
 
+import hashlib
 import json
 import latex2mathml.converter
 import re
 
 from blogs.helpers import unmark
 from blogs.models import Post
+from blogs.utils.lru import LRUCache
 
 
 register = template.Library()
 
+# Bump whenever the renderer output changes so previously cached HTML is ignored
+RENDERER_VERSION = 1
+
 HOST_WHITELIST = [
     'www.youtube.com',
     'www.youtube-nocookie.com',
@@ -77,6 +84,33 @@ TYPOGRAPHIC_REPLACEMENTS = [
     ('\\n', '<br>')
 ]
 
+# Patterns are compiled once per process. Each stage of the pipeline checks
+# for its trigger characters first and skips the regex entirely when absent.
+LATEX_INLINE_PATTERN = re.compile(r'\$\$([^\n]*?)\$\$')
+CURRENCY_PATTERN = re.compile(r'(?<!\\)(\$\d[^$]*?)(?<!\\)(\$\d)')
+LINK_PARENTHESES_PATTERN = re.compile(r'\[([^\]]+)\]\(((?:tab:)?https?://[^\)]+\([^\)]*\)[^\)]*)\)')
+PROTECTED_CODE_PATTERN = re.compile(r'```.*?```|`[^`\n]+`|<script[\s>].*?</script>', re.DOTALL)
+FENCED_CODE_PATTERN = re.compile(r'(```[^\n]*\n.*?```|~~~[^\n]*\n.*?~~~)', re.DOTALL)
+SCRIPT_BLOCK_PATTERN = re.compile(r'<script\b[^>]*>.*?</script>', re.DOTALL | re.IGNORECASE)
+TRAILING_BACKSLASH_PATTERN = re.compile(r'^\s*\\\s*$')
+PRE_CODE_PATTERN = re.compile(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', re.DOTALL)
+
+CLEAN_SCRIPT_PATTERN = re.compile(r'<script.*?>.*?</script>', re.DOTALL | re.IGNORECASE)
+CLEAN_EVENT_HANDLER_PATTERNS = [
+    re.compile(r'\son\w+="[^"]*"', re.IGNORECASE),
+    re.compile(r'\son\w+=\'[^\']*\'', re.IGNORECASE),
+    re.compile(r'\son\w+=\w+', re.IGNORECASE),
+]
+CLEAN_JAVASCRIPT_URL_PATTERN = re.compile(r'(<\w+\s+.*?)(href|src)\s*=\s*["\']?javascript:[^"\']*["\']?', re.IGNORECASE)
+CLEAN_BLOCKED_OPEN_TAG_PATTERN = re.compile(r'<(object|embed|form|input|button).*?>', re.IGNORECASE)
+CLEAN_BLOCKED_CLOSE_TAG_PATTERN = re.compile(r'</(object|embed|form|input|button)>', re.IGNORECASE)
+CLEAN_EVENT_HANDLER_TAG_PATTERN = re.compile(r'<\w+\s*[^>]*\bon\w+\s*=\s*(".*?"|\'.*?\'|[^\s>]*)\s*[^>]*>', re.IGNORECASE | re.DOTALL)
+CLEAN_IFRAME_PATTERN = re.compile(r'(<iframe.*?src=["\'])([^"\']*)(["\'].*?>.*?</iframe>)', re.DOTALL | re.IGNORECASE)
+
+BOLD_TITLE_PATTERN = re.compile(r'\*\*(.+?)\*\*')
+ITALIC_TITLE_PATTERN = re.compile(r'\*(.+?)\*')
+PLAIN_TITLE_PATTERN = re.compile(r'\*+(.+?)\*+')
+
 
 def typographic_replacements(text):
     for old, new in TYPOGRAPHIC_REPLACEMENTS:
@@ -84,17 +118,21 @@ def typographic_replacements(text):
     return text
 
 def replace_inline_latex(text):
-    latex_exp_inline = re.compile(r'\$\$([^\n]*?)\$\$')
-    replaced_text = latex_exp_inline.sub(r'$\1$', text)
+    if '$$' not in text:
+        return text
+    replaced_text = LATEX_INLINE_PATTERN.sub(r'$\1$', text)
 
     return replaced_text
 
 def escape_currency(text):
+    if '$' not in text:
+        return text
     # Escape pairs of $<digit> as currency, e.g. "$5 ... $10" → "\$5 ... \$10"
-    return re.sub(r'(?<!\\)(\$\d[^$]*?)(?<!\\)(\$\d)', r'\\\1\\\2', text)
+    return CURRENCY_PATTERN.sub(r'\\\1\\\2', text)
 
 def fix_links(text):
-    parentheses_pattern = r'\[([^\]]+)\]\(((?:tab:)?https?://[^\)]+\([^\)]*\)[^\)]*)\)'
+    if '](' not in text:
+        return text
 
     def escape_parentheses(match):
         label = match.group(1)
@@ -103,7 +141,7 @@ def fix_links(text):
         escaped_url = url.replace('(', '%28').replace(')', '%29')
         return f'[{label}]({escaped_url})'
 
-    fixed_text = re.sub(parentheses_pattern, escape_parentheses, text)
+    fixed_text = LINK_PARENTHESES_PATTERN.sub(escape_parentheses, text)
     
 
     return fixed_text
@@ -141,7 +179,7 @@ class MyRenderer(HTMLRenderer):
 
     def text(self, text):
         # Replace trailing backslashes with <br>
-        if re.match(r'^\s*\\\s*$', text):
+        if '\\' in text and TRAILING_BACKSLASH_PATTERN.match(text):
             text = '<br>'
         return typographic_replacements(text)
     
@@ -152,31 +190,63 @@ class MyRenderer(HTMLRenderer):
         return html
     
     def inline_math(self, text):
-        # Skip rendering if there's a space before the closing dollar sign
-        try:
-            return latex2mathml.converter.convert(text)
-        except Exception as e:
-            print("LaTeX rendering error")
+        return latex_to_mathml(text)
 
-    
     def block_math(self, text):
-        try:
-            
-            return latex2mathml.converter.convert(text).replace('display="inline"', 'display="block"')
-        except Exception as e:
-            print("LaTeX rendering error")
+        mathml = latex_to_mathml(text)
+        if mathml is not None:
+            return mathml.replace('display="inline"', 'display="block"')
     
     def block_code(self, code, info=None):
         if info is None:
             info = 'text'
+        return highlight_code(code, info)
+
+
+# MathML keyed on the LaTeX expression, shared by inline and block math.
+# Failed conversions are cached as well so a bad expression is only parsed (and logged) once
+mathml_cache = LRUCache(maxsize=4096)
+MATHML_FAILED = object()
+
+
+def latex_to_mathml(text):
+    mathml = mathml_cache.get(text)
+    if mathml is None:
         try:
-            lexer = get_lexer_by_name(info)
-        except ValueError:
-            lexer = get_lexer_by_name('text')
-        
-        formatter = HtmlFormatter(style='friendly')
-        highlighted_code = highlight(code, lexer, formatter)
-        return highlighted_code
+            mathml = latex2mathml.converter.convert(text)
+        except Exception:
+            print("LaTeX rendering error")
+            mathml = MATHML_FAILED
+        mathml_cache.set(text, mathml)
+
+    if mathml is MATHML_FAILED:
+        return None
+    return mathml
+
+
+# One formatter is shared by every code block, it holds no per-render state
+CODE_FORMATTER = HtmlFormatter(style='friendly')
+
+# Highlighted HTML keyed on (language, code hash). Code-heavy posts repeat the same snippets
+highlight_cache = LRUCache(maxsize=2048)
+
+
+@lru_cache(maxsize=256)
+def get_lexer(info):
+    # get_lexer_by_name is a slow plugin lookup, so lexers are kept around per language name
+    try:
+        return get_lexer_by_name(info)
+    except ValueError:
+        return get_lexer_by_name('text')
+
+
+def highlight_code(code, info='text'):
+    key = (info, hashlib.sha256(code.encode('utf-8', 'surrogatepass')).hexdigest())
+    highlighted_code = highlight_cache.get(key)
+    if highlighted_code is None:
+        highlighted_code = highlight(code, get_lexer(info), CODE_FORMATTER)
+        highlight_cache.set(key, highlighted_code)
+    return highlighted_code
 
 
 _mistune_renderer = create_markdown(
@@ -201,7 +271,8 @@ def markdown_renderer(content):
         code_placeholders[key] = match.group(0)
         return key
 
-    content = re.sub(r'(```[^\n]*\n.*?```|~~~[^\n]*\n.*?~~~)', replace_code, content, flags=re.DOTALL)
+    if '```' in content or '~~~' in content:
+        content = FENCED_CODE_PATTERN.sub(replace_code, content)
 
     # Extract script blocks (now only those outside code fences)
     script_placeholders = {}
@@ -211,7 +282,8 @@ def markdown_renderer(content):
         script_placeholders[key] = match.group(0)
         return key
 
-    content = re.sub(r'<script\b[^>]*>.*?</script>', replace_script, content, flags=re.DOTALL | re.IGNORECASE)
+    if '<script' in content.lower():
+        content = SCRIPT_BLOCK_PATTERN.sub(replace_script, content)
 
     # Restore code blocks before rendering
     for key, code in code_placeholders.items():
@@ -226,19 +298,21 @@ def markdown_renderer(content):
     return result
 
 
-@register.simple_tag(takes_context=False)
-def markdown(content, blog=None, post=None, tz=None):
-    content = str(content)
-    if not content:
-        return ''
+def render_cache_key(content, upgraded):
+    digest = hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
+    return f'markdown:{RENDERER_VERSION}:{int(upgraded)}:{digest}'
+
 
+def render_markup(content, upgraded=False):
+    """Render markdown to (cleaned) HTML, leaving {{ directives }} untouched."""
     # Protect code blocks and inline code from currency/latex escaping
     code_placeholders = {}
     def _protect_code(match):
         key = f"<!--EXCLUDE_BLOCK_{len(code_placeholders)}-->"
         code_placeholders[key] = match.group(0)
         return key
-    content = re.sub(r'```.*?```|`[^`\n]+`|<script[\s>].*?</script>', _protect_code, content, flags=re.DOTALL)
+    if '`' in content or '<script' in content:
+        content = PROTECTED_CODE_PATTERN.sub(_protect_code, content)
 
     # Removes old formatted inline LaTeX
     content = replace_inline_latex(content)
@@ -251,15 +325,54 @@ def markdown(content, blog=None, post=None, tz=None):
     for key, code in code_placeholders.items():
         content = content.replace(key, code)
 
-    try:
-        processed_markup = markdown_renderer(content)
-    except TypeError:
-        return ''
+    processed_markup = markdown_renderer(content)
 
     # If not upgraded remove iframes and js
-    if not blog or not blog.user.settings.upgraded:
+    if not upgraded:
         processed_markup = clean(processed_markup)
 
+    return processed_markup
+
+
+# Recently rendered HTML in this process, in front of the markdown database cache. Nav, footer
+# and content are rendered on every page and a database round trip each adds up
+local_render_cache = LRUCache(maxsize=1000)
+
+
+def cached_render_markup(content, upgraded=False):
+    """render_markup backed by the shared render cache.
+
+    The cached HTML only depends on the content, the renderer version and
+    whether the blog is upgraded, so unchanged posts are rendered once and
+    reused across workers (and Cloudflare purges).
+    """
+    key = render_cache_key(content, upgraded)
+    processed_markup = local_render_cache.get(key)
+    if processed_markup is not None:
+        return processed_markup
+
+    render_cache = caches['markdown']
+    processed_markup = render_cache.get(key)
+    if processed_markup is None:
+        processed_markup = render_markup(content, upgraded)
+        render_cache.set(key, processed_markup)
+    local_render_cache.set(key, processed_markup)
+    return processed_markup
+
+
+@register.simple_tag(takes_context=False)
+def markdown(content, blog=None, post=None, tz=None):
+    content = str(content)
+    if not content:
+        return ''
+
+    upgraded = bool(blog and blog.user.settings.upgraded)
+
+    try:
+        processed_markup = cached_render_markup(content, upgraded)
+    except TypeError:
+        return ''
+
     # Replace {{ xyz }} elements
     if blog:
         processed_markup = excluding_pre(processed_markup, blog, post, tz=tz)
@@ -269,6 +382,10 @@ def markdown(content, blog=None, post=None, tz=None):
 
 # Replace elements in all but pre and code tags
 def excluding_pre(markup, blog=None, post=None, tz=None):
+    # No directives to replace
+    if '{{' not in markup:
+        return markup
+
     placeholders = {}
 
     def placeholder_div(match):
@@ -276,7 +393,8 @@ def excluding_pre(markup, blog=None, post=None, tz=None):
         placeholders[key] = match.group(0)
         return key
 
-    markup = re.sub(r'(<pre.*?>.*?</pre>|<code.*?>.*?</code>)', placeholder_div, markup, flags=re.DOTALL)
+    if '<pre' in markup or '<code' in markup:
+        markup = PRE_CODE_PATTERN.sub(placeholder_div, markup)
 
     if blog:
         if post:
@@ -331,44 +449,156 @@ def apply_filters(posts, tag=None, limit=None, order=None, from_date=None, to_da
     return posts
 
 
+def render_posts_directive(params_str, blog, post=None, tz=None):
+    tag, limit, order, description, image, content = None, None, None, False, False, False
+    from_date = None
+    to_date = None
+
+    # Extract and process parameters one by one
+    params = POSTS_PARAM_PATTERN.findall(params_str)
+    for param in params:
+        if 'tag:' in param[0]:
+            tag = param[1].strip()
+        elif 'limit:' in param[0]:
+            limit = int(param[2])
+        elif 'order:' in param[0]:
+            order = param[3]
+        elif 'description:' in param[0]:
+            description = param[4] == 'True'
+        elif 'image:' in param[0]:
+            image  = param[5] == 'True'
+        # Only show content if injection is on page or homepage
+        elif 'content:' in param[0] and (not post or post.is_page):
+            content = param[6] == 'True'
+        elif 'from:' in param[0]:
+            from_date = param[7]
+        elif 'to:' in param[0]:
+            to_date = param[8]
+
+    filtered_posts = apply_filters(blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now()), tag, limit, order, from_date, to_date)
+    context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_image': image, 'show_content': content, 'tz': tz}
+    return render_to_string('snippets/post_list.html', context)
+
+
+class Directives:
+    """Lazily evaluated {{ directive }} values for a single render.
+
+    Each value is only computed (and memoised) once a directive that needs it
+    is found in the markup. Post directives return None without a post so
+    they're left untouched.
+    """
+
+    def __init__(self, blog, post=None):
+        self.blog = blog
+        self.post = post
+        self._values = {}
+        self._adjacent_posts = None
+
+    def get(self, name):
+        name = name.replace('-', '_')
+        if name not in self._values:
+            self._values[name] = getattr(self, name)()
+        return self._values[name]
+
+    def email_signup(self):
+        if self.blog.user.settings.upgraded:
+            return render_to_string('snippets/email_subscribe_form.html')
+        return ''
+
+    def blog_title(self):
+        return escape(self.blog.title)
+
+    def blog_description(self):
+        return escape(self.blog.meta_description)
+
+    def blog_created_date(self):
+        return render_to_string('snippets/formatted_date.html', {"date": self.blog.created_date})
+
+    def blog_last_modified(self):
+        return timesince(self.blog.last_modified)
+
+    def blog_last_posted(self):
+        if self.blog.last_posted:
+            return timesince(self.blog.last_posted)
+        return ''
+
+    def tags(self):
+        return render_to_string('snippets/blog_tags.html', {"tags": self.blog.tags, "blog_path": self.blog.blog_path or "blog"})
+
+    def blog_link(self):
+        return f"{self.blog.useful_domain}"
+
+    def post_title(self):
+        if self.post:
+            return safe_title(self.post.title)
+
+    def post_description(self):
+        if self.post:
+            return escape(self.post.meta_description)
+
+    def post_published_date(self):
+        if self.post:
+            return render_to_string('snippets/formatted_date.html', {"date": self.post.published_date})
+
+    def post_last_modified(self):
+        if self.post:
+            return timesince(self.post.last_modified or timezone.now())
+
+    def post_link(self):
+        if self.post:
+            return f"{self.blog.useful_domain}/{self.post.slug}"
+
+    def adjacent_posts(self):
+        # Shared by next_post and previous_post, so only queried once
+        if self._adjacent_posts is None:
+            self._adjacent_posts = get_adjacent_posts(self.post, self.blog)
+        return self._adjacent_posts
+
+    def next_post(self):
+        if self.post:
+            adjacent_posts = self.adjacent_posts()
+            if adjacent_posts['next_slug']:
+                return f'<a class="next-post" href="/{adjacent_posts['next_slug']}" title="{escape(adjacent_posts['next_title'])}">Next</a>'
+            return ''
+
+    def previous_post(self):
+        if self.post:
+            adjacent_posts = self.adjacent_posts()
+            if adjacent_posts['previous_slug']:
+                return f'<a class="previous-post" href="/{adjacent_posts['previous_slug']}" title="{escape(adjacent_posts['previous_title'])}">Previous</a>'
+            return ''
+
+
+DIRECTIVE_NAMES = [
+    'email-signup', 'email_signup',
+    'blog_title', 'blog_description', 'blog_created_date', 'blog_last_modified', 'blog_last_posted', 'tags', 'blog_link',
+    'post_title', 'post_description', 'post_published_date', 'post_last_modified', 'post_link', 'next_post', 'previous_post',
+]
+
+# Match the entire {{ posts ... }} directive (including parameters) or any of the named directives
+DIRECTIVE_PATTERN = re.compile(
+    r'\{\{\s*posts([^}]*)\}\}|\{\{ (' + '|'.join(re.escape(name) for name in DIRECTIVE_NAMES) + r') \}\}'
+)
+POSTS_PARAM_PATTERN = re.compile(r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|image:(True)|content:(True)|from:(\d{4}-\d{2}-\d{2})|to:(\d{4}-\d{2}-\d{2}))')
+
+
 def element_replacement(markup, blog, post=None, tz=None):
-    # Match the entire {{ posts ... }} directive, including parameters
-    pattern = r'\{\{\s*posts([^}]*)\}\}'
-    
-    def replace_with_filtered_posts(match):
-        params_str = match.group(1) 
-        tag, limit, order, description, image, content = None, None, None, False, False, False
-        from_date = None
-        to_date = None
-
-        # Extract and process parameters one by one
-        param_pattern = r'(tag:([^|}\s][^|}]*)|limit:(\d+)|order:(asc|desc)|description:(True)|image:(True)|content:(True)|from:(\d{4}-\d{2}-\d{2})|to:(\d{4}-\d{2}-\d{2}))'
-        params = re.findall(param_pattern, params_str)
-        for param in params:
-            if 'tag:' in param[0]:
-                tag = param[1].strip()
-            elif 'limit:' in param[0]:
-                limit = int(param[2])
-            elif 'order:' in param[0]:
-                order = param[3]
-            elif 'description:' in param[0]:
-                description = param[4] == 'True'
-            elif 'image:' in param[0]:
-                image  = param[5] == 'True'
-            # Only show content if injection is on page or homepage
-            elif 'content:' in param[0] and (not post or post.is_page):
-                content = param[6] == 'True'
-            elif 'from:' in param[0]:
-                from_date = param[7]
-            elif 'to:' in param[0]:
-                to_date = param[8]
-
-        filtered_posts = apply_filters(blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now()), tag, limit, order, from_date, to_date)
-        context = {'blog': blog, 'posts': filtered_posts, 'embed': True, 'show_description': description, 'show_image': image, 'show_content': content, 'tz': tz}
-        return render_to_string('snippets/post_list.html', context)
-
-    # Replace each matched directive with rendered content
-    markup = re.sub(pattern, replace_with_filtered_posts, markup)
+    # Most markup has no directives at all
+    if '{{' not in markup:
+        return markup
+
+    directives = Directives(blog, post)
+    # {{ posts }} lists render in the request language, everything else in the blog/post language
+    request_lang = translation.get_language()
+
+    def replace_directive(match):
+        if match.group(2) is None:
+            with translation.override(request_lang):
+                return render_posts_directive(match.group(1), blog, post, tz=tz)
+        value = directives.get(match.group(2))
+        if value is None:
+            return match.group(0)
+        return value
 
     # Date translation replacement
     current_lang = "en" # translation.get_language()
@@ -376,45 +606,8 @@ def element_replacement(markup, blog, post=None, tz=None):
     if post:
         translation.activate(post.lang)
 
-    if blog.user.settings.upgraded:
-        markup = markup.replace('{{ email-signup }}', render_to_string('snippets/email_subscribe_form.html'))
-        markup = markup.replace('{{ email_signup }}', render_to_string('snippets/email_subscribe_form.html'))
-    else:
-        markup = markup.replace('{{ email-signup }}', '')
-        markup = markup.replace('{{ email_signup }}', '')
-
-    markup = markup.replace('{{ blog_title }}', escape(blog.title))
-    markup = markup.replace('{{ blog_description }}', escape(blog.meta_description))
-    markup = markup.replace('{{ blog_created_date }}',  render_to_string('snippets/formatted_date.html', {"date": blog.created_date}))
-    markup = markup.replace('{{ blog_last_modified }}', timesince(blog.last_modified))
-    if blog.last_posted:
-        markup = markup.replace('{{ blog_last_posted }}', timesince(blog.last_posted))
-    else:
-        markup = markup.replace('{{ blog_last_posted }}', '')
-
-    markup = markup.replace('{{ tags }}', render_to_string('snippets/blog_tags.html', {"tags": blog.tags, "blog_path": blog.blog_path or "blog"}))
-        
-    markup = markup.replace('{{ blog_link }}', f"{blog.useful_domain}")
-
-    if post:
-        markup = markup.replace('{{ post_title }}', safe_title(post.title))
-        markup = markup.replace('{{ post_description }}', escape(post.meta_description))
-        markup = markup.replace('{{ post_published_date }}', render_to_string('snippets/formatted_date.html', {"date": post.published_date}))
-        last_modified = post.last_modified or timezone.now()
-        markup = markup.replace('{{ post_last_modified }}', timesince(last_modified))
-        markup = markup.replace('{{ post_link }}', f"{blog.useful_domain}/{post.slug}")
-
-        if "{{ next_post }}" in markup or "{{ previous_post }}" in markup:
-            # Only find adjacent posts if necessary
-            adjacent_posts = get_adjacent_posts(post, blog)
-            next_link = ""
-            previous_link = ""
-            if adjacent_posts['next_slug']:
-                next_link = f'<a class="next-post" href="/{adjacent_posts['next_slug']}" title="{escape(adjacent_posts['next_title'])}">Next</a>'
-            if adjacent_posts['previous_slug']:
-                previous_link = f'<a class="previous-post" href="/{adjacent_posts['previous_slug']}" title="{escape(adjacent_posts['previous_title'])}">Previous</a>'
-            markup = markup.replace('{{ next_post }}', next_link)
-            markup = markup.replace('{{ previous_post }}', previous_link)
+    # Single pass over the markup, each directive is rendered in place
+    markup = DIRECTIVE_PATTERN.sub(replace_directive, markup)
 
     translation.activate(current_lang)
 
@@ -457,8 +650,9 @@ def get_adjacent_posts(post, blog):
 def safe_title(title):
     """Convert **bold** to <b>, *italic* to <i>, and &nbsp; to non-breaking spaces in titles."""
     escaped = escape(title)
-    escaped = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', escaped)
-    escaped = re.sub(r'\*(.+?)\*', r'<i>\1</i>', escaped)
+    if '*' in escaped:
+        escaped = BOLD_TITLE_PATTERN.sub(r'<b>\1</b>', escaped)
+        escaped = ITALIC_TITLE_PATTERN.sub(r'<i>\1</i>', escaped)
     escaped = escaped.replace('&amp;nbsp;', '\u00a0')
     return mark_safe(escaped)
 
@@ -466,30 +660,38 @@ def safe_title(title):
 @register.filter
 def plain_title(title):
     """Strip * markers and &nbsp; for plain-text contexts."""
-    title = re.sub(r'\*+(.+?)\*+', r'\1', title)
+    if '*' in title:
+        title = PLAIN_TITLE_PATTERN.sub(r'\1', title)
     title = title.replace('&nbsp;', ' ')
     return title
 
 
 @register.filter
 def clean(markup):
-    cleaned_markup = re.sub(r'<script.*?>.*?</script>', '', markup, flags=re.DOTALL | re.IGNORECASE)
-    
-    cleaned_markup = re.sub(r'\son\w+="[^"]*"', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\'[^\']*\'', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'\son\w+=\w+', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'(<\w+\s+.*?)(href|src)\s*=\s*["\']?javascript:[^"\']*["\']?', r'\1', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'<(object|embed|form|input|button).*?>', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'</(object|embed|form|input|button)>', '', cleaned_markup, flags=re.IGNORECASE)
-    cleaned_markup = re.sub(r'<\w+\s*[^>]*\bon\w+\s*=\s*(".*?"|\'.*?\'|[^\s>]*)\s*[^>]*>', '', cleaned_markup, flags=re.IGNORECASE | re.DOTALL)
-    
+    lowered = markup.lower()
+
+    cleaned_markup = markup
+    if '<script' in lowered:
+        cleaned_markup = CLEAN_SCRIPT_PATTERN.sub('', cleaned_markup)
+
+    if '=' in lowered:
+        for pattern in CLEAN_EVENT_HANDLER_PATTERNS:
+            cleaned_markup = pattern.sub('', cleaned_markup)
+    if 'javascript:' in lowered:
+        cleaned_markup = CLEAN_JAVASCRIPT_URL_PATTERN.sub(r'\1', cleaned_markup)
+    if '<' in lowered:
+        cleaned_markup = CLEAN_BLOCKED_OPEN_TAG_PATTERN.sub('', cleaned_markup)
+        cleaned_markup = CLEAN_BLOCKED_CLOSE_TAG_PATTERN.sub('', cleaned_markup)
+        cleaned_markup = CLEAN_EVENT_HANDLER_TAG_PATTERN.sub('', cleaned_markup)
+
     def iframe_whitelisted(match):
         src = match.group(2)
         if any(host in src for host in HOST_WHITELIST):
             return match.group(0)
         return ''
 
-    cleaned_markup = re.sub(r'(<iframe.*?src=["\'])([^"\']*)(["\'].*?>.*?</iframe>)', iframe_whitelisted, cleaned_markup, flags=re.DOTALL | re.IGNORECASE)
+    if '<iframe' in lowered:
+        cleaned_markup = CLEAN_IFRAME_PATTERN.sub(iframe_whitelisted, cleaned_markup)
 
     return cleaned_markup
 
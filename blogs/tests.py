@@ -1,19 +1,35 @@
 import json
 import os
-from unittest import mock
+import time
+from array import array
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 from zoneinfo import ZoneInfo
 
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import Client, TestCase, override_settings
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client, TestCase, override_settings, skipUnlessDBFeature
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.safestring import SafeString
+from pygments import highlight
+import latex2mathml.converter
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 from blogs.forms import BlogForm, AdvancedSettingsForm
-from blogs.models import Blog, Post, Stylesheet
-from blogs.templatetags.custom_tags import apply_filters, safe_title, plain_title, markdown, markdown_renderer, replace_inline_latex, escape_currency, fix_links, clean, element_replacement, excluding_pre
+from blogs.models import Blog, DiscoverPost, FeedEntry, Hit, HitRollup, OnSiteCounter, PersistentStore, Post, Stylesheet, Subscriber, Upvote, VisitorRollup, VisitorSketch
+from blogs.random_pool import build_random_pool, sample_posts
+from blogs.scoring import post_score, rescore
+from blogs.utils.hll import HyperLogLog
+from blogs.utils.lru import LRUCache
+from blogs.templatetags.custom_tags import apply_filters, safe_title, plain_title, markdown, markdown_renderer, render_cache_key, replace_inline_latex, escape_currency, fix_links, clean, element_replacement, excluding_pre, get_adjacent_posts, get_lexer, highlight_cache, highlight_code, latex_to_mathml, local_render_cache, mathml_cache
 
 
 class SafeTitleTests(TestCase):
@@ -494,6 +510,7 @@ class DiscoverRandomFeedTests(TestCase):
                 make_discoverable=True,
                 content='x' * 200,
             )
+        build_random_pool()
 
     def test_random_feed_returns_200(self):
         response = self.client.get('/discover/?random=true')
@@ -529,17 +546,17 @@ class DiscoverRandomFeedTests(TestCase):
         self.assertNotIn('Next', content)
         self.assertNotIn('Previous', content)
 
-    def test_random_probes_are_batched(self):
-        """ID probes run as batched UNION queries, not one query per probe (N+1)."""
+    def test_random_posts_are_sampled_from_pool(self):
+        """Random posts are picked from the pool and loaded in one query, no ID probes."""
         from django.db import connection
         from django.test.utils import CaptureQueriesContext
         with CaptureQueriesContext(connection) as ctx:
             response = self.client.get('/discover/?random=true')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['posts']), 3)
-        # Old code ran up to 200 probe queries; batched it's at most
-        # 10 UNION queries plus a handful of others
-        self.assertLess(len(ctx.captured_queries), 20)
+        discover_queries = [q['sql'] for q in ctx.captured_queries if 'blogs_discoverpost' in q['sql']]
+        self.assertEqual(len(discover_queries), 1)
+        self.assertNotIn('RANDOM()', discover_queries[0].upper())
         # Queries must stay parseable by sqlparse (debug toolbar runs every
         # query through it, which raises above 10000 tokens)
         import sqlparse
@@ -922,6 +939,405 @@ class DiscoverFeedMarkdownTests(TestCase):
         self.assertNotIn('{{ post_published_date }}', content)
 
 
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class DiscoverTableTests(TestCase):
+    """Discover pages read from the DiscoverPost table, which saves keep in sync."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='discoveruser', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Discover Blog', subdomain='discoverblog', reviewed=True)
+        self.post = self.make_post('dt1')
+
+    def make_post(self, uid, **kwargs):
+        fields = {'title': f'Post {uid}', 'slug': uid, 'published_date': timezone.now(), 'content': 'x' * 200}
+        fields.update(kwargs)
+        return Post.objects.create(blog=self.blog, uid=uid, **fields)
+
+    def entry(self, post=None):
+        return DiscoverPost.objects.filter(pk=(post or self.post).pk).first()
+
+    def test_only_eligible_posts_have_entries(self):
+        self.make_post('short', content='Too short')
+        self.make_post('undiscoverable', make_discoverable=False)
+        self.make_post('draft', publish=False)
+        self.assertEqual(list(DiscoverPost.objects.values_list('slug', flat=True)), ['dt1'])
+
+        entry = self.entry()
+        self.assertEqual((entry.blog_url, entry.user_id), (self.blog.useful_domain, self.user.pk))
+
+    def test_post_and_blog_changes_are_synced(self):
+        self.post.title = 'Renamed'
+        self.post.hidden = True
+        self.post.save()
+        self.assertEqual((self.entry().title, self.entry().hidden), ('Renamed', True))
+
+        self.blog.domain = 'example.com'
+        self.blog.hidden = True
+        self.blog.save()
+        self.assertEqual((self.entry().blog_url, self.entry().blog_hidden), ('https://example.com', True))
+
+        self.post.make_discoverable = False
+        self.post.save()
+        self.assertIsNone(self.entry())
+
+    def test_blocking_and_unreviewing_remove_entries(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.entry())
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertIsNotNone(self.entry())
+
+        self.blog.reviewed = False
+        self.blog.save()
+        self.assertIsNone(self.entry())
+
+    def test_upvotes_update_score(self):
+        for i in range(3):
+            Upvote.objects.create(post=self.post, hash_id=f'voter-{i}')
+        self.assertEqual(self.entry().upvotes, 3)
+
+        rescore([self.post.pk])
+        self.post.refresh_from_db()
+        self.assertEqual((self.entry().upvotes, self.entry().score), (3, self.post.score))
+
+    def test_discover_reads_only_the_table(self):
+        self.make_post('hidden', hidden=True)
+        self.make_post('scheduled', published_date=timezone.now() + timezone.timedelta(days=1))
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/discover/')
+        self.assertEqual([post.slug for post in response.context['posts']], ['dt1'])
+        self.assertContains(response, f'{self.blog.useful_domain}/dt1/')
+        self.assertFalse([q for q in ctx.captured_queries if 'blogs_post' in q['sql']])
+
+    def test_newest_and_feed(self):
+        self.make_post('dt2', published_date=timezone.now() - timezone.timedelta(days=1))
+        response = self.client.get('/discover/?newest=true')
+        self.assertEqual([post.slug for post in response.context['posts']], ['dt1', 'dt2'])
+
+        response = self.client.get('/discover/feed/?newest=true')
+        self.assertContains(response, f'{self.blog.useful_domain}/dt2/')
+
+    def test_rebuild_command(self):
+        from django.core.management import call_command
+        DiscoverPost.objects.all().delete()
+        Blog.objects.filter(pk=self.blog.pk).update(hidden=True)
+        call_command('sync_discover_posts', stdout=StringIO())
+        self.assertTrue(self.entry().blog_hidden)
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+@mock.patch('blogs.views.discover.cached_pages', -1)
+class KeysetPaginationTests(TestCase):
+    """Next/previous links seek by cursor, page numbers still work as an offset."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        user = User.objects.create_user(username='keysetuser', password='pass')
+        blog = Blog.objects.create(user=user, title='Keyset Blog', subdomain='keysetblog', reviewed=True)
+        now = timezone.now()
+        for i in range(45):
+            # Scores all tie at 0, pages have to fall back on the id
+            Post.objects.create(blog=blog, uid=f'ks{i}', title=f'Post {i}', slug=f'ks-{i}', published_date=now - timezone.timedelta(days=1 + i % 7), content='x' * 200)
+
+    def slugs(self, response):
+        return [post.slug for post in response.context['posts']]
+
+    def walk(self, params):
+        pages = []
+        response = self.client.get('/discover/', params)
+        while self.slugs(response):
+            pages.append(self.slugs(response))
+            response = self.client.get('/discover/', {**params, 'after': response.context['next_cursor'], 'page': len(pages)})
+        return pages
+
+    def assert_cursor_pages_match_page_numbers(self, params):
+        pages = self.walk(params)
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual(len({slug for page in pages for slug in page}), 45)
+        for number, page in enumerate(pages):
+            self.assertEqual(self.slugs(self.client.get('/discover/', {**params, 'page': number})), page)
+
+    def test_cursor_pages_match_page_numbers(self):
+        self.assert_cursor_pages_match_page_numbers({})
+
+    def test_newest_cursor_pages_match_page_numbers(self):
+        self.assert_cursor_pages_match_page_numbers({'newest': 'true'})
+
+    def test_previous_cursor(self):
+        first = self.client.get('/discover/', {'newest': 'true'})
+        second = self.client.get('/discover/', {'newest': 'true', 'after': first.context['next_cursor'], 'page': 1})
+        self.assertContains(second, f'before={second.context["previous_cursor"]}&page=0')
+        back = self.client.get('/discover/', {'newest': 'true', 'before': second.context['previous_cursor'], 'page': 0})
+        self.assertEqual(self.slugs(back), self.slugs(first))
+
+    def test_cursor_page_is_one_query(self):
+        first = self.client.get('/discover/')
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/discover/', {'after': first.context['next_cursor'], 'page': 1})
+        sql = [q['sql'] for q in ctx.captured_queries if 'blogs_discoverpost' in q['sql']]
+        self.assertEqual(len(sql), 1)
+        self.assertNotIn('OFFSET', sql[0])
+
+    def test_invalid_cursor_falls_back_to_page(self):
+        for cursor in ['nonsense', 'nan_1', '1.5_x', '']:
+            response = self.client.get('/discover/', {'after': cursor, 'page': 1})
+            self.assertEqual(len(self.slugs(response)), 20)
+
+    def test_feed_next_link(self):
+        import re
+        from blogs.utils.keyset import decode_cursor
+        from datetime import datetime
+        response = self.client.get('/discover/feed/', {'newest': 'true'})
+        link = re.search(r'href="https://bearblog.dev/discover/feed/\?newest=true&amp;after=([^"]+)" rel="next"', response.content.decode())
+        self.assertIsNotNone(decode_cursor(link.group(1), datetime))
+
+        response = self.client.get('/discover/feed/', {'newest': 'true', 'after': link.group(1)})
+        self.assertEqual(response.content.decode().count('<entry>'), 20)
+        self.assertNotIn('rel="next"', self.client.get('/discover/feed/', {'type': 'rss'}).content.decode())
+
+    @skipUnless(connection.vendor == 'postgresql', 'Search needs Postgres')
+    def test_search_cursor(self):
+        first = self.client.get('/discover/search/', {'query': 'post'})
+        second = self.client.get('/discover/search/', {'query': 'post', 'after': first.context['next_cursor'], 'page': 1})
+        self.assertEqual(len(self.slugs(first)), 20)
+        self.assertEqual(self.slugs(second), self.slugs(self.client.get('/discover/search/', {'query': 'post', 'page': 1})))
+        self.assertFalse(set(self.slugs(first)) & set(self.slugs(second)))
+
+    def test_cursor_round_trip(self):
+        from blogs.utils.keyset import decode_cursor, encode_cursor
+        from datetime import datetime
+        when = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(when, 7), datetime), (when, 7))
+        self.assertEqual(decode_cursor(encode_cursor(0.1 + 0.2, 8), float), (0.1 + 0.2, 8))
+        self.assertIsNone(decode_cursor(None, float))
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class DiscoverCacheTests(TestCase):
+    """Anonymous discover pages and the discover feed are served from rendered fragments."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='cacheuser', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Cache Blog', subdomain='cacheblog', reviewed=True)
+        self.post = Post.objects.create(blog=self.blog, uid='dc1', title='Cached Post', slug='cached-post', published_date=timezone.now(), content='x' * 200)
+
+    def discover_queries(self, url):
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        return response, [q['sql'] for q in ctx.captured_queries if 'blogs_discoverpost' in q['sql'] or 'blogs_post' in q['sql']]
+
+    def test_page_is_rendered_once(self):
+        response, queries = self.discover_queries('/discover/')
+        self.assertContains(response, 'Cached Post')
+        self.assertTrue(queries)
+
+        response, queries = self.discover_queries('/discover/')
+        self.assertContains(response, 'Cached Post')
+        self.assertEqual(queries, [])
+
+    def test_saves_show_up_once_the_fragment_is_old(self):
+        self.client.get('/discover/')
+        Post.objects.create(blog=self.blog, uid='dc2', title='Fresh Post', slug='fresh-post', published_date=timezone.now(), content='x' * 200)
+        self.assertNotContains(self.client.get('/discover/'), 'Fresh Post')
+
+        with mock.patch('blogs.views.discover.refresh_after', 0):
+            self.assertContains(self.client.get('/discover/'), 'Fresh Post')
+
+    def test_batches_show_up_at_once(self):
+        self.client.get('/discover/')
+        # Votes wait for the rescore batch
+        from blogs.scoring import RescoreQueue
+        with mock.patch('blogs.scoring.rescore_queue', RescoreQueue()), mock.patch('blogs.scoring.executor.schedule'):
+            for i in range(2):
+                Upvote.objects.create(post=self.post, hash_id=f'dc-vote-{i}')
+        _, queries = self.discover_queries('/discover/')
+        self.assertEqual(queries, [])
+
+        rescore([self.post.pk])
+        _, queries = self.discover_queries('/discover/')
+        self.assertTrue(queries)
+
+    def test_staff_hiding_shows_up_at_once(self):
+        self.client.get('/discover/')
+        User.objects.create_user(username='cachestaff', password='pass', is_staff=True)
+        self.client.login(username='cachestaff', password='pass')
+        self.client.post('/discover/', {'hide-post': self.post.pk})
+        self.client.logout()
+
+        # Not served stale while a background refresh catches up
+        with mock.patch('blogs.views.discover.executor') as executor:
+            executor.background = True
+            self.assertNotContains(self.client.get('/discover/'), 'Cached Post')
+        executor.submit.assert_not_called()
+
+    @mock.patch('blogs.views.discover.posts_per_page', 1)
+    @mock.patch('blogs.views.discover.cached_pages', 1)
+    def test_rescores_below_the_cached_pages_keep_the_cache(self):
+        from blogs.views.discover import ranking_changed
+        # Blogs posting more than 3 times in 12 hours drop out, the cached post is the third
+        DiscoverPost.objects.filter(pk=self.post.pk).update(score=1000)
+        for i, score in enumerate([999, 0]):
+            post = Post.objects.create(blog=self.blog, uid=f'rk{i}', title=f'Ranked {i}', slug=f'ranked-{i}', published_date=timezone.now(), content='x' * 200)
+            DiscoverPost.objects.filter(pk=post.pk).update(score=score)
+        low = DiscoverPost.objects.get(slug='ranked-1')
+
+        self.assertFalse(ranking_changed([{'id': low.pk, 'old_score': 0, 'score': 5}]))
+        self.assertTrue(ranking_changed([{'id': low.pk, 'old_score': 0, 'score': 2000}]))
+        self.assertFalse(ranking_changed([{'id': low.pk, 'old_score': 0, 'score': 0}]))
+
+    def test_cursor_pages_are_not_cached(self):
+        from blogs.utils.keyset import encode_cursor
+        url = '/discover/?after=' + encode_cursor(self.post.score + 1, self.post.pk + 1)
+        self.client.get(url)
+        _, queries = self.discover_queries(url)
+        self.assertTrue(queries)
+
+    def test_stale_fragment_refreshes_in_background(self):
+        self.client.get('/discover/')
+        self.post.title = 'Renamed Post'
+        self.post.save()
+
+        with mock.patch('blogs.views.discover.executor') as executor, mock.patch('blogs.views.discover.refresh_after', 0):
+            executor.background = True
+            for _ in range(3):
+                self.assertContains(self.client.get('/discover/'), 'Cached Post')
+        executor.submit.assert_called_once()
+
+        _, fn, *args = executor.submit.call_args.args
+        fn(*args)
+        self.assertContains(self.client.get('/discover/'), 'Renamed Post')
+
+    def test_logged_in_pages_are_not_cached(self):
+        self.client.login(username='cacheuser', password='pass')
+        self.client.get('/discover/')
+        _, queries = self.discover_queries('/discover/')
+        self.assertTrue(queries)
+
+    def test_feed_renders_once(self):
+        with mock.patch('blogs.views.discover.markdown', return_value='<p>Rendered</p>') as render:
+            for _ in range(3):
+                self.assertContains(self.client.get('/discover/feed/'), 'Rendered')
+        self.assertEqual(render.call_count, 1)
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class RescoreTests(TestCase):
+    """Upvotes only bump a counter, rescore_posts recounts and rescores in batches."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='rescoreuser', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Rescore Blog', subdomain='rescoreblog', reviewed=True)
+        self.posts = [
+            Post.objects.create(blog=self.blog, uid=f'rs{i}', title=f'Rescore {i}', slug=f'rescore-{i}',
+                                published_date=timezone.now() - timezone.timedelta(days=i), content='x' * 200)
+            for i in range(3)
+        ]
+        # Votes wait for the batch until a test flushes the queue
+        from blogs.scoring import RescoreQueue
+        self.queue = RescoreQueue()
+        for patcher in [mock.patch('blogs.scoring.rescore_queue', self.queue), mock.patch('blogs.scoring.executor.schedule')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def vote(self, post, count):
+        for i in range(count):
+            Upvote.objects.create(post=post, hash_id=f'{post.uid}-{i}')
+
+    def test_votes_are_rescored_together(self):
+        from blogs.scoring import executor
+        self.vote(self.posts[0], 2)
+        self.vote(self.posts[1], 3)
+        executor.schedule.assert_called_once_with(60, 'discover', self.queue.flush, refused=self.queue.retry)
+
+        self.queue.flush()
+        for post in self.posts[:2]:
+            post.refresh_from_db()
+            self.assertAlmostEqual(post.score, post_score(post.upvotes, 0, post.first_published_at))
+
+    def test_refused_and_failed_batches_keep_their_posts(self):
+        from blogs.scoring import executor
+        self.vote(self.posts[0], 2)
+        executor.schedule.call_args.kwargs['refused']()
+        self.assertEqual(executor.schedule.call_count, 2)
+
+        with mock.patch('blogs.scoring.rescore', side_effect=ConnectionError('down')):
+            with self.assertRaises(ConnectionError):
+                self.queue.flush()
+        self.queue.flush()
+        post = Post.objects.get(pk=self.posts[0].pk)
+        self.assertAlmostEqual(post.score, post_score(2, 0, post.first_published_at))
+
+    def test_saving_a_stale_post_keeps_its_votes(self):
+        post = Post.objects.get(pk=self.posts[0].pk)
+        self.vote(self.posts[0], 2)
+        post.title = 'Edited'
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.upvotes, 2)
+        self.assertAlmostEqual(post.score, post_score(2, 0, post.first_published_at))
+
+    def test_post_score_matches_formula(self):
+        from math import log
+        posted_at = timezone.now()
+        expected = log(30 + 2, 10) + (posted_at.timestamp() - 1577811600) / (14 * 86400)
+        self.assertAlmostEqual(post_score(45, 2, posted_at), expected)
+        self.assertIsNone(post_score(1, 5, posted_at))
+        self.assertIsNone(post_score(3, -5, posted_at))
+
+    def test_upvote_counts_without_scoring(self):
+        post = self.posts[0]
+        self.vote(post, 3)
+        post.refresh_from_db()
+        self.assertEqual((post.upvotes, post.score), (3, 0))
+
+    def test_rescore_recounts_and_scores(self):
+        self.vote(self.posts[0], 4)
+        self.vote(self.posts[1], 2)
+        Post.objects.filter(pk=self.posts[1].pk).update(upvotes=9)
+
+        changes = rescore([post.pk for post in self.posts])
+        self.assertEqual({change['id'] for change in changes}, {self.posts[0].pk, self.posts[1].pk})
+
+        for post, upvotes in zip(self.posts[:2], [4, 2]):
+            post.refresh_from_db()
+            entry = DiscoverPost.objects.get(pk=post.pk)
+            self.assertEqual((post.upvotes, entry.upvotes), (upvotes, upvotes))
+            self.assertAlmostEqual(post.score, post_score(upvotes, 0, post.first_published_at))
+            self.assertEqual(entry.score, post.score)
+
+        self.assertEqual(rescore([post.pk for post in self.posts]), [])
+
+    def test_batch_query_count_is_constant(self):
+        for post in self.posts:
+            self.vote(post, 2)
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            rescore([post.pk for post in self.posts])
+        # One bulk update each for posts and entries, however many posts changed
+        writes = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "blogs_')]
+        self.assertEqual(len(writes), 2)
+
+    def test_dry_run_reports_without_writing(self):
+        from django.core.management import call_command
+        self.vote(self.posts[2], 5)
+        out = StringIO()
+        call_command('rescore_posts', '--dry-run', stdout=out)
+        self.assertIn('Rescore 2', out.getvalue())
+        self.assertIn('rank', out.getvalue())
+        self.assertEqual(Post.objects.get(pk=self.posts[2].pk).score, 0)
+
+        call_command('rescore_posts', stdout=StringIO())
+        self.assertGreater(Post.objects.get(pk=self.posts[2].pk).score, 0)
+
+
 class ScriptTagTests(TestCase):
     """Verify that <script> blocks are not corrupted by markdown text processing."""
 
@@ -1135,7 +1551,7 @@ class ContentTypeTests(TestCase):
 
     def _read_zip(self, response):
         import zipfile, io
-        return zipfile.ZipFile(io.BytesIO(response.content))
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
 
     def test_export_returns_zip(self):
         response = self._get_export()
@@ -1195,6 +1611,874 @@ class ContentTypeTests(TestCase):
 
 
 @mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class StreamingExportTests(TestCase):
+    """Exports are written out as they're read, not built up in memory."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='export_user', password='pass')
+        self.user.settings.upgraded = True
+        self.user.settings.save()
+        self.blog = Blog.objects.create(user=self.user, title='Export Blog', subdomain='exportblog')
+        for i in range(3):
+            Post.objects.create(
+                blog=self.blog, uid=f'ex{i}', title=f'Post {i}', slug='same' if i else 'first',
+                published_date=timezone.now(), content=f'Content {i}',
+            )
+        Subscriber.objects.create(blog=self.blog, email_address='a@example.com')
+        Subscriber.objects.create(blog=self.blog, email_address='b@example.com')
+        self.client.login(username='export_user', password='pass')
+
+    def body(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    def test_posts_csv(self):
+        response = self.client.get('/exportblog/dashboard/settings/', {'export-csv': 'true'})
+        lines = self.body(response).decode('utf-8').splitlines()
+        self.assertTrue(lines[0].startswith('\ufeffuid,title,slug'))
+        self.assertEqual(len(lines), 4)
+
+    def test_email_exports(self):
+        response = self.client.get('/exportblog/dashboard/email-list/', {'export-txt': '1'})
+        self.assertEqual(self.body(response), b'a@example.com\nb@example.com\n')
+        response = self.client.get('/exportblog/dashboard/email-list/', {'export-csv': '1'})
+        self.assertIn('a@example.com', self.body(response).decode('utf-8'))
+
+    def test_markdown_zip_is_written_per_post(self):
+        import zipfile
+        response = self.client.get('/exportblog/dashboard/settings/', {'export-md': 'true'})
+        chunks = list(response.streaming_content)
+        # One chunk per post, then the central directory
+        self.assertEqual(len(chunks), 4)
+        names = zipfile.ZipFile(BytesIO(b''.join(chunks))).namelist()
+        self.assertEqual(sorted(names), ['first.md', 'same-2.md', 'same.md'])
+
+
+@skipUnless(mock_aws, 'Backup tests need moto')
+class IncrementalBackupTests(TestCase):
+    """Backups only upload posts and settings that changed, against a moto S3."""
+
+    def setUp(self):
+        import boto3
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='bear-backup')
+
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='backup_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Backup Blog', subdomain='backupblog', reviewed=True)
+        self.posts = [
+            Post.objects.create(blog=self.blog, uid=f'bk{i}', title=f'Post {i}', slug=f'post-{i}', published_date=timezone.now(), content=f'Content {i}')
+            for i in range(3)
+        ]
+
+    def backup(self):
+        from blogs.backup import backup_blog
+        result = backup_blog(self.blog, self.s3)
+        self.assertTrue(result['success'], result)
+        return result['uploaded_files']
+
+    def read(self, key):
+        return json.loads(self.s3.get_object(Bucket='bear-backup', Key=key)['Body'].read())
+
+    def test_only_changes_are_uploaded(self):
+        uploaded = self.backup()
+        # Three posts, the blog, the day's manifest and the latest one
+        self.assertEqual(len(uploaded), 6)
+        self.assertEqual(self.backup(), [])
+
+        # Votes aren't content
+        Post.objects.filter(pk=self.posts[0].pk).update(upvotes=10, score=3)
+        self.assertEqual(self.backup(), [])
+
+        self.posts[1].content = 'Fixed a typo'
+        self.posts[1].save()
+        uploaded = self.backup()
+        self.assertEqual(len(uploaded), 3)
+        self.assertTrue(uploaded[0].startswith('content/backupblog/posts/bk1/'))
+
+        manifest = self.read('content/backupblog/manifest.json')
+        self.assertEqual(manifest, self.read(f'content/backupblog/{manifest["backup_date"]}/manifest.json'))
+        self.assertEqual(self.read(manifest['posts']['bk1'])['content'], 'Fixed a typo')
+        self.assertEqual(self.read(manifest['blog'])['subdomain'], 'backupblog')
+
+    def test_export_to_csv(self):
+        import csv
+        import tempfile
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        self.backup()
+        with tempfile.TemporaryDirectory() as output:
+            with mock.patch('blogs.backup.get_s3_client', return_value=self.s3):
+                call_command('export_backup', 'backupblog', '--output', output, stdout=StringIO())
+                with self.assertRaises(CommandError):
+                    call_command('export_backup', 'backupblog', '--date', '2001-01-01', '--output', output, stdout=StringIO())
+            with open(os.path.join(output, 'posts.csv'), encoding='utf-8-sig') as f:
+                self.assertEqual([row['title'] for row in csv.DictReader(f)], ['Post 0', 'Post 1', 'Post 2'])
+            with open(os.path.join(output, 'blog.csv'), encoding='utf-8-sig') as f:
+                self.assertEqual(next(csv.DictReader(f))['subdomain'], 'backupblog')
+
+    def test_failures_raise_for_retry(self):
+        from botocore.exceptions import EndpointConnectionError
+        from blogs.backup import backup_blog
+        with mock.patch.object(self.s3, 'put_object', side_effect=EndpointConnectionError(endpoint_url='https://fra1')):
+            with self.assertRaises(EndpointConnectionError):
+                backup_blog(self.blog, self.s3)
+        self.assertEqual(len(self.backup()), 6)
+
+    @mock.patch.dict(os.environ, {'ENVIRONMENT': 'production'})
+    def test_saves_are_coalesced(self):
+        from blogs.backup import _pending, _run_backup, backup_in_thread
+        with mock.patch('blogs.backup.executor.schedule') as schedule:
+            for _ in range(10):
+                backup_in_thread(self.blog)
+        schedule.assert_called_once()
+        self.assertEqual(schedule.call_args.args, (60, 'backup', _run_backup, self.blog.pk))
+        self.assertIn(self.blog.pk, _pending)
+
+        with mock.patch('blogs.backup.get_s3_client', return_value=self.s3):
+            _run_backup(self.blog.pk)
+        self.assertNotIn(self.blog.pk, _pending)
+        self.assertIn('posts', self.read('content/backupblog/manifest.json'))
+
+    @mock.patch.dict(os.environ, {'ENVIRONMENT': 'production'})
+    def test_inline_backup_clears_pending(self):
+        from blogs.backup import _pending, backup_in_thread
+        with mock.patch('blogs.backup.get_s3_client', return_value=self.s3):
+            for _ in range(2):
+                self.assertTrue(backup_in_thread(self.blog))
+        self.assertNotIn(self.blog.pk, _pending)
+        self.assertIn('posts', self.read('content/backupblog/manifest.json'))
+
+    @mock.patch.dict(os.environ, {'ENVIRONMENT': 'production'})
+    def test_refused_backup_is_forgotten(self):
+        from blogs.backup import _pending, backup_in_thread
+        self.addCleanup(_pending.clear)
+        with mock.patch('blogs.backup.executor.schedule') as schedule:
+            backup_in_thread(self.blog)
+            schedule.call_args.kwargs['refused']()
+            self.assertNotIn(self.blog.pk, _pending)
+            backup_in_thread(self.blog)
+        self.assertEqual(schedule.call_count, 2)
+
+
+class TaskExecutorTests(TestCase):
+    """Side-effect work runs on bounded per-type queues instead of a thread per call."""
+
+    def make_executor(self, **kwargs):
+        from blogs.tasks import TaskExecutor, TaskQueue
+        return TaskExecutor([TaskQueue('test', **kwargs)], background=True)
+
+    def test_failed_tasks_are_retried(self):
+        executor = self.make_executor(retries=2, backoff=0)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError('try again')
+
+        executor.submit('test', flaky)
+        executor.drain(timeout=2)
+        stats = executor.stats()['queues']['test']
+        self.assertEqual(len(calls), 3)
+        self.assertEqual((stats['completed'], stats['retried'], stats['failed']), (1, 2, 0))
+
+    def test_gives_up_after_retries(self):
+        executor = self.make_executor(retries=1, backoff=0)
+        executor.submit('test', mock.Mock(side_effect=ConnectionError('down')))
+        executor.drain(timeout=2)
+        self.assertEqual(executor.stats()['queues']['test']['failed'], 1)
+
+    def test_full_queue_drops(self):
+        executor = self.make_executor(maxsize=2)
+        with mock.patch.object(executor.queues['test'], 'start'):
+            results = [executor.submit('test', print) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(executor.stats()['queues']['test']['dropped'], 1)
+
+    def test_scheduled_tasks_run_later(self):
+        executor = self.make_executor()
+        task = mock.Mock()
+        executor.schedule(0.1, 'test', task, 'blog')
+        self.assertEqual(executor.stats()['delayed'], 1)
+        task.assert_not_called()
+
+        for _ in range(40):
+            if task.called:
+                break
+            time.sleep(0.05)
+        executor.drain(timeout=2)
+        task.assert_called_once_with('blog')
+
+    def test_refused_scheduled_tasks_are_reported(self):
+        executor = self.make_executor()
+        refused = mock.Mock()
+        with mock.patch.object(executor.queues['test'], 'submit', return_value=False):
+            executor.schedule(0, 'test', print, refused=refused)
+            for _ in range(40):
+                if refused.called:
+                    break
+                time.sleep(0.05)
+        refused.assert_called_once_with()
+
+    def test_inline_when_not_in_background(self):
+        from blogs.tasks import TaskExecutor, TaskQueue
+        executor = TaskExecutor([TaskQueue('test')], background=False)
+        task = mock.Mock(side_effect=[ConnectionError('down')])
+        self.assertTrue(executor.submit('test', task))
+        task.assert_called_once()
+        self.assertEqual(executor.stats()['queues']['test']['submitted'], 0)
+
+    def test_full_media_queue_uploads_inline(self):
+        from blogs.views.media import upload_files
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        blog = Blog.objects.create(user=User.objects.create_user(username='mediaq'), title='Media', subdomain='mediaq')
+        upload = lambda: upload_files(blog, [SimpleUploadedFile('photo.svg', b'<svg/>', content_type='image/svg+xml')])
+
+        with mock.patch('blogs.views.media.executor.submit', return_value=False), mock.patch('blogs.views.media.upload_to_s3') as upload_to_s3:
+            links = upload()
+        upload_to_s3.assert_called_once()
+        self.assertEqual(list(blog.media.values_list('url', flat=True)), links)
+
+        with mock.patch('blogs.views.media.executor.submit', return_value=False), mock.patch('blogs.views.media.upload_to_s3', side_effect=ConnectionError('down')):
+            links = upload()
+        self.assertTrue(links[0].startswith('Error:'))
+        self.assertEqual(blog.media.count(), 1)
+
+    def test_background_follows_setting(self):
+        from blogs.tasks import TaskExecutor, TaskQueue
+        executor = TaskExecutor([TaskQueue('test')])
+        self.assertFalse(executor.background)
+        with self.settings(BACKGROUND_TASKS=True):
+            self.assertTrue(executor.background)
+
+    def test_shutdown_stops_workers(self):
+        executor = self.make_executor()
+        task = mock.Mock()
+        executor.submit('test', task)
+        executor.shutdown(timeout=2)
+        task.assert_called_once()
+
+        queue = executor.queues['test']
+        for _ in range(40):
+            if not queue._threads:
+                break
+            time.sleep(0.05)
+        self.assertEqual(queue._threads, [])
+
+    @mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver', 'STAFF_API_KEY': 'test-key'})
+    def test_stats_endpoint(self):
+        url = reverse('staff_api_tasks')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        response = self.client.get(url, HTTP_X_API_KEY='test-key')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('email', response.json()['queues'])
+
+
+@mock.patch.dict(os.environ, {'ENVIRONMENT': 'production', 'CLOUDFLARE_API_KEY': 'key', 'CLOUDFLARE_EMAIL': 'bear@example.com', 'CLOUDFLARE_ZONE_ID': 'zone'})
+class CloudflarePurgeTests(TestCase):
+    """Cache purges are collected for a few seconds and sent as multi-tag requests."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import threading
+
+        received = cls.received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+                body = json.dumps({'success': True}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.api_url = f'http://127.0.0.1:{cls.server.server_port}/client/v4'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        from blogs.cloudflare import PurgeQueue
+        self.received.clear()
+        self.queue = PurgeQueue()
+        patcher = mock.patch('blogs.cloudflare.CLOUDFLARE_API_URL', self.api_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_saves_share_one_request(self):
+        with mock.patch('blogs.cloudflare.executor.schedule') as schedule:
+            for subdomain in ['bear', 'Bear', 'cub', 'bear']:
+                self.queue.add(subdomain)
+        schedule.assert_called_once()
+
+        self.queue.flush()
+        self.assertEqual(self.received, [('/client/v4/zones/zone/purge_cache', {'tags': ['bear', 'cub']})])
+        self.assertEqual(self.queue.stats(), {'pending': 0, 'added': 4, 'flushed_tags': 2, 'requests': 1})
+
+    def test_respects_tags_per_request(self):
+        from blogs.cloudflare import TAGS_PER_REQUEST
+        with mock.patch('blogs.cloudflare.executor.schedule'):
+            self.queue.add(*[f'blog-{i:03}' for i in range(TAGS_PER_REQUEST * 2 + 5)])
+        self.queue.flush()
+        self.assertEqual([len(body['tags']) for _, body in self.received], [TAGS_PER_REQUEST, TAGS_PER_REQUEST, 5])
+
+    def test_full_queue_keeps_tags(self):
+        with mock.patch('blogs.cloudflare.executor.schedule') as schedule:
+            self.queue.add('bear')
+            # The flush itself was refused
+            schedule.call_args.kwargs['refused']()
+            self.assertEqual(schedule.call_count, 2)
+
+            with mock.patch('blogs.cloudflare.executor.submit', return_value=False):
+                self.queue.flush()
+            self.assertEqual(schedule.call_count, 3)
+        self.assertEqual(self.queue.stats()['pending'], 1)
+
+        self.queue.flush()
+        self.assertEqual(self.received, [('/client/v4/zones/zone/purge_cache', {'tags': ['bear']})])
+
+    def test_failed_purge_raises_for_retry(self):
+        from blogs.cloudflare import purge_tags
+        with mock.patch('blogs.cloudflare.CLOUDFLARE_API_URL', 'http://127.0.0.1:1'):
+            with self.assertRaises(Exception):
+                purge_tags(['bear'])
+
+    def test_command_batches_live_posts(self):
+        from django.core.management import call_command
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        with mock.patch('blogs.cloudflare.executor.schedule'):
+            for name in ['purgeone', 'purgetwo']:
+                blog = Blog.objects.create(user=User.objects.create_user(username=name), title=name, subdomain=name)
+                for i in range(3):
+                    Post.objects.create(blog=blog, uid=f'{name}{i}', title=f'Post {i}', slug=f'post-{i}', published_date=timezone.now(), content='Live')
+        call_command('invalidate_cache', stdout=StringIO())
+        self.assertEqual(self.received, [('/client/v4/zones/zone/purge_cache', {'tags': ['purgeone', 'purgetwo']})])
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class HitQueueTests(TestCase):
+    """The hit endpoint enqueues, a background writer batches the inserts."""
+
+    def setUp(self):
+        from blogs.hits import HitQueue
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='hitq_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Hit Blog', subdomain='hitblog')
+        self.post = Post.objects.create(
+            blog=self.blog, uid='hq1', title='Hit Post', slug='hit-post',
+            published_date=timezone.now(), content='Test content',
+        )
+        self.queue = HitQueue(maxsize=5, batch_size=3, background=True)
+
+    def visit(self, **overrides):
+        hit = {'blog': 'hitblog', 'post': 'hq1', 'hash_id': 'abc', 'referrer': '', 'country': 'Test', 'device': 'Linux', 'browser': 'Firefox'}
+        hit.update(overrides)
+        return hit
+
+    @mock.patch('blogs.views.analytics.get_country', return_value={'country_name': 'Test'})
+    @mock.patch.dict(os.environ, {'SALT': 'test-salt'})
+    def test_endpoint_only_enqueues(self, mock_country):
+        with mock.patch('blogs.views.analytics.hit_queue', self.queue), mock.patch.object(self.queue, 'start'):
+            with self.assertNumQueries(0):
+                response = self.client.get('/hit/', {'blog': 'hitblog', 'score': '100', 'token': 'hq1'}, HTTP_USER_AGENT='Mozilla/5.0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.queue.stats()['queued'], 1)
+
+        self.queue.flush()
+        hit = Hit.objects.get()
+        self.assertEqual((hit.blog, hit.post, hit.country), (self.blog, self.post, 'Test'))
+
+    def test_batch_write_queries(self):
+        with mock.patch.object(self.queue, 'start'):
+            for i in range(3):
+                self.queue.put(self.visit(hash_id=f'visitor-{i}', post=None if i == 0 else 'hq1'))
+        # Blog lookup, post lookup, existing visits, one insert, then the visitor sketches
+        # (savepoint, insert missing, lock, update, release) and the on site counter
+        with self.assertNumQueries(10):
+            self.queue.flush()
+        self.assertEqual(Hit.objects.count(), 3)
+        self.assertEqual(Hit.objects.filter(post__isnull=True).count(), 1)
+        self.assertEqual(self.queue.stats()['batches'], 1)
+
+    def test_unknown_blog_is_skipped(self):
+        with mock.patch.object(self.queue, 'start'):
+            self.queue.put(self.visit(blog='nosuchblog'))
+        self.queue.flush()
+        self.assertFalse(Hit.objects.exists())
+
+    def test_full_queue_drops_and_counts(self):
+        with mock.patch.object(self.queue, 'start'):
+            results = [self.queue.put(self.visit(hash_id=str(i))) for i in range(7)]
+        self.assertEqual(results.count(False), 2)
+        stats = self.queue.stats()
+        self.assertEqual((stats['dropped'], stats['high_water'], stats['enqueued']), (2, 5, 5))
+        self.queue.flush()
+        self.assertEqual(Hit.objects.count(), 5)
+
+    def test_inline_mode_writes_immediately(self):
+        from blogs.hits import HitQueue
+        queue = HitQueue(background=False)
+        queue.put(self.visit())
+        self.assertEqual(Hit.objects.count(), 1)
+
+    @skipUnlessDBFeature('supports_nulls_distinct_unique_constraints', 'supports_partial_indexes')
+    def test_duplicate_visits_are_ignored(self):
+        with mock.patch.object(self.queue, 'start'):
+            self.queue.put(self.visit(post=None))
+            self.queue.put(self.visit(post=None))
+            self.queue.put(self.visit(post=None, hash_id='scrubbed'))
+            self.queue.put(self.visit(post=None, hash_id='scrubbed'))
+        self.queue.flush()
+        self.assertEqual(Hit.objects.count(), 3)
+
+    @mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver', 'STAFF_API_KEY': 'test-key'})
+    def test_staff_api_stats(self):
+        self.assertEqual(self.client.get('/staff-api/hit-queue/').status_code, 401)
+        response = self.client.get('/staff-api/hit-queue/', HTTP_X_API_KEY='test-key')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('dropped', response.json())
+        self.assertIn('hit_rate', response.json()['user_agent_cache'])
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class AnalyticsRollupTests(TestCase):
+    """The dashboard reads closed days from the rollup and gets the same numbers."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='rollup_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Rollup Blog', subdomain='rollupblog')
+        self.post = Post.objects.create(
+            blog=self.blog, uid='ru1', title='Rollup Post', slug='rollup-post',
+            published_date=timezone.now() - timezone.timedelta(days=10), content='Test content',
+        )
+        visits = [
+            # days ago, visitor, post, referrer, device
+            (3, 'a', None, 'https://news.ycombinator.com/', 'Linux'),
+            (3, 'a', self.post, 'https://news.ycombinator.com/', 'Linux'),
+            (3, 'b', self.post, '', 'Mac OS'),
+            (2, 'c', self.post, 'https://lobste.rs/', 'Linux'),
+            (0, 'd', None, '', 'Windows'),
+            (0, 'd', self.post, 'https://lobste.rs/', 'Windows'),
+        ]
+        for days_ago, visitor, post, referrer, device in visits:
+            hit = Hit.objects.create(
+                blog=self.blog, post=post, hash_id=f'{visitor}-{days_ago}', referrer=referrer,
+                country='Test', device=device, browser='Firefox',
+            )
+            Hit.objects.filter(pk=hit.pk).update(created_date=timezone.now() - timezone.timedelta(days=days_ago))
+        self.client.login(username='rollup_user', password='pass')
+
+    def dashboard(self, query=''):
+        response = self.client.get(f'/rollupblog/dashboard/analytics/?days=30{query}')
+        self.assertEqual(response.status_code, 200)
+        context = response.context
+        return {
+            key: context[key] for key in (
+                'unique_reads', 'unique_visitors', 'chart_data', 'posts', 'start_date',
+            )
+        } | {key: list(context[key]) for key in ('referrers', 'devices', 'browsers', 'countries')}
+
+    def test_rollup_matches_raw(self):
+        from django.core.management import call_command
+        queries = ('', '&post=rollup-post', '&post=homepage', '&referrer=https://lobste.rs/')
+        before = [self.dashboard(query) for query in queries]
+
+        call_command('rollup_hits', stdout=StringIO())
+        self.assertEqual(PersistentStore.load().hits_rolled_up_to, timezone.now().date() - timezone.timedelta(days=1))
+        self.assertEqual(HitRollup.objects.aggregate(total=Sum('hits'))['total'], 4)
+
+        for query, expected in zip(queries, before):
+            self.assertEqual(self.dashboard(query), expected, query)
+
+    def test_dashboard_reads_rollup_for_closed_days(self):
+        from django.core.management import call_command
+        call_command('rollup_hits', stdout=StringIO())
+        # Raw hits for closed days are no longer read
+        Hit.objects.filter(created_date__lt=timezone.now() - timezone.timedelta(days=1)).delete()
+        context = self.dashboard()
+        self.assertEqual(context['unique_reads'], 6)
+        self.assertEqual(context['unique_visitors'], 4)
+        self.assertEqual(context['referrers'][0], {'referrer': 'https://lobste.rs/', 'count': 2})
+
+    def test_rollup_is_incremental(self):
+        from django.core.management import call_command
+        call_command('rollup_hits', stdout=StringIO())
+        rows = HitRollup.objects.count()
+        with self.assertNumQueries(1):
+            # Only the watermark is read when there's nothing new to roll up
+            call_command('rollup_hits', stdout=StringIO())
+        self.assertEqual(HitRollup.objects.count(), rows)
+
+    def test_scrub_rolls_up_first(self):
+        from django.core.management import call_command
+        call_command('scrub_hash_ids', stdout=StringIO())
+        self.assertEqual(VisitorRollup.objects.aggregate(total=Sum('visitors'))['total'], 3)
+        self.assertFalse(Hit.objects.filter(created_date__lt=timezone.now() - timezone.timedelta(days=1)).exclude(hash_id='scrubbed').exists())
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class VisitorSketchTests(TestCase):
+    """Unique visitors come from per-day HyperLogLog sketches written by the hit queue."""
+
+    def setUp(self):
+        from blogs.hits import HitQueue
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='sketch_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Sketch Blog', subdomain='sketchblog')
+        self.post = Post.objects.create(
+            blog=self.blog, uid='sk1', title='Sketch Post', slug='sketch-post',
+            published_date=timezone.now() - timezone.timedelta(days=10), content='Test content',
+        )
+        self.queue = HitQueue(background=False)
+        self.client.login(username='sketch_user', password='pass')
+
+    def visit(self, visitor, post=None, referrer=''):
+        self.queue.put({
+            'blog': 'sketchblog', 'post': post, 'hash_id': visitor, 'referrer': referrer,
+            'country': 'Test', 'device': 'Linux', 'browser': 'Firefox',
+        })
+
+    def unique_visitors(self, query=''):
+        response = self.client.get(f'/sketchblog/dashboard/analytics/?days=30{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.context['unique_visitors']
+
+    def test_hyperloglog(self):
+        sketch = HyperLogLog()
+        for i in range(3):
+            sketch.add(f'visitor-{i}')
+            sketch.add(f'visitor-{i}')
+        self.assertEqual(sketch.count(), 3)
+
+        other = HyperLogLog()
+        for i in range(2, 5000):
+            other.add(f'visitor-{i}')
+        merged = HyperLogLog.from_bytes(sketch.to_bytes()).merge(other)
+        self.assertAlmostEqual(merged.count(), 5000, delta=5000 * 0.05)
+
+    def test_queue_writes_sketches(self):
+        self.visit('a')
+        self.visit('a', post='sk1', referrer='https://lobste.rs/')
+        self.visit('b', post='sk1')
+        sketches = {(sketch.scope, sketch.key): HyperLogLog.from_bytes(sketch.registers).count() for sketch in VisitorSketch.objects.all()}
+        self.assertEqual(sketches, {
+            ('blog', ''): 2,
+            ('post', 'homepage'): 1,
+            ('post', str(self.post.id)): 2,
+            ('referrer', 'https://lobste.rs/'): 1,
+            ('post_referrer', f'{self.post.id}|https://lobste.rs/'): 1,
+        })
+
+    def test_dashboard_reads_sketches(self):
+        self.visit('a')
+        self.visit('a', post='sk1', referrer='https://lobste.rs/')
+        self.visit('b', post='sk1', referrer='https://lobste.rs/')
+        self.visit('c', post='sk1')
+        # Raw hashes aren't needed once sketched
+        Hit.objects.update(hash_id='scrubbed')
+
+        self.assertEqual(self.unique_visitors(), 3)
+        self.assertEqual(self.unique_visitors('&post=sketch-post'), 3)
+        self.assertEqual(self.unique_visitors('&post=homepage'), 1)
+        self.assertEqual(self.unique_visitors('&referrer=https://lobste.rs/'), 2)
+        self.assertEqual(self.unique_visitors('&post=sketch-post&referrer=https://lobste.rs/'), 2)
+
+    def test_days_before_sketches_count_raw_hits(self):
+        old = Hit.objects.create(blog=self.blog, hash_id='old-visitor')
+        Hit.objects.filter(pk=old.pk).update(created_date=timezone.now() - timezone.timedelta(days=3))
+        self.visit('a')
+        self.visit('b')
+        self.assertEqual(self.unique_visitors(), 3)
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class OnSiteCounterTests(TestCase):
+    """"Reading now" comes from per-minute buckets kept by the hit queue."""
+
+    def setUp(self):
+        from blogs.hits import HitQueue
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='onsite_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='On Site Blog', subdomain='onsiteblog')
+        self.other = Blog.objects.create(
+            user=User.objects.create_user(username='onsite_other', password='pass'), title='Other', subdomain='onsiteother'
+        )
+        self.queue = HitQueue(background=False)
+        self.minute = 29000000
+
+    def visit(self, blog='onsiteblog', minute=0, visitor='a'):
+        with mock.patch('blogs.hits.time.time', return_value=(self.minute + minute) * 60 + 30):
+            self.queue.put({
+                'blog': blog, 'post': None, 'hash_id': f'{visitor}-{minute}', 'referrer': '',
+                'country': 'Test', 'device': 'Linux', 'browser': 'Firefox',
+            })
+
+    def on_site(self, minute=0, blog=None):
+        from blogs.hits import on_site_now
+        with mock.patch('blogs.hits.time.time', return_value=(self.minute + minute) * 60 + 45):
+            return on_site_now((blog or self.blog).id)
+
+    def test_sliding_window(self):
+        self.visit(minute=0)
+        self.visit(minute=0, visitor='b')
+        self.visit(minute=2)
+        self.visit(blog='onsiteother', minute=2)
+        self.assertEqual(self.on_site(minute=2), 3)
+        self.assertEqual(self.on_site(minute=2, blog=self.other), 1)
+        # The first minute falls out of the window
+        self.assertEqual(self.on_site(minute=4), 1)
+        self.assertEqual(self.on_site(minute=6), 0)
+
+        # Slots get reused once their minute is gone
+        self.visit(minute=5)
+        self.assertEqual(self.on_site(minute=5), 2)
+        self.assertEqual(OnSiteCounter.objects.filter(blog=self.blog).count(), 2)
+
+    def test_repeat_visits_are_not_counted(self):
+        self.visit(minute=0)
+        self.visit(minute=0)
+        self.assertEqual(self.on_site(minute=0), 1)
+        self.assertEqual(self.queue.stats()['written'], 1)
+
+    def test_late_batch_for_a_reused_slot_is_dropped(self):
+        self.visit(minute=5)
+        self.visit(minute=0)
+        self.assertEqual(self.on_site(minute=5), 1)
+
+    def test_json_endpoint(self):
+        self.visit(minute=0)
+        url = '/onsiteblog/dashboard/analytics/on-site/'
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.login(username='onsite_user', password='pass')
+        with mock.patch('blogs.hits.time.time', return_value=self.minute * 60 + 50):
+            response = self.client.get(url)
+        self.assertEqual(response.json(), {'on_site': 1})
+        self.assertEqual(self.client.get('/onsiteother/dashboard/analytics/on-site/').status_code, 404)
+
+    def test_filtered_views_count_their_own_hits(self):
+        post = Post.objects.create(blog=self.blog, uid='os1', title='On Site Post', slug='on-site-post', published_date=timezone.now(), content='x')
+        Hit.objects.create(blog=self.blog, post=post, hash_id='p', referrer='https://example.com/')
+        Hit.objects.create(blog=self.blog, hash_id='h')
+        old = Hit.objects.create(blog=self.blog, post=post, hash_id='old')
+        Hit.objects.filter(pk=old.pk).update(created_date=timezone.now() - timezone.timedelta(minutes=10))
+        OnSiteCounter.objects.create(blog=self.blog, slot=0, minute=int(time.time() // 60), hits=5)
+
+        self.client.login(username='onsite_user', password='pass')
+        url = '/onsiteblog/dashboard/analytics/on-site/'
+        counts = [self.client.get(url, params).json()['on_site'] for params in [
+            {}, {'post': 'on-site-post'}, {'post': 'homepage'}, {'referrer': 'https://example.com/'}, {'post': 'homepage', 'referrer': 'https://example.com/'},
+        ]]
+        self.assertEqual(counts, [5, 1, 1, 1, 0])
+
+
+class HitPathCacheTests(TestCase):
+    """GeoIP and user agent lookups on the hit path are cached per IP / user agent."""
+
+    FIREFOX = 'Mozilla/5.0 (X11; Linux x86_64; rv:131.0) Gecko/20100101 Firefox/131.0'
+
+    def setUp(self):
+        from blogs.helpers import country_cache, user_agent_cache
+        country_cache.clear()
+        user_agent_cache.clear()
+
+    def test_user_agents_are_parsed_once(self):
+        import httpagentparser
+        from blogs.helpers import parse_user_agent, user_agent_cache
+        with mock.patch('blogs.helpers.httpagentparser.detect', wraps=httpagentparser.detect) as detect:
+            self.assertEqual(parse_user_agent(self.FIREFOX), ('Linux', 'Firefox'))
+            self.assertEqual(parse_user_agent(self.FIREFOX), ('Linux', 'Firefox'))
+            self.assertEqual(detect.call_count, 1)
+
+            long_agent = self.FIREFOX + ' x' * 300
+            parse_user_agent(long_agent)
+            parse_user_agent(long_agent)
+            self.assertEqual(detect.call_count, 3)
+        self.assertEqual(user_agent_cache.stats()['hits'], 1)
+
+    @override_settings(GEOIP_CACHE=2)
+    def test_countries_are_looked_up_once(self):
+        import geoip2.errors
+        from blogs.helpers import country_cache, get_country
+        reader = mock.Mock()
+        reader.country.side_effect = lambda ip: {'country_name': 'Test'} if ip == '1.2.3.4' else (_ for _ in ()).throw(geoip2.errors.AddressNotFoundError(ip))
+        with mock.patch('blogs.helpers._geoip', None), mock.patch('blogs.helpers.GeoIP2', return_value=reader) as geoip:
+            for _ in range(3):
+                self.assertEqual(get_country('1.2.3.4'), {'country_name': 'Test'})
+                self.assertEqual(get_country('10.0.0.1'), {})
+        geoip.assert_called_once_with(cache=2)
+        self.assertEqual(reader.country.call_count, 2)
+        self.assertEqual(country_cache.stats()['hits'], 4)
+
+
+class HitPartitionTests(TestCase):
+    """Hits live in monthly partitions, old ones are detached once rolled up."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='partition_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Partition Blog', subdomain='partitionblog')
+
+    def partition_hits(self, now, *args):
+        from django.core.management import call_command
+        out = StringIO()
+        with self.at(now):
+            call_command('partition_hits', *args, stdout=out)
+        return out.getvalue()
+
+    def at(self, now):
+        from datetime import datetime, timezone as dt_timezone
+        return mock.patch('django.utils.timezone.now', return_value=datetime(*now, tzinfo=dt_timezone.utc))
+
+    def test_month_helpers(self):
+        from datetime import datetime, timezone as dt_timezone
+        from blogs.management.commands.partition_hits import add_months, month_start, parse_bound, partition_name
+        start = month_start(datetime(2026, 11, 18, 13, 5, tzinfo=dt_timezone.utc))
+        self.assertEqual(start, datetime(2026, 11, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(add_months(start, 2), datetime(2027, 1, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(add_months(start, -11), datetime(2025, 12, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(partition_name(start), 'blogs_hit_y2026m11')
+        self.assertEqual(parse_bound("'2026-11-01 00:00:00+00'"), start)
+        self.assertIsNone(parse_bound('MINVALUE'))
+
+    def test_scrub_only_touches_recent_months(self):
+        from django.core.management import call_command
+        old = Hit.objects.create(blog=self.blog, hash_id='old')
+        recent = Hit.objects.create(blog=self.blog, hash_id='recent')
+        Hit.objects.filter(pk=old.pk).update(created_date=timezone.now() - timezone.timedelta(days=90))
+        Hit.objects.filter(pk=recent.pk).update(created_date=timezone.now() - timezone.timedelta(days=2))
+
+        call_command('scrub_hash_ids', stdout=StringIO())
+        self.assertEqual(Hit.objects.get(pk=old.pk).hash_id, 'old')
+        self.assertEqual(Hit.objects.get(pk=recent.pk).hash_id, 'scrubbed')
+
+        call_command('scrub_hash_ids', '--all', stdout=StringIO())
+        self.assertEqual(Hit.objects.get(pk=old.pk).hash_id, 'scrubbed')
+
+    @skipUnless(connection.vendor != 'postgresql', 'Partitioning runs on Postgres')
+    def test_skipped_without_postgres(self):
+        self.assertIn('needs Postgres', self.partition_hits((2026, 1, 15)))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Partitioning needs Postgres')
+    def test_convert_and_detach(self):
+        from datetime import date
+        from django.core.management.base import CommandError
+        with self.at((2026, 1, 10)):
+            existing = Hit.objects.create(blog=self.blog, hash_id='before')
+
+        with self.assertRaises(CommandError):
+            self.partition_hits((2026, 1, 15))
+        # The bound check would refuse next month's hits if the month ended mid-conversion
+        with self.assertRaises(CommandError):
+            self.partition_hits((2026, 1, 31), '--convert')
+        out = self.partition_hits((2026, 1, 15), '--convert')
+        self.assertIn('Created blogs_hit_y2026m04', out)
+        self.assertIn('Created blogs_hit_y2026m11', self.partition_hits((2026, 8, 15)))
+
+        # Rows stay where they were, new ones get routed and deduped per partition
+        self.assertEqual(Hit.objects.get().pk, existing.pk)
+        with self.at((2026, 8, 15)):
+            Hit.objects.bulk_create([Hit(blog=self.blog, hash_id='after'), Hit(blog=self.blog, hash_id='after')], ignore_conflicts=True)
+        self.assertEqual(Hit.objects.count(), 2)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM blogs_hit WHERE hash_id = 'after'")
+            self.assertEqual(cursor.fetchone()[0], 'blogs_hit_y2026m08')
+
+        # Nothing is detached before it's rolled up
+        self.assertNotIn('Detached', self.partition_hits((2026, 8, 15), '--retain-months', '3'))
+        store = PersistentStore.load()
+        store.hits_rolled_up_to = date(2026, 5, 31)
+        store.save()
+        out = self.partition_hits((2026, 8, 15), '--retain-months', '3')
+        self.assertIn('Detached blogs_hit_legacy', out)
+        self.assertIn('Detached blogs_hit_y2026m04', out)
+        self.assertNotIn('blogs_hit_y2026m05', out)
+        self.assertEqual(Hit.objects.count(), 1)
+
+
+class ScrubHashIdsTests(TestCase):
+    """Scrubbing picks up from a watermark and works through hit ids in batches."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='scrub_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Scrub Blog', subdomain='scrubblog')
+
+    def hit(self, hours_ago):
+        hit = Hit.objects.create(blog=self.blog, hash_id=f'visitor-{Hit.objects.count()}')
+        Hit.objects.filter(pk=hit.pk).update(created_date=timezone.now() - timezone.timedelta(hours=hours_ago))
+        return hit
+
+    def scrub(self, *args):
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('scrub_hash_ids', *args, stdout=out)
+        return out.getvalue()
+
+    def scrubbed(self):
+        return set(Hit.objects.filter(hash_id='scrubbed').values_list('pk', flat=True))
+
+    def test_batches_up_to_the_first_recent_hit(self):
+        old = [self.hit(30) for _ in range(5)]
+        recent = self.hit(2)
+        # Written late, it's older than the recent hit before it
+        straggler = self.hit(30)
+
+        out = self.scrub('--batch-size', '2')
+        self.assertIn('Scrubbed 5 hash_ids', out)
+        self.assertIn('rows/s', out)
+        self.assertEqual(self.scrubbed(), {hit.pk for hit in old})
+        self.assertEqual(PersistentStore.load().hits_scrubbed_to_id, recent.pk - 1)
+
+        # Once the recent hit ages the straggler goes with it
+        Hit.objects.filter(pk=recent.pk).update(created_date=timezone.now() - timezone.timedelta(hours=30))
+        self.scrub()
+        self.assertEqual(self.scrubbed(), {hit.pk for hit in old} | {recent.pk, straggler.pk})
+        self.assertEqual(PersistentStore.load().hits_scrubbed_to_id, straggler.pk)
+
+    def test_resumes_from_the_watermark(self):
+        first = self.hit(30)
+        self.scrub()
+        Hit.objects.filter(pk=first.pk).update(hash_id='unscrubbed')
+        second = self.hit(30)
+
+        self.assertIn('Scrubbed 1 hash_ids', self.scrub())
+        self.assertEqual(self.scrubbed(), {second.pk})
+
+        self.scrub('--all')
+        self.assertEqual(self.scrubbed(), {first.pk, second.pk})
+
+    def test_batches_are_bounded_by_date(self):
+        from django.test.utils import CaptureQueriesContext
+        for _ in range(3):
+            self.hit(30)
+        with CaptureQueriesContext(connection) as ctx:
+            self.scrub('--batch-size', '1')
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "blogs_hit"')]
+        self.assertEqual(len(updates), 3)
+        # Partitions are by created_date, the id range alone can't prune them
+        for sql in updates:
+            self.assertIn('"blogs_hit"."created_date" >=', sql)
+
+
 class ResolveAddressTests(TestCase):
     def setUp(self):
         Stylesheet.objects.create(title='Default', identifier='default', css='')
@@ -1230,6 +2514,106 @@ class ResolveAddressTests(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'www.bearblog.dev,bearblog.dev'})
+class HostClassificationTests(TestCase):
+    def test_classify_host(self):
+        from blogs.utils.hosts import classify_host, CUSTOM_DOMAIN, MAIN_SITE, SUBDOMAIN
+        self.assertEqual(classify_host('bearblog.dev').kind, MAIN_SITE)
+        self.assertEqual(classify_host('WWW.bearblog.dev').kind, MAIN_SITE)
+        host = classify_host('Herman.bearblog.dev')
+        self.assertEqual((host.kind, host.subdomain), (SUBDOMAIN, 'herman'))
+        self.assertEqual(classify_host('herman.www.bearblog.dev').subdomain, 'herman')
+        host = classify_host('blog.example.com')
+        self.assertEqual((host.kind, host.subdomain), (CUSTOM_DOMAIN, None))
+        self.assertEqual(classify_host('notbearblog.dev').kind, CUSTOM_DOMAIN)
+
+    def test_request_host_is_classified_once(self):
+        from django.test import RequestFactory
+        from blogs.utils import hosts
+        request = RequestFactory().get('/', SERVER_NAME='herman.bearblog.dev')
+        with mock.patch.object(hosts, 'classify_host', wraps=hosts.classify_host) as mock_classify:
+            self.assertEqual(hosts.request_host(request).subdomain, 'herman')
+            self.assertIs(hosts.request_host(request), hosts.request_host(request))
+        mock_classify.assert_called_once()
+
+    def test_account_paths_blocked_off_main_site(self):
+        response = self.client.get('/accounts/login/', SERVER_NAME='herman.bearblog.dev')
+        self.assertEqual(response.status_code, 400)
+
+    def test_x_frame_options_only_on_main_site(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        user = User.objects.create_user(username='frame_user', password='pass')
+        Blog.objects.create(user=user, title='Frame Blog', subdomain='frameblog')
+        self.assertEqual(self.client.get('/', SERVER_NAME='bearblog.dev')['X-Frame-Options'], 'DENY')
+        self.assertNotEqual(self.client.get('/', SERVER_NAME='frameblog.bearblog.dev').get('X-Frame-Options'), 'DENY')
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class HostCacheTests(TestCase):
+    """resolve_address caches host -> blog id, including misses."""
+
+    def setUp(self):
+        from blogs.views.blog import host_cache
+        host_cache.clear()
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='hostcache_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Host Blog', subdomain='hostblog', domain='hostblog.example.com')
+
+    def resolve(self, host):
+        from django.test import RequestFactory
+        from blogs.views.blog import resolve_address
+        return resolve_address(RequestFactory().get('/', SERVER_NAME=host))
+
+    def test_unknown_domain_is_negatively_cached(self):
+        from django.http import Http404
+        with self.assertRaises(Http404):
+            self.resolve('random-bot-host.example.net')
+        with self.assertNumQueries(0):
+            with self.assertRaises(Http404):
+                self.resolve('random-bot-host.example.net')
+
+    def test_known_domain_uses_primary_key_lookup(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        self.assertEqual(self.resolve('www.hostblog.example.com'), self.blog)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.resolve('hostblog.example.com'), self.blog)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn(' OR ', queries[0]['sql'])
+
+    def test_blog_save_clears_negative_entry(self):
+        from django.http import Http404
+        with self.assertRaises(Http404):
+            self.resolve('newblog.testserver')
+        Blog.objects.create(user=self.user, title='New', subdomain='newblog')
+        self.assertEqual(self.resolve('newblog.testserver').subdomain, 'newblog')
+
+    def test_renamed_subdomain_stops_resolving(self):
+        from django.http import Http404
+        self.resolve('hostblog.testserver')
+        Blog.objects.filter(pk=self.blog.pk).update(subdomain='renamed')
+        with self.assertRaises(Http404):
+            self.resolve('hostblog.testserver')
+
+    def test_deactivated_user_stops_resolving(self):
+        from django.http import Http404
+        self.resolve('hostblog.testserver')
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(Http404):
+            self.resolve('hostblog.testserver')
+
+    def test_reactivated_user_resolves_again(self):
+        from django.http import Http404
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(Http404):
+            self.resolve('hostblog.testserver')
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.resolve('hostblog.testserver'), self.blog)
+
+
 class RateLimitMiddlewareTests(TestCase):
     def _middleware(self):
         from django.http import HttpResponse
@@ -1329,6 +2713,168 @@ class FeedNavDirectiveTests(TestCase):
         mock_adjacent.assert_not_called()
 
 
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class ConditionalGetTests(TestCase):
+    """Blog pages, feeds and sitemaps answer revalidations with a 304 before rendering."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='etag_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='ETag Blog', subdomain='etagblog')
+        self.post = Post.objects.create(
+            blog=self.blog, uid='et1', title='First', slug='first',
+            published_date=timezone.now() - timezone.timedelta(days=1), content='Hello',
+        )
+
+    def get(self, path, **headers):
+        return self.client.get(path, SERVER_NAME='etagblog.testserver', **headers)
+
+    def assert_revalidates_without_rendering(self, path):
+        etag = self.get(path)['ETag']
+        with mock.patch('blogs.views.blog.render') as mock_render, mock.patch('blogs.views.feed.generate_feed') as mock_feed:
+            response = self.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304, path)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Cache-Tag'], 'etagblog')
+        mock_render.assert_not_called()
+        mock_feed.assert_not_called()
+
+    def test_home_revalidates(self):
+        self.assert_revalidates_without_rendering('/')
+
+    def test_post_list_revalidates(self):
+        self.assert_revalidates_without_rendering('/blog/')
+
+    def test_post_revalidates(self):
+        self.assert_revalidates_without_rendering('/first/')
+
+    def test_feed_revalidates(self):
+        self.assert_revalidates_without_rendering('/feed/')
+
+    def test_sitemap_revalidates(self):
+        self.assert_revalidates_without_rendering('/sitemap.xml')
+
+    def test_robots_revalidates(self):
+        self.assert_revalidates_without_rendering('/robots.txt')
+
+    def test_post_edit_changes_etag(self):
+        etag = self.get('/')['ETag']
+        self.post.content = 'Edited'
+        self.post.last_modified = timezone.now()
+        self.post.save()
+        self.assertEqual(self.get('/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_dashboard_edit_changes_etag(self):
+        etag = self.get('/first/')['ETag']
+        self.blog.nav = '[About](/about/)'
+        self.blog.save()
+        self.assertEqual(self.get('/first/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_scheduled_post_going_live_changes_etag(self):
+        Post.objects.create(
+            blog=self.blog, uid='et2', title='Later', slug='later',
+            published_date=timezone.now() + timezone.timedelta(days=1), content='Soon',
+        )
+        etag = self.get('/feed/')['ETag']
+        Post.objects.filter(uid='et2').update(published_date=timezone.now() - timezone.timedelta(minutes=1))
+        self.assertEqual(self.get('/feed/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_timezone_cookie_changes_etag(self):
+        etag = self.get('/')['ETag']
+        self.client.cookies['timezone'] = 'Africa/Johannesburg'
+        self.assertNotEqual(self.get('/')['ETag'], etag)
+
+    def test_feed_if_modified_since(self):
+        last_modified = self.get('/feed/')['Last-Modified']
+        self.assertEqual(self.get('/feed/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.post.content = 'Edited'
+        self.post.last_modified = timezone.now() + timezone.timedelta(seconds=2)
+        self.post.save()
+        self.assertEqual(self.get('/feed/', HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_html_pages_have_no_last_modified(self):
+        self.assertNotIn('Last-Modified', self.get('/'))
+
+    def test_preview_is_not_validated(self):
+        self.post.publish = False
+        self.post.save()
+        response = self.get(f'/first/?token={self.post.token}')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class FeedMaterializationTests(TestCase):
+    """Feed entries are pre-rendered on Post.save and reused by feed requests."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='feedmat_user', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Feed Blog', subdomain='feedmat')
+        self.post = Post.objects.create(
+            blog=self.blog, uid='fm1', title='Stored', slug='stored',
+            published_date=timezone.now() - timezone.timedelta(hours=1),
+            content='**Pre-rendered** body', all_tags=json.dumps(['bears']),
+        )
+
+    def test_entry_materialized_on_save(self):
+        entry = FeedEntry.objects.get(post=self.post)
+        self.assertIn('&lt;strong&gt;Pre-rendered&lt;/strong&gt;', entry.atom)
+        self.assertIn('<description>&lt;p&gt;&lt;strong&gt;Pre-rendered', entry.rss)
+
+    def test_feed_request_reuses_stored_entries(self):
+        self.client.get('/feed/', SERVER_NAME='feedmat.testserver')
+        with mock.patch('blogs.views.feed.markdown') as mock_markdown:
+            atom = self.client.get('/feed/', SERVER_NAME='feedmat.testserver')
+            rss = self.client.get('/rss/', SERVER_NAME='feedmat.testserver')
+        mock_markdown.assert_not_called()
+        self.assertIn('Pre-rendered', atom.content.decode())
+        self.assertIn('<category term="bears"/>', atom.content.decode())
+        self.assertIn('<guid isPermaLink="false">', rss.content.decode())
+
+    def test_feed_is_valid_xml(self):
+        from lxml import etree
+        for path in ('/feed/', '/rss/', '/feed/?q=bears'):
+            response = self.client.get(path, SERVER_NAME='feedmat.testserver')
+            root = etree.fromstring(response.content)
+            self.assertEqual(len(root.findall('.//{http://www.w3.org/2005/Atom}entry') + root.findall('.//item')), 1)
+
+    def test_editing_post_rebuilds_entry(self):
+        self.post.content = 'Edited body'
+        self.post.save()
+        response = self.client.get('/feed/', SERVER_NAME='feedmat.testserver')
+        self.assertIn('Edited body', response.content.decode())
+        self.assertNotIn('Pre-rendered', response.content.decode())
+
+    def test_unchanged_save_skips_render(self):
+        # setUp ran outside the class's MAIN_SITE_HOSTS patch, so the blog url has changed since
+        self.post.save()
+        with mock.patch('blogs.views.feed.render_feed_entry') as render:
+            self.post.hidden = True
+            self.post.save()
+        render.assert_not_called()
+
+        from blogs.views.feed import render_feed_entry
+        with mock.patch('blogs.views.feed.render_feed_entry', wraps=render_feed_entry) as render:
+            self.post.title = 'Retitled'
+            self.post.save()
+        render.assert_called_once()
+        self.assertIn('Retitled', FeedEntry.objects.get(post=self.post).atom)
+
+    def test_stale_entry_rebuilt_on_read(self):
+        Post.objects.filter(pk=self.post.pk).update(content='Changed behind our back')
+        response = self.client.get('/feed/', SERVER_NAME='feedmat.testserver')
+        self.assertIn('Changed behind our back', response.content.decode())
+
+    def test_directive_entries_render_live(self):
+        self.post.content = 'Welcome to {{ blog_title }}'
+        self.post.save()
+        self.assertNotIn('Welcome', FeedEntry.objects.get(post=self.post).atom)
+        Blog.objects.filter(pk=self.blog.pk).update(title='Renamed Feed Blog')
+        response = self.client.get('/feed/', SERVER_NAME='feedmat.testserver')
+        self.assertIn('Welcome to Renamed Feed Blog', response.content.decode())
+
+
 class InlineLatexTests(TestCase):
     """Tests for replace_inline_latex and currency vs math rendering."""
 
@@ -1630,6 +3176,23 @@ class RendererInlineMathTests(TestCase):
         result = markdown_renderer('$E$ is energy')
         self.assertIn('math', result)
 
+    def test_repeated_expressions_converted_once(self):
+        mathml_cache.clear()
+        with mock.patch('latex2mathml.converter.convert', wraps=latex2mathml.converter.convert) as mock_convert:
+            result = markdown_renderer('$x$ and $x$ and $\\alpha$, then $x$ again')
+        self.assertEqual(result.count('<math'), 4)
+        self.assertEqual(mock_convert.call_count, 2)
+        self.assertEqual(mathml_cache.stats()['hits'], 2)
+
+    def test_failed_conversion_is_cached(self):
+        mathml_cache.clear()
+        with mock.patch('latex2mathml.converter.convert', side_effect=ValueError) as mock_convert, \
+                mock.patch('builtins.print') as mock_print:
+            self.assertIsNone(latex_to_mathml('\\broken'))
+            self.assertIsNone(latex_to_mathml('\\broken'))
+        self.assertEqual(mock_convert.call_count, 1)
+        self.assertEqual(mock_print.call_count, 1)
+
 
 class RendererBlockMathTests(TestCase):
     """Tests for MyRenderer.block_math() -- display=block."""
@@ -1689,6 +3252,45 @@ class CodeBlockTests(TestCase):
         self.assertIn('.highlight', css)
         self.assertIn('{', css)
 
+    def test_repeated_block_is_highlighted_once(self):
+        highlight_cache.clear()
+        code = '```python\nprint("cached")\n```'
+        with mock.patch('blogs.templatetags.custom_tags.highlight', wraps=highlight) as mock_highlight:
+            first = markdown_renderer(code)
+            second = markdown_renderer(code + '\n\n' + code)
+        self.assertEqual(mock_highlight.call_count, 1)
+        self.assertEqual(second.count('class="highlight"'), 2)
+        self.assertIn(first.strip(), second)
+
+    def test_same_code_different_language_not_shared(self):
+        self.assertNotEqual(highlight_code('<b>x</b>', 'html'), highlight_code('<b>x</b>', 'text'))
+
+    def test_lexers_are_reused(self):
+        self.assertIs(get_lexer('python'), get_lexer('python'))
+        self.assertEqual(get_lexer('nonexistentlang').name, get_lexer('text').name)
+
+
+class LRUCacheTests(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache()
+        cache.get('missing')
+        cache.set('key', 'value')
+        cache.get('key')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
 
 class HighlightCssTests(TestCase):
     """Tests for the inlined highlight CSS template include."""
@@ -1780,6 +3382,39 @@ class ReplaceInlineLatexDirectTests(TestCase):
         self.assertIn('\\$20', result)
 
 
+class PreprocessingFastPathTests(TestCase):
+    """Each preprocessing stage is skipped when its trigger characters are absent."""
+
+    PLAIN = 'Just some prose with a [link](https://example.com) and no specials.'
+
+    def test_stages_skip_regex_without_trigger_characters(self):
+        with mock.patch('blogs.templatetags.custom_tags.LATEX_INLINE_PATTERN') as latex, \
+                mock.patch('blogs.templatetags.custom_tags.CURRENCY_PATTERN') as currency, \
+                mock.patch('blogs.templatetags.custom_tags.PROTECTED_CODE_PATTERN') as code:
+            self.assertEqual(replace_inline_latex(self.PLAIN), self.PLAIN)
+            self.assertEqual(escape_currency(self.PLAIN), self.PLAIN)
+            markdown(self.PLAIN)
+        latex.sub.assert_not_called()
+        currency.sub.assert_not_called()
+        code.sub.assert_not_called()
+
+    def test_fix_links_skipped_without_links(self):
+        with mock.patch('blogs.templatetags.custom_tags.LINK_PARENTHESES_PATTERN') as links:
+            self.assertEqual(fix_links('No links (at all)'), 'No links (at all)')
+        links.sub.assert_not_called()
+
+    def test_clean_skips_iframe_and_script_passes(self):
+        with mock.patch('blogs.templatetags.custom_tags.CLEAN_IFRAME_PATTERN') as iframe, \
+                mock.patch('blogs.templatetags.custom_tags.CLEAN_SCRIPT_PATTERN') as script:
+            self.assertEqual(clean('<p>Hello</p>'), '<p>Hello</p>')
+        iframe.sub.assert_not_called()
+        script.sub.assert_not_called()
+
+    def test_uppercase_script_still_cleaned(self):
+        result = clean('<p>Hi</p><SCRIPT>alert(1)</SCRIPT>')
+        self.assertNotIn('alert', result)
+
+
 class StrikethroughPluginTests(TestCase):
     """Tests for ~~strikethrough~~ plugin."""
 
@@ -2063,6 +3698,63 @@ class CombinedRenderingTests(TestCase):
         self.assertIn('<li>Alpha</li>', result)
 
 
+class RenderCacheTests(TestCase):
+    """Rendered markdown is cached by content hash, before directives are filled in."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='rendercacheuser', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Cache Blog', subdomain='cacheblog')
+        local_render_cache.clear()
+
+    def test_unchanged_content_is_only_rendered_once(self):
+        with mock.patch('blogs.templatetags.custom_tags.markdown_renderer', wraps=markdown_renderer) as renderer:
+            first = markdown('# Hello cache', self.blog)
+            second = markdown('# Hello cache', self.blog)
+        self.assertEqual(first, second)
+        self.assertEqual(renderer.call_count, 1)
+
+    def test_repeat_renders_skip_the_database(self):
+        markdown('# Hello local cache', self.blog)
+        blog = Blog.objects.select_related('user__settings').get(pk=self.blog.pk)
+        with self.assertNumQueries(0):
+            markdown('# Hello local cache', blog)
+
+        # Another process still finds it in the database cache
+        local_render_cache.clear()
+        with mock.patch('blogs.templatetags.custom_tags.markdown_renderer') as renderer:
+            self.assertIn('Hello local cache', markdown('# Hello local cache', blog))
+        renderer.assert_not_called()
+
+    def test_changed_content_is_rendered_again(self):
+        with mock.patch('blogs.templatetags.custom_tags.markdown_renderer', wraps=markdown_renderer) as renderer:
+            markdown('Version one', self.blog)
+            result = markdown('Version two', self.blog)
+        self.assertIn('Version two', result)
+        self.assertEqual(renderer.call_count, 2)
+
+    def test_upgraded_flag_is_part_of_the_key(self):
+        content = '<iframe src="https://evil.example.com"></iframe>'
+        self.assertNotEqual(render_cache_key(content, True), render_cache_key(content, False))
+        self.assertNotIn('evil.example.com', markdown(content, self.blog))
+        self.user.settings.upgraded = True
+        self.user.settings.save()
+        self.assertIn('evil.example.com', markdown(content, self.blog))
+
+    def test_renderer_version_is_part_of_the_key(self):
+        key = render_cache_key('Hello', False)
+        with mock.patch('blogs.templatetags.custom_tags.RENDERER_VERSION', 999):
+            self.assertNotEqual(render_cache_key('Hello', False), key)
+
+    def test_directives_stay_dynamic(self):
+        markdown('Title: {{ blog_title }}', self.blog)
+        self.blog.title = 'Renamed Blog'
+        self.blog.save()
+        result = markdown('Title: {{ blog_title }}', self.blog)
+        self.assertIn('Renamed Blog', result)
+        self.assertNotIn('{{ blog_title }}', result)
+
+
 class ElementReplacementTests(TestCase):
     """Regression tests for template variable injection via element_replacement()."""
 
@@ -2200,6 +3892,29 @@ class ElementReplacementTests(TestCase):
         self.assertNotIn('{{ blog_last_posted }}', result)
         self.assertIn('XY', result)
 
+    def test_markup_without_directives_skips_rendering(self):
+        with mock.patch('blogs.templatetags.custom_tags.render_to_string') as mock_render:
+            result = element_replacement('<p>No directives here</p>', self.blog, post=self.post)
+        self.assertEqual(result, '<p>No directives here</p>')
+        mock_render.assert_not_called()
+
+    def test_only_used_directives_are_rendered(self):
+        with mock.patch('blogs.templatetags.custom_tags.render_to_string', return_value='') as mock_render:
+            element_replacement('{{ blog_title }}', self.blog, post=self.post)
+        mock_render.assert_not_called()
+
+    def test_repeated_directive_rendered_once(self):
+        with mock.patch('blogs.templatetags.custom_tags.render_to_string', return_value='<time>') as mock_render:
+            result = element_replacement('{{ blog_created_date }} {{ blog_created_date }}', self.blog)
+        self.assertEqual(result, '<time> <time>')
+        self.assertEqual(mock_render.call_count, 1)
+
+    def test_replaced_values_are_not_expanded_again(self):
+        self.blog.title = '{{ blog_description }}'
+        self.blog.save()
+        result = element_replacement('{{ blog_title }}', self.blog)
+        self.assertEqual(result, '{{ blog_description }}')
+
 
 class NextPreviousPostTests(TestCase):
     """Regression tests for {{ next_post }} and {{ previous_post }} replacement."""
@@ -2256,6 +3971,13 @@ class NextPreviousPostTests(TestCase):
         result = element_replacement('{{ next_post }}', self.blog, post=self.post1)
         self.assertNotIn('<quotes>', result)
 
+    def test_adjacent_posts_queried_once_for_both_links(self):
+        with mock.patch('blogs.templatetags.custom_tags.get_adjacent_posts', wraps=get_adjacent_posts) as mock_adjacent:
+            result = element_replacement('{{ previous_post }} {{ next_post }}', self.blog, post=self.post2)
+        self.assertIn('previous-post', result)
+        self.assertIn('next-post', result)
+        self.assertEqual(mock_adjacent.call_count, 1)
+
 
 class PostListDirectiveTests(TestCase):
     """Regression tests for {{ posts ... }} directive parsing in element_replacement()."""
@@ -2458,6 +4180,7 @@ class RandomRedirectTests(TestCase):
             hidden=False,
             content='x' * 150,
         )
+        build_random_pool()
 
     def test_random_post_redirects(self):
         response = self.client.get('/discover/random-post/')
@@ -2469,6 +4192,90 @@ class RandomRedirectTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertIn('https://', response.url)
 
+    def test_links_skip_posts_hidden_since_the_pool_was_built(self):
+        self.post.hidden = True
+        self.post.save()
+        self.assertEqual(self.client.get('/discover/random-post/').url, '/discover/')
+        self.assertEqual(self.client.get('/discover/random-blog/').url, self.blog.useful_domain)
+
+
+@mock.patch.dict(os.environ, {'MAIN_SITE_HOSTS': 'testserver'})
+class RandomPoolTests(TestCase):
+    """Random picks sample a pool of ids per language, rebuilt by build_random_pool."""
+
+    def setUp(self):
+        Stylesheet.objects.create(title='Default', identifier='default', css='')
+        self.user = User.objects.create_user(username='pooluser', password='pass')
+        self.blog = Blog.objects.create(user=self.user, title='Pool Blog', subdomain='poolblog', reviewed=True, lang='en')
+        for i, lang in enumerate(['', 'de', 'pt-br']):
+            Post.objects.create(blog=self.blog, uid=f'pool{i}', title=f'Pool {i}', slug=f'pool-{i}', lang=lang,
+                                published_date=timezone.now(), content='x' * 200)
+        self.pool = build_random_pool()
+
+    def test_pools_per_language(self):
+        posts = self.pool['posts']
+        self.assertEqual(sorted(posts), ['', 'de', 'en', 'pt'])
+        self.assertEqual([len(posts[lang]) for lang in ['', 'de', 'en', 'pt']], [3, 1, 1, 1])
+        self.assertEqual(list(self.pool['blogs']), [self.blog.pk])
+
+        self.client.cookies['lang'] = 'pt'
+        response = self.client.get('/discover/?random=true')
+        self.assertEqual([post.title for post in response.context['posts']], ['Pool 2'])
+
+    def test_samples_are_distinct(self):
+        self.assertEqual(len(set(sample_posts(10))), 3)
+        self.assertEqual(sample_posts(10, 'ja'), [])
+
+    def test_processes_pick_up_rebuilt_pool(self):
+        from blogs import random_pool
+        Post.objects.create(blog=self.blog, uid='pool3', title='Pool 3', slug='pool-3',
+                            published_date=timezone.now() - timezone.timedelta(days=1), content='x' * 200)
+        self.assertEqual(len(sample_posts(10)), 3)
+
+        # Another process rebuilds it
+        with mock.patch.dict(random_pool._pool):
+            build_random_pool()
+        random_pool._pool['checked'] = 0
+        self.assertEqual(len(sample_posts(10)), 4)
+
+    def test_missing_pool_is_rebuilt(self):
+        from blogs import random_pool
+        random_pool.pool_cache.clear()
+        random_pool._pool['checked'] = 0
+        with mock.patch('blogs.random_pool.build_random_pool', wraps=build_random_pool) as build:
+            self.assertEqual(len(sample_posts(10)), 3)
+        build.assert_called_once()
+
+    def test_stale_pool_is_served_while_rebuilding(self):
+        from blogs import random_pool
+        random_pool.pool_cache.clear()
+        with mock.patch('blogs.random_pool.executor') as executor:
+            executor.background = True
+            for _ in range(3):
+                random_pool._pool['checked'] = 0
+                self.assertEqual(len(sample_posts(10)), 3)
+        executor.submit.assert_called_once_with('discover', build_random_pool)
+
+    def test_one_caller_builds_a_missing_pool(self):
+        from blogs import random_pool
+        random_pool.pool_cache.clear()
+        random_pool.pool_cache.add('random_pool:building', True, 60)
+        with mock.patch.dict(random_pool._pool, built_at=None, checked=0, posts={}, blogs=array('I')):
+            with mock.patch('blogs.random_pool.build_random_pool') as build:
+                self.assertEqual(sample_posts(10), [])
+            build.assert_not_called()
+
+            # Built by the other caller
+            build_random_pool()
+            random_pool._pool['checked'] = 0
+            self.assertEqual(len(sample_posts(10)), 3)
+
+    def test_command(self):
+        from django.core.management import call_command
+        out = StringIO()
+        call_command('build_random_pool', stdout=out)
+        self.assertIn('Pooled 3 posts in 3 languages and 1 blogs', out.getvalue())
+
 
 class PostContentLengthTests(TestCase):
     """Tests for the content_length field on Post."""
@@ -2,9 +2,9 @@ from django.urls import path, re_path
 
 from blogs.views import blog, dashboard, studio, feed, discover, analytics, emailer, staff, signup_flow, media, staff_api
 from blogs import subscriptions
+from blogs.utils.hosts import request_host
 from conf import logger
 
-import os
 from functools import wraps
 
 
@@ -12,7 +12,7 @@ from functools import wraps
 def main_site_only(view_func):
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
-        if not request.get_host() in os.getenv('MAIN_SITE_HOSTS').split(','):
+        if not request_host(request).is_main_site:
             # If not the main site, redirect to a potential blog post
             return blog.post(request, slug=request.path)
         return view_func(request, *args, **kwargs)
@@ -46,6 +46,8 @@ urlpatterns = [
     path('staff-api/unreviewed-blogs/', main_site_only(staff_api.unreviewed_blogs), name='staff_api_unreviewed_blogs'),
     path('staff-api/blog/<slug:subdomain>/', main_site_only(staff_api.blog), name='staff_api_blog'),
     path('staff-api/post/<int:pk>/', main_site_only(staff_api.post), name='staff_api_post'),
+    path('staff-api/hit-queue/', main_site_only(staff_api.hit_queue_stats), name='staff_api_hit_queue'),
+    path('staff-api/tasks/', main_site_only(staff_api.task_stats), name='staff_api_tasks'),
 
     # User dashboard
     path('accounts/delete/', main_site_only(dashboard.delete_user), name='user_delete'),
@@ -73,6 +75,7 @@ urlpatterns = [
 
     # Analytics
     path('<id>/dashboard/analytics/', main_site_only(analytics.analytics), name='analytics'),
+    path('<id>/dashboard/analytics/on-site/', main_site_only(analytics.on_site), name='analytics_on_site'),
 
     path('<id>/dashboard/opt-in-review/', main_site_only(dashboard.opt_in_review), name='opt_in_review'),
 
@@ -1,31 +1,36 @@
 import csv
-import io
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 
 
 def _header_name(field):
     return field.replace('_', ' ')
 
 
-def render_to_csv_response(queryset):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename=data.csv'
-    _write_csv(queryset, response)
-    return response
+class _Echo:
+    # csv writers write a row at a time, hand each one back instead of keeping it
+    def write(self, value):
+        return value
 
 
-def write_csv(queryset, buffer):
-    text_buffer = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
-    _write_csv(queryset, text_buffer)
-    text_buffer.detach()
+def iter_rows(queryset, chunk_size=500):
+    if hasattr(queryset, 'iterator'):
+        return queryset.iterator(chunk_size=chunk_size)
+    return iter(queryset)
 
 
-def _write_csv(queryset, output):
-    output.write('\ufeff')
+def iter_csv(queryset, chunk_size=500):
+    yield '\ufeff'
     writer = None
-    for row in queryset:
+    for row in iter_rows(queryset, chunk_size):
         if writer is None:
             headers = list(row.keys())
-            writer = csv.DictWriter(output, fieldnames=headers)
-            writer.writerow({h: _header_name(h) for h in headers})
-        writer.writerow(row)
+            writer = csv.DictWriter(_Echo(), fieldnames=headers)
+            yield writer.writerow({h: _header_name(h) for h in headers})
+        yield writer.writerow(row)
+
+
+def render_to_csv_response(queryset, filename='data.csv'):
+    response = StreamingHttpResponse(iter_csv(queryset), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
@@ -0,0 +1,57 @@
+import os
+from functools import lru_cache
+
+
+MAIN_SITE = 'main_site'
+SUBDOMAIN = 'subdomain'
+CUSTOM_DOMAIN = 'custom_domain'
+
+
+class Host:
+    """What a request's host points at: the main site, a bear subdomain or a custom domain."""
+
+    __slots__ = ('name', 'kind', 'subdomain')
+
+    def __init__(self, name, kind, subdomain=None):
+        self.name = name
+        self.kind = kind
+        self.subdomain = subdomain
+
+    @property
+    def is_main_site(self):
+        return self.kind == MAIN_SITE
+
+    def __repr__(self):
+        return f'<Host {self.name} {self.kind}{f" {self.subdomain}" if self.subdomain else ""}>'
+
+
+@lru_cache(maxsize=8)
+def parse_main_site_hosts(value):
+    return tuple(site.strip().lower() for site in value.split(',') if site.strip())
+
+
+def main_site_hosts():
+    return parse_main_site_hosts(os.getenv('MAIN_SITE_HOSTS', ''))
+
+
+def classify_host(name):
+    name = name.lower()
+    sites = main_site_hosts()
+
+    if name in sites:
+        return Host(name, MAIN_SITE)
+
+    for site in sites:
+        if name.endswith('.' + site):
+            return Host(name, SUBDOMAIN, name[:-(len(site) + 1)])
+
+    return Host(name, CUSTOM_DOMAIN)
+
+
+def request_host(request):
+    # Classified once per request, every middleware and view after that reads the same answer
+    try:
+        return request._bear_host
+    except AttributeError:
+        request._bear_host = classify_host(request.get_host())
+        return request._bear_host
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+import math
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(value, pk):
+    # Microseconds for dates and repr for floats, both round-trip exactly
+    if isinstance(value, datetime):
+        value = (value - EPOCH) // timedelta(microseconds=1)
+    return f'{value!r}_{pk}'
+
+
+def decode_cursor(cursor, kind):
+    """Returns (value, pk) for a cursor of a field of type kind (float, int or datetime), None if it's invalid."""
+    try:
+        value, pk = cursor.rsplit('_', 1)
+        pk = int(pk)
+        if kind is datetime:
+            value = EPOCH + timedelta(microseconds=int(value))
+        else:
+            value = kind(value)
+            if not math.isfinite(value):
+                return None
+    except (AttributeError, ValueError, OverflowError):
+        return None
+    return value, pk
+
+
+def keyset_page(queryset, field, size, after=None, before=None):
+    """A page of queryset ordered by field, then pk, descending, that starts after or ends before a cursor.
+
+    Unlike an OFFSET this is an index range scan, so deep pages cost the same as the first.
+    """
+    if before:
+        value, pk = before
+        rows = queryset.filter(**{f'{field}__gte': value}).exclude(**{field: value, 'pk__lte': pk}).order_by(field, 'pk')
+        return list(rows[:size])[::-1]
+
+    queryset = queryset.order_by(f'-{field}', '-pk')
+    if after:
+        value, pk = after
+        # The range on field alone is what the index scan starts from
+        queryset = queryset.filter(**{f'{field}__lte': value}).exclude(**{field: value, 'pk__gte': pk})
+    return list(queryset[:size])
+
+
+def page_cursors(rows, field):
+    # Cursors for the pages before and after these rows
+    if not rows:
+        return None, None
+    return encode_cursor(getattr(rows[0], field), rows[0].pk), encode_cursor(getattr(rows[-1], field), rows[-1].pk)
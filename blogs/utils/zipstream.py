@@ -0,0 +1,31 @@
+import io
+import zipfile
+
+
+class _Sink(io.RawIOBase):
+    # Unseekable, so zipfile writes data descriptors instead of going back to patch headers
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """Yields a ZIP archive of (filename, content) entries one entry at a time."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression) as zf:
+        for filename, content in entries:
+            zf.writestr(filename, content)
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
@@ -3,18 +3,20 @@ from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.db import connection
-from django.db.models import DateField, Count, Sum, Q
+from django.db.models import DateField, Count, Min, Sum, Q
 from django.db.models.functions import Cast
 
-from blogs.models import Blog, Hit, Post
-from blogs.helpers import get_country, salt_and_hash
+from blogs.models import Blog, Hit, HitRollup, PersistentStore, Post, VisitorRollup, VisitorSketch
+from blogs.helpers import get_country, parse_user_agent, salt_and_hash
+from blogs.hits import ON_SITE_MINUTES, hit_queue, on_site_now, sketch_keys
+from blogs.utils.hll import HyperLogLog
 
-from datetime import timedelta
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
 from ipaddr import client_ip
 from urllib.parse import urlparse
-import httpagentparser
 
 
 def get_int(value, default):
@@ -34,6 +36,32 @@ def analytics(request, id):
     return render_analytics(request, blog)
 
 
+@login_required
+def on_site(request, id):
+    if request.user.is_superuser:
+        blog = get_object_or_404(Blog, subdomain=id)
+    else:
+        blog = get_object_or_404(Blog, user=request.user, subdomain=id)
+
+    # Polled by the analytics page, so it doesn't have to re-render everything
+    return JsonResponse({'on_site': on_site_count(blog, request.GET.get('post'), request.GET.get('referrer'))})
+
+
+def on_site_count(blog, post_filter=None, referrer_filter=None):
+    # The counters are per blog, a post or referrer is counted from its last few minutes of hits
+    if not post_filter and not referrer_filter:
+        return on_site_now(blog.id)
+
+    hits = Hit.objects.filter(blog=blog, created_date__gt=timezone.now() - timedelta(minutes=ON_SITE_MINUTES))
+    if post_filter == 'homepage':
+        hits = hits.filter(post__isnull=True)
+    elif post_filter:
+        hits = hits.filter(post__slug=post_filter)
+    if referrer_filter:
+        hits = hits.filter(referrer=referrer_filter)
+    return hits.count()
+
+
 def render_analytics(request, blog, public=False):
     now = timezone.now()
     post_filter = request.GET.get('post', False)
@@ -42,15 +70,29 @@ def render_analytics(request, blog, public=False):
     start_date = (now - timedelta(days=days_filter)).date()
     end_date = now.date()
 
-    base_hits = Hit.objects.filter(blog=blog, created_date__gt=start_date)
+    # Closed days come from the daily rollup, anything after it from raw hits,
+    # so a 10 year view costs about the same as a 7 day one
+    rolled_up_to = PersistentStore.load().hits_rolled_up_to
+    use_rollup = bool(rolled_up_to and rolled_up_to >= start_date)
+    if use_rollup:
+        rollup = HitRollup.objects.filter(blog=blog, date__gte=start_date, date__lte=rolled_up_to)
+        raw_start = datetime.combine(rolled_up_to + timedelta(days=1), datetime.min.time(), tzinfo=dt_timezone.utc)
+    else:
+        rollup = HitRollup.objects.none()
+        raw_start = datetime.combine(start_date, datetime.min.time(), tzinfo=dt_timezone.utc)
+
+    base_hits = Hit.objects.filter(blog=blog, created_date__gt=raw_start)
 
     if post_filter:
         if post_filter == 'homepage':
             base_hits = base_hits.filter(post__isnull=True)
+            rollup = rollup.filter(post__isnull=True)
         else:
             base_hits = base_hits.filter(post__slug=post_filter)
+            rollup = rollup.filter(post__slug=post_filter)
     if referrer_filter:
         base_hits = base_hits.filter(referrer=referrer_filter)
+        rollup = rollup.filter(referrer=referrer_filter)
 
     hits = base_hits
 
@@ -64,17 +106,32 @@ def render_analytics(request, blog, public=False):
         v=Count('hash_id', distinct=True)
     ).order_by('date')
 
+    # Days with visitor sketches are counted from those, older ones the way they always were
+    sketch_start, unique_visitors = sketched_visitors(blog, start_date, post_filter, referrer_filter)
+    if sketch_start is None:
+        sketch_start = end_date + timedelta(days=1)
+
     hit_date_count = {}
     unique_reads = 0
-    unique_visitors = 0
+    for day in rollup.values('date').annotate(c=Sum('hits'), v=Sum('visitors')).order_by('date'):
+        hit_date_count[day['date']] = day['c']
+        unique_reads += day['c']
+        # Rollup rows count visitors per row, close enough within a post or referrer
+        if (post_filter or referrer_filter) and day['date'] < sketch_start:
+            unique_visitors += day['v']
+    if use_rollup and not post_filter and not referrer_filter:
+        unique_visitors += VisitorRollup.objects.filter(
+            blog=blog, date__gte=start_date, date__lte=rolled_up_to, date__lt=sketch_start
+        ).aggregate(v=Sum('visitors'))['v'] or 0
     for hit in hit_dict:
-        hit_date_count[hit['date']] = hit['c']
+        hit_date_count[hit['date']] = hit_date_count.get(hit['date'], 0) + hit['c']
         unique_reads += hit['c']
-        unique_visitors += hit['v']
+        if hit['date'] < sketch_start:
+            unique_visitors += hit['v']
 
     if hit_date_count:
         start_date = min(hit_date_count.keys())
-    on_site = hits.filter(created_date__gt=now-timedelta(minutes=4)).count()
+    on_site = on_site_count(blog, post_filter, referrer_filter)
 
     chart_data = []
     date_range = [start_date + timedelta(days=x) for x in range((end_date - start_date).days + 1)]
@@ -84,12 +141,12 @@ def render_analytics(request, blog, public=False):
         count = hit_date_count.get(date, 0)
         chart_data.append({'date': date_str, 'hits': count})
 
-    posts = get_posts(blog.id, start_date, post_filter, referrer_filter)
+    posts = get_posts(blog.id, start_date, post_filter, referrer_filter, rolled_up_to, raw_start)
 
-    referrers = base_hits.exclude(referrer='').values('referrer').annotate(count=Count('referrer')).order_by('-count').values('referrer', 'count')
-    devices = base_hits.exclude(device='').values('device').annotate(count=Count('device')).order_by('-count').values('device', 'count')
-    browsers = base_hits.exclude(browser='').values('browser').annotate(count=Count('browser')).order_by('-count').values('browser', 'count')
-    countries = base_hits.exclude(country='').values('country').annotate(count=Count('country')).order_by('-count').values('country', 'count')
+    referrers = merged_counts(rollup, base_hits, 'referrer')
+    devices = merged_counts(rollup, base_hits, 'device')
+    browsers = merged_counts(rollup, base_hits, 'browser')
+    countries = merged_counts(rollup, base_hits, 'country')
 
     return render(request, 'studio/analytics.html', {
         'public': public,
@@ -111,22 +168,73 @@ def render_analytics(request, blog, public=False):
     })
 
 
-def get_posts(blog_id, start_date, post_filter=None, referrer_filter=None):
+def sketched_visitors(blog, start_date, post_filter=None, referrer_filter=None):
+    # hash_ids change daily so merging days adds up daily uniques, like the raw count does.
+    # Returns the first day this blog has sketches for (or None) and the visitors since.
+    sketch_start = VisitorSketch.objects.filter(blog=blog, scope='blog', key='').aggregate(first=Min('date'))['first']
+    if sketch_start is None:
+        return None, 0
+
+    post_ids = [None]
+    if post_filter and post_filter != 'homepage':
+        post_ids = list(Post.objects.filter(blog=blog, slug=post_filter).values_list('id', flat=True))
+
+    scope = {
+        (True, True): 'post_referrer',
+        (True, False): 'post',
+        (False, True): 'referrer',
+        (False, False): 'blog',
+    }[(bool(post_filter), bool(referrer_filter))]
+    keys = {key for post_id in post_ids for key_scope, key in sketch_keys(post_id, referrer_filter or '') if key_scope == scope}
+
+    merged = HyperLogLog()
+    sketches = VisitorSketch.objects.filter(blog=blog, scope=scope, key__in=keys, date__gte=max(start_date, sketch_start))
+    for registers in sketches.values_list('registers', flat=True).iterator():
+        merged.merge(HyperLogLog.from_bytes(registers))
+    return sketch_start, merged.count()
+
+
+def merged_counts(rollup, hits, field):
+    counts = Counter()
+    for row in rollup.exclude(**{field: ''}).values(field).annotate(count=Sum('hits')).order_by():
+        counts[row[field]] += row['count']
+    for row in hits.exclude(**{field: ''}).values(field).annotate(count=Count(field)).order_by():
+        counts[row[field]] += row['count']
+    return [{field: value, 'count': count} for value, count in counts.most_common() if value]
+
+
+def get_posts(blog_id, start_date, post_filter=None, referrer_filter=None, rolled_up_to=None, raw_start=None):
+    if raw_start is None:
+        raw_start = start_date
     with connection.cursor() as cursor:
         cursor.execute("""
             WITH hit_counts AS (
-                SELECT post_id, COUNT(*) as hit_count
-                FROM blogs_hit
-                WHERE blog_id = %s
-                AND created_date > %s
-                AND (referrer = %s OR %s IS NULL)
+                SELECT post_id, SUM(hit_count) as hit_count
+                FROM (
+                    SELECT post_id, SUM(hits) as hit_count
+                    FROM blogs_hitrollup
+                    WHERE blog_id = %s
+                    AND date >= %s
+                    AND date <= %s
+                    AND (referrer = %s OR %s IS NULL)
+                    GROUP BY post_id
+
+                    UNION ALL
+
+                    SELECT post_id, COUNT(*) as hit_count
+                    FROM blogs_hit
+                    WHERE blog_id = %s
+                    AND created_date > %s
+                    AND (referrer = %s OR %s IS NULL)
+                    GROUP BY post_id
+                ) counts
                 GROUP BY post_id
             )
             SELECT p.title,
                    p.upvotes,
                    p.published_date,
                    p.slug,
-                   COALESCE(hc.hit_count, 0) as hit_count
+                   CAST(COALESCE(hc.hit_count, 0) AS BIGINT) as hit_count
             FROM blogs_post p
             LEFT JOIN hit_counts hc ON hc.post_id = p.id
             WHERE p.blog_id = %s
@@ -139,12 +247,13 @@ def get_posts(blog_id, start_date, post_filter=None, referrer_filter=None):
                    0 as upvotes,
                    NULL as published_date,
                    'homepage' as slug,
-                   COALESCE((SELECT hit_count FROM hit_counts WHERE post_id IS NULL), 0)
+                   CAST(COALESCE((SELECT hit_count FROM hit_counts WHERE post_id IS NULL), 0) AS BIGINT)
             WHERE (%s = 'homepage' OR %s IS NULL)
 
             ORDER BY hit_count DESC, published_date DESC
         """, [
-            blog_id, start_date, referrer_filter or None, referrer_filter or None,
+            blog_id, start_date, rolled_up_to, referrer_filter or None, referrer_filter or None,
+            blog_id, raw_start, referrer_filter or None, referrer_filter or None,
             blog_id, post_filter or None, post_filter or None,
             post_filter or None, post_filter or None
         ])
@@ -156,14 +265,11 @@ def get_posts(blog_id, start_date, post_filter=None, referrer_filter=None):
 @csrf_exempt
 def hit(request):
     if request.GET.get('blog') and get_int(request.GET.get('score', 0), 0) > 50 and not request.GET.get('title') and not 'bot' in request.META.get('HTTP_USER_AGENT'):
-        user_agent = httpagentparser.detect(request.META.get('HTTP_USER_AGENT', None))
-
         # Prevent duplicates with ip hash + date
         hash_id = salt_and_hash(request)
 
         country = get_country(client_ip(request)).get('country_name', '')
-        device = user_agent.get('platform', {}).get('name', '')
-        browser = user_agent.get('browser', {}).get('name', '')
+        device, browser = parse_user_agent(request.META.get('HTTP_USER_AGENT', ''))
         
         referrer = request.GET.get('referrer','')
         if referrer:
@@ -171,25 +277,17 @@ def hit(request):
             referrer = '{uri.scheme}://{uri.netloc}/'.format(uri=referrer)
         
 
-        blog_pk = Blog.objects.filter(subdomain=request.GET.get('blog')).values_list('pk', flat=True).first()
-        post_pk = None
-        if '/' not in request.GET.get('token'):
-            post_pk = Post.objects.filter(uid=request.GET.get('token')).values_list('pk', flat=True).first()
-        
-        if blog_pk:
-            try:
-                hit, create = Hit.objects.get_or_create(
-                    blog_id=blog_pk,
-                    post_id=post_pk,
-                    hash_id=hash_id,
-                    referrer=referrer,
-                    country=country,
-                    device=device,
-                    browser=browser)
-                if create:
-                    print('Hit:', hit)
-            except Hit.MultipleObjectsReturned:
-                pass
+        # Blog/post lookups and the insert happen in the background writer
+        token = request.GET.get('token', '')
+        hit_queue.put({
+            'blog': request.GET.get('blog'),
+            'post': token if token and '/' not in token else None,
+            'hash_id': hash_id,
+            'referrer': referrer,
+            'country': country,
+            'device': device,
+            'browser': browser,
+        })
 
         response = HttpResponse("Logged hit", content_type='text/plain')
         response['X-Robots-Tag'] = 'noindex, nofollow'
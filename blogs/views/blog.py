@@ -2,43 +2,69 @@ from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import Count, Max, Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from blogs.models import Blog, Post, Upvote
 from blogs.helpers import salt_and_hash, unmark
+from blogs.templatetags.custom_tags import RENDERER_VERSION
+from blogs.utils.hosts import request_host
+from blogs.utils.lru import LRUCache
 from blogs.views.analytics import render_analytics
 
+from time import time
+import hashlib
 import json
-import os
 
 
-def resolve_address(request):
-    http_host = request.get_host()
+# Per-process host -> blog id map. Known hosts still load the blog (with its user and
+# settings) every request so edits show up at once, but by primary key instead of the
+# subdomain or the OR'd www/non-www domain lookup. Unknown hosts (bot floods on random
+# custom domains) skip the database entirely.
+# Blog.save and user (de)activation drop entries, the TTL covers the other processes.
+HOST_CACHE_TTL = 300
+NEGATIVE_HOST_CACHE_TTL = 60
+host_cache = LRUCache(maxsize=20000)
+
 
-    sites = os.getenv('MAIN_SITE_HOSTS').split(',')
+def resolve_address(request):
+    host = request_host(request)
 
-    if any(http_host == site for site in sites):
+    if host.is_main_site:
         # Homepage
         return None
 
-    for site in sites:
-        if http_host.endswith('.' + site):
-            # Subdomained blog
-            subdomain = http_host[:-(len(site) + 1)].lower()
-            return get_object_or_404(Blog.objects.select_related('user').select_related('user__settings'), subdomain=subdomain, user__is_active=True)
+    if host.subdomain:
+        # Subdomained blog
+        blog = get_blog_with_subdomain(host.subdomain)
+        if not blog:
+            raise Http404
+        return blog
 
     # Custom domain blog
-    return get_blog_with_domain(http_host)
+    return get_blog_with_domain(host.name)
+
+
+def get_blog_with_subdomain(subdomain):
+    return cached_blog_lookup(
+        ('subdomain', subdomain),
+        lambda blog: blog.subdomain == subdomain,
+        lambda blogs: blogs.filter(subdomain=subdomain).first(),
+    )
 
 
 def get_blog_with_domain(domain):
     if not domain:
         return False
 
+    domain = clean_domain(domain)
+
     # Indexed lookup on domain, matching with and without the www. prefix
-    blog = Blog.objects.select_related('user').select_related('user__settings').filter(
-        Q(domain=clean_domain(domain)) | Q(domain=f'www.{clean_domain(domain)}'),
-        user__is_active=True
-    ).first()
+    blog = cached_blog_lookup(
+        ('domain', domain),
+        lambda blog: clean_domain(blog.domain or '') == domain,
+        lambda blogs: blogs.filter(Q(domain=domain) | Q(domain=f'www.{domain}')).first(),
+    )
 
     if not blog:
         raise Http404
@@ -46,10 +72,85 @@ def get_blog_with_domain(domain):
     return blog
 
 
+def cached_blog_lookup(key, matches, lookup):
+    blogs = Blog.objects.select_related('user').select_related('user__settings').filter(user__is_active=True)
+
+    cached = host_cache.get(key)
+    if cached and cached[1] > time():
+        blog_id = cached[0]
+        if blog_id is None:
+            return None
+
+        # Still a query with the user joins, the blog row is only trusted fresh.
+        # Entries can be stale in other processes, only trust them if the host still matches
+        blog = blogs.filter(pk=blog_id).first()
+        if blog and matches(blog):
+            return blog
+
+    blog = lookup(blogs)
+    if blog:
+        host_cache.set(key, (blog.pk, time() + HOST_CACHE_TTL))
+    else:
+        host_cache.set(key, (None, time() + NEGATIVE_HOST_CACHE_TTL))
+    return blog
+
+
+def forget_blog_hosts(blog):
+    host_cache.delete(('subdomain', blog.subdomain))
+    if blog.domain:
+        host_cache.delete(('domain', clean_domain(blog.domain)))
+
+
 def clean_domain(domain):
     return domain.strip().lower().removeprefix('www.')
 
 
+def visible_posts_state(blog):
+    # One indexed aggregate that changes whenever a post is edited, deleted or a scheduled post goes live
+    return blog.posts.filter(publish=True, published_date__lte=timezone.now()).aggregate(
+        count=Count('id'),
+        last_modified=Max('last_modified'),
+        last_published=Max('published_date'),
+    )
+
+
+def blog_etag(request, blog, *parts):
+    # The blog row is already loaded by resolve_address, hashing all of it also catches
+    # dashboard edits (styles, nav, settings) that don't touch last_modified.
+    # The date is included so relative directives ("3 days ago") don't go stale forever.
+    values = [RENDERER_VERSION, timezone.now().date(), request.COOKIES.get('timezone', 'UTC'), blog.user.settings.upgraded]
+    values += [getattr(blog, field.attname) for field in blog._meta.concrete_fields]
+    values += parts
+    digest = hashlib.sha256('\x00'.join(str(value) for value in values).encode('utf-8', 'surrogatepass')).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def last_modified_date(blog, posts_state):
+    dates = [blog.last_modified, posts_state['last_modified'], posts_state['last_published']]
+    return max(date for date in dates if date)
+
+
+def not_modified(request, blog, etag, last_modified=None):
+    # Answer If-None-Match/If-Modified-Since before doing any rendering
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if response:
+        return set_cache_headers(response, blog, etag, last_modified)
+
+
+def set_cache_headers(response, blog, etag=None, last_modified=None):
+    response['Cache-Tag'] = blog.subdomain
+    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
 @csrf_exempt
 def ping(request):
     domain = request.GET.get("domain", None)
@@ -74,6 +175,11 @@ def home(request):
         # Don't cache here because of dashboard
         return render(request, 'landing.html')
 
+    etag = blog_etag(request, blog, visible_posts_state(blog))
+    response = not_modified(request, blog, etag)
+    if response:
+        return response
+
     all_posts = blog.posts.filter(publish=True, published_date__lte=timezone.now(), is_page=False).defer('content').order_by('-published_date')
 
     meta_description = blog.meta_description or unmark(blog.content)[:157] + '...'
@@ -88,10 +194,7 @@ def home(request):
         }
     )
 
-    response['Cache-Tag'] = blog.subdomain
-    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
-
-    return response
+    return set_cache_headers(response, blog, etag)
 
 
 def posts(request, blog):
@@ -99,7 +202,12 @@ def posts(request, blog):
         blog = resolve_address(request)
     if not blog:
         return not_found(request)
-    
+
+    etag = blog_etag(request, blog, visible_posts_state(blog))
+    response = not_modified(request, blog, etag)
+    if response:
+        return response
+
     tag_param = request.GET.get('q', '')
     tags = [t.strip() for t in tag_param.split(',')] if tag_param else []
     tags = [t for t in tags if t]  # Remove empty strings
@@ -151,10 +259,8 @@ def posts(request, blog):
             'tags_to_show': tags_to_show,
         }
     )
-    
-    response['Cache-Tag'] = blog.subdomain
-    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
-    return response
+
+    return set_cache_headers(response, blog, etag)
 
 
 def post(request, slug):
@@ -198,6 +304,15 @@ def post(request, slug):
     if post.publish is False and not request.GET.get('token') == post.token:
         return not_found(request)
 
+    # Previews are never cached
+    cacheable = post.publish and not request.GET.get('token')
+    if cacheable:
+        post_values = [getattr(post, field.attname) for field in post._meta.concrete_fields]
+        etag = blog_etag(request, blog, visible_posts_state(blog), *post_values)
+        response = not_modified(request, blog, etag)
+        if response:
+            return response
+
     context = {
         'blog': blog,
         'post': post,
@@ -209,9 +324,8 @@ def post(request, slug):
 
     response = render(request, 'post.html', context)
 
-    if post.publish and not request.GET.get('token'):
-        response['Cache-Tag'] = blog.subdomain
-        response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
+    if cacheable:
+        set_cache_headers(response, blog, etag)
 
     return response
 
@@ -270,16 +384,21 @@ def sitemap(request):
     blog = resolve_address(request)
     if not blog:
         return not_found(request)
-    
+
+    posts_state = visible_posts_state(blog)
+    etag = blog_etag(request, blog, posts_state)
+    last_modified = last_modified_date(blog, posts_state)
+    response = not_modified(request, blog, etag, last_modified)
+    if response:
+        return response
+
     try:
         posts = blog.posts.filter(publish=True, published_date__lte=timezone.now()).only('slug', 'last_modified', 'blog_id').order_by('-published_date')
     except AttributeError:
         posts = []
     
     response = render(request, 'sitemap.xml', {'blog': blog, 'posts': posts}, content_type='text/xml')
-    response['Cache-Tag'] = blog.subdomain
-    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
-    return response
+    return set_cache_headers(response, blog, etag, last_modified)
 
 
 def robots(request):
@@ -287,10 +406,13 @@ def robots(request):
     if not blog:
         return not_found(request)
 
+    etag = blog_etag(request, blog)
+    response = not_modified(request, blog, etag)
+    if response:
+        return response
+
     response = render(request, 'robots.txt',  {'blog': blog}, content_type="text/plain")
-    response['Cache-Tag'] = blog.subdomain
-    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
-    return response
+    return set_cache_headers(response, blog, etag)
 
 
 
@@ -3,14 +3,13 @@ from django.shortcuts import get_object_or_404, redirect, render
 from django.contrib.auth import get_user_model
 from django.utils.text import slugify
 
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 
 from ipaddr import client_ip
 from unicodedata import lookup
 from blogs.utils.csv import render_to_csv_response
-import io
+from blogs.utils.zipstream import iter_zip
 import json
-import zipfile
 
 from blogs.forms import NavForm, StyleForm
 from blogs.helpers import get_country, is_protected
@@ -201,49 +200,50 @@ def opt_in_review(request, id):
     return render(request, "dashboard/opt-in-review.html", {"blog": blog})
 
 
-def export_markdown_zip(blog):
-    buf = io.BytesIO()
+def post_markdown(post):
+    lines = ['---']
+    lines.append(f'title: {post.title}')
+    lines.append(f'slug: {post.slug}')
+    if post.alias:
+        lines.append(f'alias: {post.alias}')
+    lines.append(f'published_date: {post.published_date.isoformat()}')
+    tags = sorted(json.loads(post.all_tags))
+    if tags:
+        lines.append(f'tags: {", ".join(tags)}')
+    lines.append(f'publish: {str(post.publish).lower()}')
+    lines.append(f'make_discoverable: {str(post.make_discoverable).lower()}')
+    lines.append(f'is_page: {str(post.is_page).lower()}')
+    if post.canonical_url:
+        lines.append(f'canonical_url: {post.canonical_url}')
+    if post.meta_description:
+        lines.append(f'meta_description: {post.meta_description}')
+    if post.meta_image:
+        lines.append(f'meta_image: {post.meta_image}')
+    if post.lang:
+        lines.append(f'lang: {post.lang}')
+    if post.class_name:
+        lines.append(f'class_name: {post.class_name}')
+    lines.append('---')
+
+    return '\n'.join(lines) + '\n\n' + post.content
+
+
+def markdown_files(blog):
     seen = {}
+    # Posts can be large, only keep a few in memory at a time
+    for post in blog.posts.all().iterator(chunk_size=20):
+        base = post.slug or 'untitled'
+        if base not in seen:
+            seen[base] = 1
+            filename = f'{base}.md'
+        else:
+            seen[base] += 1
+            filename = f'{base}-{seen[base]}.md'
+        yield filename, post_markdown(post)
 
-    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for post in blog.posts.all():
-            base = post.slug or 'untitled'
-            if base not in seen:
-                seen[base] = 1
-                filename = f'{base}.md'
-            else:
-                seen[base] += 1
-                filename = f'{base}-{seen[base]}.md'
-
-            lines = ['---']
-            lines.append(f'title: {post.title}')
-            lines.append(f'slug: {post.slug}')
-            if post.alias:
-                lines.append(f'alias: {post.alias}')
-            lines.append(f'published_date: {post.published_date.isoformat()}')
-            tags = sorted(json.loads(post.all_tags))
-            if tags:
-                lines.append(f'tags: {", ".join(tags)}')
-            lines.append(f'publish: {str(post.publish).lower()}')
-            lines.append(f'make_discoverable: {str(post.make_discoverable).lower()}')
-            lines.append(f'is_page: {str(post.is_page).lower()}')
-            if post.canonical_url:
-                lines.append(f'canonical_url: {post.canonical_url}')
-            if post.meta_description:
-                lines.append(f'meta_description: {post.meta_description}')
-            if post.meta_image:
-                lines.append(f'meta_image: {post.meta_image}')
-            if post.lang:
-                lines.append(f'lang: {post.lang}')
-            if post.class_name:
-                lines.append(f'class_name: {post.class_name}')
-            lines.append('---')
-
-            md_content = '\n'.join(lines) + '\n\n' + post.content
-            zf.writestr(filename, md_content)
-
-    buf.seek(0)
-    response = HttpResponse(buf.read(), content_type='application/zip')
+
+def export_markdown_zip(blog):
+    response = StreamingHttpResponse(iter_zip(markdown_files(blog)), content_type='application/zip')
     response['Content-Disposition'] = f'attachment; filename="{blog.subdomain}-export.zip"'
     return response
 
@@ -1,31 +1,137 @@
+from django.core.cache import caches
 from django.http.response import HttpResponse
 from django.shortcuts import render, redirect
-from django.db.models import Q, Max, Min
+from django.template.loader import render_to_string
+from django.db.models import Q
 from django.utils import timezone
 from django.contrib.postgres.search import SearchQuery
 
-from blogs.models import Post, Blog
+from blogs.models import DiscoverPost, Post, Blog
 from blogs.helpers import clean_text, random_post_link, random_blog_link
+from blogs.random_pool import sample_posts
 from blogs.templatetags.custom_tags import markdown, plain_title
+from blogs.tasks import executor
+from blogs.utils.keyset import decode_cursor, keyset_page, page_cursors
 
-import random
+import hashlib
+import time
+from datetime import datetime
+from urllib.parse import urlencode
 from feedgen.feed import FeedGenerator
 
 posts_per_page = 20
 max_page = 5000
 
+# Types of the fields pages are sorted by, for reading cursors
+cursor_types = {'score': float, 'published_date': datetime, 'upvotes': int}
+
+discover_cache = caches['discover']
+
+# Anonymous visitors to the first few pages all see the same list, so it's cached rendered
+cached_pages = 5
+
+# Cached fragments older than this are re-rendered in the background
+refresh_after = 300
+
+
+def bump_discover_generation(moderated=False):
+    # Marks every cached fragment as out of date. Called once per batch (rescores that move the
+    # ranking, the nightly sync, moderation), single saves wait out refresh_after instead
+    generation = time.time_ns()
+    values = {'generation': generation}
+    if moderated:
+        # Fragments from before this aren't served again, not even while they're re-rendered
+        values['moderated'] = generation
+    discover_cache.set_many(values, None)
+
+
+def ranking_changed(changes):
+    """Whether rescored posts moved on a cached trending page, overall or in their language.
+
+    changes are the dicts rescore returns. A post counts when its old or new score reaches
+    the cached pages, posts further down only move pages that are rendered per request.
+    """
+    # The higher of each post's two scores decides whether it reaches the cached pages
+    moved = {change['id']: max(change['score'], change['old_score']) for change in changes if change['score'] != change['old_score']}
+    if not moved:
+        return False
+
+    langs = {'': set(moved)}
+    for pk, lang, blog_lang in DiscoverPost.objects.filter(pk__in=moved).values_list('pk', 'lang', 'blog_lang'):
+        # The post's language, or its blog's, as filter_lang matches them
+        lang = (lang or blog_lang or '')[:2]
+        if lang:
+            langs.setdefault(lang, set()).add(pk)
+
+    top = (cached_pages + 1) * posts_per_page
+    for lang, pks in langs.items():
+        ranked = list(filter_lang(get_discover_query(), lang).order_by('-score', '-pk').values_list('pk', 'score')[:top])
+        if len(ranked) < top or pks & {pk for pk, _ in ranked}:
+            return True
+        if any(moved[pk] >= ranked[-1][1] for pk in pks):
+            return True
+    return False
+
+
+def cached_fragment(parts, render_fragment):
+    """Returns render_fragment() through the discover cache, keyed on parts.
+
+    Entries remember the discover generation they were rendered at. Once that moves on or
+    the entry is refresh_after seconds old, the first request to notice re-renders it in the
+    background and everyone keeps getting the old copy until it's done. Entries from before
+    a moderation bump are re-rendered inline instead.
+    """
+    key = 'fragment:' + hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+    values = discover_cache.get_many([key, 'generation', 'moderated'])
+    entry = values.get(key)
+    generation = values.get('generation', 0)
+
+    if entry and entry['generation'] < values.get('moderated', 0):
+        # Staff hid something on it, render it now rather than keep showing it
+        entry = None
+
+    if entry and entry['generation'] == generation and entry['rendered_at'] > time.time() - refresh_after:
+        return entry['content']
+
+    if entry and executor.background:
+        if discover_cache.add(f'{key}:refreshing', True, 60):
+            executor.submit('discover', refresh_fragment, key, render_fragment, generation)
+        return entry['content']
+
+    return refresh_fragment(key, render_fragment, generation)
+
+
+def refresh_fragment(key, render_fragment, generation):
+    content = render_fragment()
+    discover_cache.set(key, {'generation': generation, 'rendered_at': time.time(), 'content': content})
+    discover_cache.delete(f'{key}:refreshing')
+    return content
+
+
+def filter_lang(queryset, lang):
+    if not lang:
+        return queryset
+    return queryset.filter(
+        (Q(lang__startswith=lang) & ~Q(lang='')) |
+        (Q(lang='') & Q(blog_lang__startswith=lang) & ~Q(blog_lang=''))
+    )
 
-def get_base_query(user=None):
-    queryset = Post.objects.select_related("blog").filter(
+
+def eligible_posts():
+    # Everything but the hidden flags and the publish time, which DiscoverPost keeps as columns
+    return Post.objects.filter(
         publish=True,
         blog__reviewed=True,
         blog__user__is_active=True,
         make_discoverable=True,
-        published_date__lte=timezone.now(),
         blog__posts_in_last_12_hours__lte=3,
         content_length__gte=150
     )
 
+
+def get_base_query(user=None):
+    queryset = eligible_posts().select_related("blog").filter(published_date__lte=timezone.now())
+
     if user and user.is_authenticated:
         queryset = queryset.filter(
             Q(hidden=False, blog__hidden=False) |
@@ -37,6 +143,107 @@ def get_base_query(user=None):
     return queryset
 
 
+def get_discover_query(user=None):
+    # Same posts as get_base_query, from the discover table
+    queryset = DiscoverPost.objects.filter(published_date__lte=timezone.now())
+
+    if user and user.is_authenticated:
+        queryset = queryset.filter(
+            Q(hidden=False, blog_hidden=False) |
+            Q(user=user)
+        )
+    else:
+        queryset = queryset.filter(hidden=False, blog_hidden=False)
+
+    return queryset
+
+
+def blog_fields(blog):
+    return {
+        'subdomain': blog.subdomain,
+        'blog_url': blog.useful_domain,
+        'blog_lang': blog.lang,
+        'blog_hidden': blog.hidden,
+    }
+
+
+def discover_entry(post, blog):
+    return DiscoverPost(
+        post_id=post.pk,
+        blog_id=blog.pk,
+        user_id=blog.user_id,
+        title=post.title,
+        slug=post.slug,
+        published_date=post.published_date,
+        score=post.score,
+        upvotes=post.upvotes,
+        shadow_votes=post.shadow_votes,
+        lang=post.lang,
+        hidden=post.hidden,
+        **blog_fields(blog),
+    )
+
+
+post_fields = ['title', 'slug', 'published_date', 'score', 'upvotes', 'shadow_votes', 'lang', 'hidden']
+entry_fields = post_fields + ['subdomain', 'blog_url', 'blog_lang', 'blog_hidden']
+
+
+def sync_discover_post(post):
+    if eligible_posts().filter(pk=post.pk).exists():
+        DiscoverPost.objects.bulk_create(
+            [discover_entry(post, post.blog)],
+            update_conflicts=True,
+            unique_fields=['post'],
+            update_fields=entry_fields,
+        )
+        return True
+    return DiscoverPost.objects.filter(pk=post.pk).delete()[0] > 0
+
+
+def sync_discover_blog(blog, full=False):
+    """Brings the blog's discover entries in line with the blog.
+
+    Post changes are synced by the post's own save, so by default this only updates the
+    blog's columns and adds eligible posts that are missing. full also rewrites every
+    entry from its post, for rebuilding the table. Returns the number of entries changed.
+    """
+    if not Blog.objects.filter(pk=blog.pk, reviewed=True, user__is_active=True, posts_in_last_12_hours__lte=3).exists():
+        return DiscoverPost.objects.filter(blog=blog).delete()[0]
+
+    fields = blog_fields(blog)
+    # Only touch the rows that are out of date
+    changed = DiscoverPost.objects.filter(blog=blog).exclude(**fields).update(**fields)
+
+    posts = eligible_posts().filter(blog=blog).only('id', *post_fields)
+    if full:
+        changed += DiscoverPost.objects.filter(blog=blog).exclude(post__in=posts).delete()[0]
+    else:
+        posts = posts.filter(discover_entry__isnull=True)
+
+    changed += len(DiscoverPost.objects.bulk_create(
+        [discover_entry(post, blog) for post in posts.iterator(chunk_size=500)],
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['post'],
+        update_fields=entry_fields,
+    ))
+    return changed
+
+
+def get_cursors(request, field):
+    # Cursor links (?after=, ?before=) from the previous/next buttons seek by field and id,
+    # plain ?page= numbers still work with an offset
+    return decode_cursor(request.GET.get('after'), cursor_types[field]), decode_cursor(request.GET.get('before'), cursor_types[field])
+
+
+def get_page(queryset, field, posts_from, after=None, before=None):
+    if after or before:
+        posts = keyset_page(queryset, field, posts_per_page, after=after, before=before)
+    else:
+        posts = list(queryset.order_by(f'-{field}', '-pk')[posts_from:posts_from + posts_per_page])
+    return posts, *page_cursors(posts, field)
+
+
 def admin_actions(request):
     # admin actions
     if request.user.is_staff:
@@ -52,6 +259,10 @@ def admin_actions(request):
             post = Post.objects.get(pk=request.POST.get("block-blog"))
             post.blog.user.is_active = False
             post.blog.user.save()
+
+        # Hidden and blocked posts drop off the cached pages on the next request
+        if any(request.POST.get(action) for action in ("hide-post", "hide-blog", "block-blog")):
+            bump_discover_generation(moderated=True)
         
         if request.POST.get("set-values", False):
             post = Post.objects.get(pk=request.POST.get("set-values"))
@@ -97,12 +308,13 @@ def discover(request):
     page = min(page, max_page)
 
     posts_from = page * posts_per_page
-    posts_to = (page * posts_per_page) + posts_per_page
 
     newest = request.GET.get("newest")
     random_feed = request.GET.get("random")
 
-    base_query = get_base_query(request.user)
+    base_query = get_discover_query(request.user)
+    if request.user.is_staff:
+        base_query = base_query.select_related('user__settings')
     
     # Get blog objects for display
     hide_list = None
@@ -114,56 +326,46 @@ def discover(request):
             base_query = base_query.exclude(blog__in=hide_list)
 
     lang = request.COOKIES.get('lang')
-
-    if lang:
-        base_query = base_query.filter(
-            (Q(lang__startswith=lang) & ~Q(lang='')) |
-            (Q(lang='') & Q(blog__lang__startswith=lang) & ~Q(blog__lang=''))
-        )
+    base_query = filter_lang(base_query, lang)
 
     if random_feed:
-        probe_langs = {'en', 'pt', 'es', 'zh', 'fr', 'de'}
-        use_probes = not lang or lang in probe_langs
-
-        if use_probes:
-            # Fast path: random ID probes for common languages,
-            # batched into UNION queries to avoid sequential round-trips
-            agg = Post.objects.aggregate(max_id=Max('id'), min_id=Min('id'))
-            results = []
-            found_ids = set()
-            if agg['max_id']:
-                for _ in range(10):
-                    probes = [
-                        base_query.filter(
-                            id__gte=random.randint(agg['min_id'], agg['max_id'])
-                        ).order_by('id').values('id')[:1]
-                        for _ in range(posts_per_page)
-                    ]
-                    for row in probes[0].union(*probes[1:]):
-                        found_ids.add(row['id'])
-                    if len(found_ids) >= posts_per_page:
-                        break
-                results = list(base_query.filter(id__in=list(found_ids)[:posts_per_page]))
-                random.shuffle(results)
-            posts = results
-        else:
-            # Slow fallback: ORDER BY random() for rare languages where probes have too low a hit rate
-            posts = list(base_query.order_by('?')[:posts_per_page])
-    elif newest:
-        posts = base_query.order_by("-published_date")
+        # Sampled from the pool, with extra ids for posts hidden since it was built or on the hide list
+        ids = sample_posts(posts_per_page * 2, lang)
+        found = base_query.select_related('blog').in_bulk(ids)
+        posts = [found[pk] for pk in ids if pk in found][:posts_per_page]
+        posts_html = render_to_string("snippets/discover_posts.html", {
+            "posts": posts,
+            "posts_from": posts_from,
+            "random": random_feed,
+        }, request=request)
     else:
-        posts = base_query.order_by("-score")
-
-    if not random_feed:
-        posts = posts[posts_from:posts_to]
+        field = 'published_date' if newest else 'score'
+        after, before = get_cursors(request, field)
+
+        def render_posts(request=None):
+            # Cached renders rebuild the query so it isn't pinned to one request's time
+            queryset = base_query if request else filter_lang(get_discover_query(), lang)
+            posts, previous_cursor, next_cursor = get_page(queryset, field, posts_from, after, before)
+            return render_to_string("snippets/discover_posts.html", {
+                "posts": posts,
+                "previous_page": page - 1,
+                "next_page": page + 1 if page < max_page else None,
+                "previous_cursor": previous_cursor,
+                "next_cursor": next_cursor,
+                "posts_from": posts_from,
+                "newest": newest,
+            }, request=request)
+
+        # Cursors come straight from the query string, only page numbers share a cache entry
+        if request.user.is_authenticated or page > cached_pages or after or before:
+            posts_html = render_posts(request)
+        else:
+            posts_html = cached_fragment(('discover', field, lang, page), render_posts)
 
     return render(request, "discover.html", {
         "lang": lang,
         "available_languages": get_available_languages(),
-        "posts": posts,
-        "previous_page": page - 1,
-        "next_page": page + 1 if page < max_page else None,
-        "posts_from": posts_from,
+        "posts_html": posts_html,
         "newest": newest,
         "random": random_feed,
         "hide_list": hide_list
@@ -180,7 +382,26 @@ def feed(request):
     feed_kind = "newest" if request.GET.get("newest") else "trending"
     feed_type = 'rss' if request.GET.get("type") == "rss" else "atom"
     lang = request.GET.get("lang")
-    
+    field = 'published_date' if feed_kind == 'newest' else 'score'
+
+    # ?after= pages through older entries, linked from the Atom feed
+    after = decode_cursor(request.GET.get('after'), cursor_types[field])
+
+    def render_feed():
+        return build_feed(feed_kind, feed_type, lang, field, after)
+
+    if after:
+        feed_str = render_feed()
+    else:
+        # Feed readers poll the first page, don't render 20 posts for each of them
+        feed_str = cached_fragment(('feed', feed_kind, feed_type, lang), render_feed)
+
+    response = HttpResponse(feed_str, content_type="application/xml")
+    response['Cache-Control'] = "public, s-maxage=3600, max-age=0"
+    return response
+
+
+def build_feed(feed_kind, feed_type, lang, field, after=None):
     fg = FeedGenerator()
     fg.id("bearblog")
     fg.author({"name": "Bear Blog", "email": "feed@bearblog.dev"})
@@ -190,28 +411,28 @@ def feed(request):
     else:
         feed_method = fg.atom_str
     
-    base_query = get_base_query().select_related('blog__user__settings')
-    if lang:
-        base_query = base_query.filter(
-            (Q(lang__startswith=lang) & ~Q(lang='')) |
-            (Q(lang='') & Q(blog__lang__startswith=lang) & ~Q(blog__lang=''))
-        )
+    base_query = filter_lang(get_discover_query(), lang)
     if feed_kind == 'newest':
         fg.title("Bear Blog Most Recent Posts")
         fg.subtitle("Most recent posts on Bear Blog")
         fg.link(href="https://bearblog.dev/discover/?newest=True", rel="alternate")
-        # Sort by published date
-        all_posts = base_query.order_by("-published_date")[:posts_per_page]
-        
     else:
         fg.title("Bear Blog Trending Posts")
         fg.subtitle("Trending posts on Bear Blog")
         fg.link(href="https://bearblog.dev/discover/", rel="alternate")
-        # Sort by score and then by published date
-        all_posts = base_query.order_by("-score", "-published_date")[:posts_per_page]
+
+    entries = keyset_page(base_query, field, posts_per_page, after=after)
+    if feed_type == 'atom' and len(entries) == posts_per_page:
+        _, next_cursor = page_cursors(entries, field)
+        params = urlencode({k: v for k, v in {'newest': 'true' if feed_kind == 'newest' else None, 'lang': lang, 'after': next_cursor}.items() if v})
+        fg.link(href=f"https://bearblog.dev/discover/feed/?{params}", rel="next")
+
+    # Rendering needs the whole post, fetch just these by id
+    ids = [entry.pk for entry in entries]
+    posts = Post.objects.select_related('blog__user__settings').in_bulk(ids)
 
     # Reverse the most recent posts
-    all_posts = list(all_posts)[::-1]
+    all_posts = [posts[pk] for pk in ids if pk in posts][::-1]
 
     for post in all_posts:
         fe = fg.add_entry()
@@ -228,11 +449,7 @@ def feed(request):
         fe.updated(post.published_date)
 
     # Generate the feed string
-    feed_str = feed_method(pretty=True)
-
-    response = HttpResponse(feed_str, content_type="application/xml")
-    response['Cache-Control'] = "public, s-maxage=3600, max-age=0"
-    return response
+    return feed_method(pretty=True)
 
 
 def search(request):
@@ -246,14 +463,14 @@ def search(request):
     page = min(page, max_page)
 
     posts_from = page * posts_per_page
-    posts_to = posts_from + posts_per_page
+    previous_cursor = next_cursor = None
 
     if search_string:
-        posts = (
-            get_base_query().filter(
-                search_vector=SearchQuery(search_string, search_type='websearch')
-            )
-            .order_by('-upvotes')[posts_from:posts_to]
+        posts, previous_cursor, next_cursor = get_page(
+            get_base_query().filter(search_vector=SearchQuery(search_string, search_type='websearch')),
+            'upvotes',
+            posts_from,
+            *get_cursors(request, 'upvotes'),
         )
 
     return render(request, "search.html", {
@@ -261,6 +478,8 @@ def search(request):
         "search_string": search_string,
         "previous_page": page - 1,
         "next_page": page + 1 if page < max_page else None,
+        "previous_cursor": previous_cursor,
+        "next_cursor": next_cursor,
     })
 
 
@@ -2,7 +2,7 @@ import re
 
 from blogs.utils.csv import render_to_csv_response
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
@@ -28,11 +28,8 @@ def email_list(request, id):
         return render_to_csv_response(subscribers)
 
     if request.GET.get("export-txt", ""):
-        subscribers = subscribers.values('email_address')
-        file_data = ""
-        for subscriber in subscribers:
-            file_data += subscriber['email_address'] + "\n"
-        response = HttpResponse(file_data, content_type='text/plain; charset=utf-8')
+        email_addresses = subscribers.values_list('email_address', flat=True).iterator(chunk_size=2000)
+        response = StreamingHttpResponse((email_address + "\n" for email_address in email_addresses), content_type='text/plain; charset=utf-8')
         response['Content-Disposition'] = 'attachment; filename="emails.txt"'
         return response
 
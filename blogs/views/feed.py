@@ -2,13 +2,23 @@ from django.http import HttpResponse
 from django.utils import timezone
 
 from blogs.helpers import unmark
-from blogs.templatetags.custom_tags import markdown, plain_title
-from blogs.views.blog import not_found, resolve_address
+from blogs.models import FeedEntry
+from blogs.templatetags.custom_tags import RENDERER_VERSION, markdown, plain_title
+from blogs.views.blog import blog_etag, last_modified_date, not_found, not_modified, resolve_address, set_cache_headers, visible_posts_state
 
+from feedgen.entry import FeedEntry as FeedGenEntry
 from feedgen.feed import FeedGenerator
+from lxml import etree
+import hashlib
 import re
 
 
+RSS_NSMAP = {
+    'atom': 'http://www.w3.org/2005/Atom',
+    'content': 'http://purl.org/rss/1.0/modules/content/',
+}
+
+
 def clean_string(s):
     s = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x9F]', '', s)
     s = re.sub(r'[\uFFFE\uFFFF\uFDD0-\uFDEF]', '', s)
@@ -32,6 +42,14 @@ def feed(request):
     blog = resolve_address(request)
     if not blog:
         return not_found(request)
+
+    posts_state = visible_posts_state(blog)
+    etag = blog_etag(request, blog, posts_state)
+    last_modified = last_modified_date(blog, posts_state)
+    response = not_modified(request, blog, etag, last_modified)
+    if response:
+        return response
+
     try:
         feed = generate_feed(blog, feed_type, tag, page)
     except Exception as e:
@@ -40,13 +58,11 @@ def feed(request):
         raise e
     
     response = HttpResponse(feed, content_type=f'application/{feed_type}+xml')
-    response['Cache-Tag'] = blog.subdomain
-    response['Cache-Control'] = "public, s-maxage=43200, max-age=0"
-    return response
+    return set_cache_headers(response, blog, etag, last_modified)
 
 
 def generate_feed(blog, feed_type="atom", tag=None, page=0):
-    all_posts = blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now()).order_by('-published_date')
+    all_posts = blog.posts.filter(publish=True, is_page=False, published_date__lte=timezone.now()).select_related('feed_entry').order_by('-published_date')
 
     if tag:
         all_posts = all_posts.filter(all_tags__icontains=tag).order_by('-published_date')
@@ -58,9 +74,6 @@ def generate_feed(blog, feed_type="atom", tag=None, page=0):
     # Only last 10 posts
     all_posts = all_posts[first_post:last_post]
 
-    # Reverse the most recent posts 
-    all_posts = list(all_posts)[::-1] 
-
     fg = FeedGenerator()
     fg.id(blog.useful_domain)
     fg.author({'name': clean_string(blog.subdomain)})
@@ -71,33 +84,116 @@ def generate_feed(blog, feed_type="atom", tag=None, page=0):
     fg.subtitle(clean_string(blog.meta_description or unmark(blog.content)[:157] + '...' or blog.title))
     fg.link(href=f"{blog.useful_domain}/", rel='alternate')
 
-    for post in all_posts:
-        fe = fg.add_entry()
-        fe.id(f"{blog.useful_domain}/{post.slug}/")
-        fe.title(clean_string(plain_title(post.title)))
-        fe.author({'name': clean_string(blog.subdomain), 'email': 'hidden'})
-        fe.link(href=f"{blog.useful_domain}/{post.slug}/")
-        if post.meta_description:
-            fe.summary(clean_string(post.meta_description))
-
-        # Strip nav directives: their relative links break in feed readers
-        # and each one costs 2 adjacent-post queries per entry
-        post_content = post.content.replace('{{ email-signup }}', '')
-        post_content = post_content.replace('{{ next_post }}', '')
-        post_content = post_content.replace('{{ previous_post }}', '')
-
-        fe.content(clean_string(markdown(post_content, blog, post)), type="html")
-
-        fe.published(post.published_date)
-        fe.updated(post.last_modified)
-
-        for tag in post.tags:
-            fe.category(term=clean_string(tag))
+    # Entries are pre-rendered per post, most recent first
+    entries = [get_feed_entry(blog, post) for post in all_posts]
 
     if feed_type == "atom":
         fg.link(href=f"{blog.useful_domain}/feed/", rel='self')
-        return fg.atom_str(pretty=True)
+        return splice_entries(fg.atom_str(pretty=True), b'</feed>', [entry.atom for entry in entries])
     elif feed_type == "rss":
         fg.link(href=f"{blog.useful_domain}/feed/?type=rss", rel='self', type='application/rss+xml')
         fg.link(href=f"{blog.useful_domain}", rel='self')
-        return fg.rss_str(pretty=True)
+        return splice_entries(fg.rss_str(pretty=True), b'</channel>', [entry.rss for entry in entries])
+
+
+def splice_entries(feed_xml, closing_tag, entries):
+    head, closing_tag, tail = feed_xml.rpartition(closing_tag)
+    return head + ''.join(entries).encode('utf-8') + closing_tag + tail
+
+
+def feed_post_content(post):
+    # Strip nav directives: their relative links break in feed readers
+    # and each one costs 2 adjacent-post queries per entry
+    post_content = post.content.replace('{{ email-signup }}', '')
+    post_content = post_content.replace('{{ next_post }}', '')
+    post_content = post_content.replace('{{ previous_post }}', '')
+    return post_content
+
+
+def feed_entry_fingerprint(blog, post, post_content):
+    parts = [
+        RENDERER_VERSION,
+        blog.useful_domain,
+        blog.subdomain,
+        blog.user.settings.upgraded,
+        post.slug,
+        post.title,
+        post.meta_description,
+        post.published_date.timestamp(),
+        post.last_modified.timestamp() if post.last_modified else '',
+        post.all_tags,
+        post_content,
+    ]
+    return hashlib.sha256('\x00'.join(str(part) for part in parts).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def render_feed_entry(blog, post, post_content, fingerprint=''):
+    fe = FeedGenEntry()
+    fe.id(f"{blog.useful_domain}/{post.slug}/")
+    fe.title(clean_string(plain_title(post.title)))
+    fe.author({'name': clean_string(blog.subdomain), 'email': 'hidden'})
+    fe.link(href=f"{blog.useful_domain}/{post.slug}/")
+    if post.meta_description:
+        fe.summary(clean_string(post.meta_description))
+
+    fe.content(clean_string(markdown(post_content, blog, post)), type="html")
+
+    fe.published(post.published_date)
+    fe.updated(post.last_modified)
+
+    for tag in post.tags:
+        fe.category(term=clean_string(tag))
+
+    # RSS items use the content: namespace, serialise them inside an <rss> so it's declared as content:
+    rss = etree.Element('rss', nsmap=RSS_NSMAP)
+    rss.append(fe.rss_entry())
+
+    return FeedEntry(
+        post=post,
+        fingerprint=fingerprint,
+        atom=etree.tostring(fe.atom_entry(), pretty_print=True, encoding='unicode'),
+        rss=etree.tostring(rss[0], pretty_print=True, encoding='unicode'),
+    )
+
+
+def materialize_feed_entry(blog, post, post_content=None):
+    if post_content is None:
+        post_content = feed_post_content(post)
+
+    # Remaining directives depend on more than the post itself (other posts, the time), so render those live
+    if '{{' in post_content:
+        return render_feed_entry(blog, post, post_content)
+
+    entry = render_feed_entry(blog, post, post_content, feed_entry_fingerprint(blog, post, post_content))
+    FeedEntry.objects.update_or_create(post=post, defaults={
+        'fingerprint': entry.fingerprint,
+        'atom': entry.atom,
+        'rss': entry.rss,
+    })
+    return entry
+
+
+def update_feed_entry(blog, post):
+    # On save: only render when something in the entry changed, not for hides, score or setting updates
+    post_content = feed_post_content(post)
+    if '{{' in post_content:
+        return
+
+    if FeedEntry.objects.filter(post=post, fingerprint=feed_entry_fingerprint(blog, post, post_content)).exists():
+        return
+
+    materialize_feed_entry(blog, post, post_content)
+
+
+def get_feed_entry(blog, post):
+    post_content = feed_post_content(post)
+
+    try:
+        entry = post.feed_entry
+    except FeedEntry.DoesNotExist:
+        entry = None
+
+    if entry and entry.fingerprint == feed_entry_fingerprint(blog, post, post_content):
+        return entry
+
+    return materialize_feed_entry(blog, post, post_content)
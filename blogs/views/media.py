@@ -14,9 +14,9 @@ import re
 import json
 import os
 import boto3
-import threading
 
 from blogs.models import Blog, Media
+from blogs.tasks import executor
 
 bucket_name = os.getenv('SPACES_BUCKET', 'bear-images')
 
@@ -140,21 +140,21 @@ def upload_files(blog, file_list, optimise=True):
         
         filepath = f'{blog.subdomain}/{file_name}.{extension}'
         url = f'https://{bucket_name}.sfo2.cdn.digitaloceanspaces.com/{filepath}'
-        file_links.append(url)
-
-        # Create Media object first
-        Media.objects.create(blog=blog, url=url)
 
-        # Read file data before starting thread
+        # Read file data before handing it to the upload queue
         file_data = file.read()
         content_type = file.content_type
 
-        # Move S3 upload to a thread
-        thread = threading.Thread(
-            target=upload_to_s3,
-            args=(filepath, file_data, content_type)
-        )
-        thread.start()
+        if not executor.submit('media', upload_to_s3, filepath, file_data, content_type):
+            # The upload queue is full, upload now rather than link to a file that never arrives
+            try:
+                upload_to_s3(filepath, file_data, content_type)
+            except Exception:
+                file_links.append('Error: The file could not be uploaded, please try again.')
+                break
+
+        Media.objects.create(blog=blog, url=url)
+        file_links.append(url)
     
     return sorted(file_links)
 
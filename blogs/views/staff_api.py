@@ -10,7 +10,11 @@ from django.http import JsonResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
+from blogs.cloudflare import purge_queue
+from blogs.helpers import country_cache, user_agent_cache
+from blogs.hits import hit_queue
 from blogs.models import Blog, Post
+from blogs.tasks import executor
 from blogs.views.discover import get_base_query
 
 
@@ -162,3 +166,24 @@ def unreviewed_blogs(request):
         blogs.append(data)
 
     return JsonResponse({'blogs': blogs})
+
+
+@api_auth
+def hit_queue_stats(request):
+    # Per worker process, so repeated calls may land on different workers
+    return JsonResponse({
+        'pid': os.getpid(),
+        **hit_queue.stats(),
+        'country_cache': country_cache.stats(),
+        'user_agent_cache': user_agent_cache.stats(),
+    })
+
+
+@api_auth
+def task_stats(request):
+    # Per worker process, like the hit queue stats
+    return JsonResponse({
+        'pid': os.getpid(),
+        **executor.stats(),
+        'cloudflare_purges': purge_queue.stats(),
+    })
@@ -32,6 +32,11 @@ LEMONSQUEEZY_SIGNATURE = os.getenv('LEMONSQUEEZY_SIGNATURE')
 
 DEBUG = (os.getenv('DEBUG') == 'True')
 
+# Emails, cache purges, uploads, backups and hit writes run on background threads.
+# Inline on dev, and the test runner turns them off so tests see their effects
+BACKGROUND_TASKS = os.getenv('ENVIRONMENT') != 'dev'
+TEST_RUNNER = 'conf.test_runner.TestRunner'
+
 if not DEBUG:
     # Logging settings
     def before_send(event, hint):
@@ -158,6 +163,33 @@ DATABASES = {
 if os.getenv('DATABASE_URL'):
     DATABASES['default'] = _parse_database_url(os.getenv('DATABASE_URL'), conn_max_age=600)
 
+# Cache
+# Rendered markdown lives in the database so it's shared between dynos and survives restarts.
+# Created on release with `python manage.py createcachetable`
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'markdown': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'markdown_cache',
+        'TIMEOUT': 60 * 60 * 24 * 30, # 30 days
+        'OPTIONS': {
+            'MAX_ENTRIES': 200000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+    # Rendered discover pages and feeds, shared between workers
+    'discover': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'discover_cache',
+        'TIMEOUT': 60 * 60, # 1 hour
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -199,6 +231,8 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 GEOIP_PATH = "geoip/"
+# GeoIP2 reader mode: 0 auto (C extension mmap, then pure Python mmap), 1 C mmap, 2 mmap, 4 file, 8 memory
+GEOIP_CACHE = int(os.getenv('GEOIP_CACHE', 0))
 
 # Enable WhiteNoise's GZip compression of static assets.
 STATICFILES_STORAGE = "whitenoise.storage.CompressedStaticFilesStorage"
@@ -0,0 +1,9 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        # Run background tasks inline, no worker threads holding connections to the test database
+        settings.BACKGROUND_TASKS = False